@@ -0,0 +1,190 @@
+"""
+A small artifact store for the files produced by the web UIs (screenshots, uploads
+and annotated images).
+
+Files are content-addressed, so identical artifacts are written once and can be served
+with long-lived cache headers. Encoding and disk writes happen on a background thread,
+which keeps disk I/O off the streaming response, and a size/age based retention policy
+bounds the disk usage of long-lived hosts. Retention only deletes files the store named
+itself and skips the ones live sessions still reference, so a store may share its
+directory with other files.
+"""
+
+import hashlib
+import os
+import queue
+import re
+import threading
+import time
+from typing import Callable, Dict, Iterable, Optional
+
+from PIL import Image
+
+
+class ArtifactStore:
+    """
+    A directory of content-addressed artifacts with asynchronous writes and retention.
+
+    Args:
+        root(str): Directory in which artifacts are stored.
+        max_bytes(int, optional): Upper bound for the total size of the directory.
+        max_age(float, optional): Artifacts older than this many seconds are deleted.
+        retention_interval(int): Run the retention policy after this many writes.
+        in_use(Callable, optional): Returns the names that must be kept (e.g. referenced by
+            live sessions); called from the writer thread.
+    """
+
+    # Names are derived from the content, so a name never points to different bytes.
+    CACHE_HEADERS = {"Cache-Control": "public, max-age=31536000, immutable"}
+    CACHE_MAX_AGE = 31536000
+    # Names produced by `_digest`; retention never touches other files in the directory.
+    NAME_PATTERN = re.compile(r"[0-9a-f]{32}\.[a-z0-9]+")
+
+    def __init__(
+        self,
+        root: str,
+        max_bytes: Optional[int] = None,
+        max_age: Optional[float] = None,
+        retention_interval: int = 32,
+        in_use: Optional[Callable[[], Iterable[str]]] = None,
+    ):
+        self.root = root
+        self.max_bytes = max_bytes or None
+        self.max_age = max_age or None
+        self.retention_interval = retention_interval
+        self.in_use = in_use
+
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock()
+        self._pending: Dict[str, threading.Event] = {}
+        self._queue = queue.Queue()
+        self._writes = 0
+        self._writer = threading.Thread(target=self._run, daemon=True)
+        self._writer.start()
+        self._queue.put((None, self.enforce_retention))
+
+    @staticmethod
+    def _digest(*chunks) -> str:
+        digest = hashlib.blake2b(digest_size=16)
+        for chunk in chunks:
+            digest.update(chunk)
+        return digest.hexdigest()
+
+    def put_bytes(self, data: bytes, ext: str) -> str:
+        """
+        Store already encoded bytes (e.g. a PNG) and return the artifact name.
+        The write happens in the background; use `wait` before reading the file.
+        """
+        name = f"{self._digest(data)}.{ext.lower()}"
+
+        def write(path):
+            with open(path, "wb") as f:
+                f.write(data)
+
+        return self._submit(name, write)
+
+    def put_image(self, image: Image.Image, fmt: str = "PNG") -> str:
+        """
+        Store a PIL image and return the artifact name. Encoding is done on the
+        writer thread, so the image must not be modified after this call.
+        """
+        name = "{}.{}".format(
+            self._digest(
+                image.mode.encode(), str(image.size).encode(), image.tobytes()
+            ),
+            fmt.lower(),
+        )
+        return self._submit(name, lambda path: image.save(path, format=fmt))
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, os.path.basename(name))
+
+    def wait(self, name: str, timeout: Optional[float] = 30.0) -> bool:
+        """Block until a pending write of `name` has reached the disk."""
+        with self._lock:
+            event = self._pending.get(os.path.basename(name))
+        return event.wait(timeout) if event is not None else True
+
+    def flush(self, timeout: Optional[float] = None):
+        """Wait for all writes queued so far."""
+        with self._lock:
+            events = list(self._pending.values())
+        for event in events:
+            event.wait(timeout)
+
+    def close(self):
+        self._queue.put(None)
+        self._writer.join()
+
+    def _submit(self, name: str, write: Callable[[str], None]) -> str:
+        with self._lock:
+            if name in self._pending:
+                return name
+            event = threading.Event()
+            self._pending[name] = event
+        self._queue.put((name, write))
+        return name
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            name, job = item
+            if name is None:
+                job()
+                continue
+            try:
+                self._write(name, job)
+            except Exception as e:
+                print(f"Failed to write artifact {name}: {e}")
+            finally:
+                with self._lock:
+                    self._pending.pop(name).set()
+
+            self._writes += 1
+            if self._writes % self.retention_interval == 0:
+                self.enforce_retention()
+
+    def _write(self, name: str, write: Callable[[str], None]):
+        path = self.path(name)
+        if os.path.exists(path):
+            # Deduplicated: refresh the mtime so that retention keeps it.
+            os.utime(path)
+            return
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        write(tmp_path)
+        os.replace(tmp_path, path)
+
+    def enforce_retention(self):
+        """
+        Delete artifacts that are older than `max_age` or exceed `max_bytes`. Only names
+        created by the store are considered, pending and in-use artifacts are kept.
+        """
+        if self.max_bytes is None and self.max_age is None:
+            return
+
+        with self._lock:
+            keep = set(self._pending)
+        if self.in_use is not None:
+            keep.update(os.path.basename(name) for name in self.in_use())
+        entries = []
+        for entry in os.scandir(self.root):
+            if not entry.is_file() or entry.name in keep or not self.NAME_PATTERN.fullmatch(entry.name):
+                continue
+            stat = entry.stat()
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        now = time.time()
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            expired = self.max_age is not None and now - mtime > self.max_age
+            oversized = self.max_bytes is not None and total > self.max_bytes
+            if not expired and not oversized:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except OSError:
+                pass
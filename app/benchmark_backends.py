@@ -0,0 +1,177 @@
+"""
+This script compares inference backends (see model_backend.py) on a set of screenshots.
+
+For every backend it reports the load time, the generation latency and throughput, and the
+quality of the parsed output: how often a grounded operation can be parsed at all, how often
+the operation matches the `default` backend, and the IoU of the predicted boxes against it.
+
+Each screenshot is paired with a task, either from a tasks.jsonl file in the screenshot
+directory (lines like {"image": "img_1.png", "task": "Open the settings"}) or from --task:
+python benchmark_backends.py --model_path THUDM/cogagent-9b-20241220 --screenshots ./screens --backends default,int4,cpu
+"""
+
+import argparse
+import gc
+import json
+import os
+import re
+import statistics
+import time
+from typing import Dict, List, Optional, Tuple
+
+import torch
+from PIL import Image
+from transformers import AutoModel
+
+from model_backend import BACKENDS, load_model
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def load_samples(directory: str, task: str) -> List[Tuple[str, str]]:
+    """Returns (image path, task) pairs from `directory`."""
+    tasks_file = os.path.join(directory, "tasks.jsonl")
+    if os.path.exists(tasks_file):
+        with open(tasks_file) as f:
+            items = [json.loads(line) for line in f if line.strip()]
+        return [(os.path.join(directory, item["image"]), item["task"]) for item in items]
+    images = sorted(f for f in os.listdir(directory) if f.lower().endswith(IMAGE_EXTENSIONS))
+    return [(os.path.join(directory, image), task) for image in images]
+
+
+def parse_operation(response: str) -> Tuple[Optional[str], Optional[List[int]]]:
+    """Extracts the operation name and the first box of the grounded operation."""
+    match = re.search(r"Grounded Operation:\s*(\w+)\((.*)", response)
+    if not match:
+        return None, None
+    box = re.search(r"box=\[\[?(\d+),(\d+),(\d+),(\d+)\]?\]", match.group(2))
+    return match.group(1), [int(x) for x in box.groups()] if box else None
+
+
+def box_iou(a: List[int], b: List[int]) -> float:
+    width = max(0, min(a[2], b[2]) - max(a[0], b[0]))
+    height = max(0, min(a[3], b[3]) - max(a[1], b[1]))
+    intersection = width * height
+    union = (a[2] - a[0]) * (a[3] - a[1]) + (b[2] - b[0]) * (b[3] - b[1]) - intersection
+    return intersection / union if union > 0 else 0.0
+
+
+@torch.inference_mode()
+def run_sample(model, tokenizer, image_path: str, task: str, args) -> Dict:
+    query = f"Task: {task}\nHistory steps: \n(Platform: {args.platform})\n{args.format}\n"
+    image = Image.open(image_path).convert("RGB")
+    start = time.perf_counter()
+    inputs = tokenizer.apply_chat_template(
+        [{"role": "user", "image": image, "content": query}],
+        add_generation_prompt=True,
+        tokenize=True,
+        return_tensors="pt",
+        return_dict=True,
+    ).to(model.device)
+    outputs = model.generate(
+        **inputs, max_new_tokens=args.max_new_tokens, do_sample=False, top_k=1
+    )
+    new_tokens = outputs[0][inputs["input_ids"].shape[1] :]
+    latency = time.perf_counter() - start
+    return {
+        "image": os.path.basename(image_path),
+        "response": tokenizer.decode(new_tokens, skip_special_tokens=True),
+        "latency": latency,
+        "tokens": len(new_tokens),
+    }
+
+
+def summarize(results: List[Dict], reference: Optional[List[Dict]]) -> Dict:
+    latencies = [r["latency"] for r in results]
+    parsed = [parse_operation(r["response"]) for r in results]
+    summary = {
+        "latency_mean": statistics.mean(latencies),
+        "latency_p50": statistics.median(latencies),
+        "latency_max": max(latencies),
+        "tokens_per_s": sum(r["tokens"] for r in results) / sum(latencies),
+        "parse_rate": sum(op is not None for op, _ in parsed) / len(parsed),
+    }
+    if reference is not None:
+        reference_parsed = [parse_operation(r["response"]) for r in reference]
+        matches = [op == ref_op for (op, _), (ref_op, _) in zip(parsed, reference_parsed)]
+        ious = [
+            box_iou(box, ref_box)
+            for (_, box), (_, ref_box) in zip(parsed, reference_parsed)
+            if box and ref_box
+        ]
+        summary["op_match"] = sum(matches) / len(matches)
+        summary["box_iou"] = statistics.mean(ious) if ious else None
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CogAgent inference backends")
+    parser.add_argument("--model_path", required=True, help="Path or name of the CogAgent model")
+    parser.add_argument("--screenshots", required=True, help="Directory with screenshots")
+    parser.add_argument("--task", default="Open the settings", help="Task used without tasks.jsonl")
+    parser.add_argument("--backends", default="default,int8,int4,cpu", help="Comma separated backends")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="Threads of the CPU backends")
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--platform", default="WIN")
+    parser.add_argument("--format", default="(Answer in Action-Operation-Sensitive format.)")
+    parser.add_argument("--output", default=None, help="Write all responses and metrics to this JSON file")
+    args = parser.parse_args()
+
+    backends = args.backends.split(",")
+    for backend in backends:
+        if backend not in BACKENDS:
+            parser.error(f"Unknown backend {backend}. Available backends: {BACKENDS}")
+    # The default backend is the quality reference, so it runs first
+    if "default" in backends:
+        backends.remove("default")
+        backends.insert(0, "default")
+
+    samples = load_samples(args.screenshots, args.task)
+    report = {}
+    reference = None
+    for backend in backends:
+        start = time.perf_counter()
+        try:
+            tokenizer, model = load_model(
+                args.model_path,
+                backend=backend,
+                model_class=AutoModel,
+                cpu_threads=args.cpu_threads,
+                encode_special_tokens=True,
+            )
+        except Exception as e:
+            print(f"Skipping {backend}: {e}")
+            continue
+        load_time = time.perf_counter() - start
+
+        # One untimed sample absorbs kernel compilation and allocator growth
+        run_sample(model, tokenizer, *samples[0], args)
+        results = [run_sample(model, tokenizer, image, task, args) for image, task in samples]
+        if backend == "default":
+            reference = results
+
+        summary = summarize(results, reference if backend != "default" else None)
+        summary["load_time"] = load_time
+        report[backend] = {"summary": summary, "results": results}
+
+        del model, tokenizer
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+    print(f"{'backend':<10} {'load s':>8} {'mean s':>8} {'p50 s':>8} {'tok/s':>8} {'parse':>6} {'op':>6} {'iou':>6}")
+    for backend, entry in report.items():
+        s = entry["summary"]
+        fmt = lambda v: f"{v:.2f}" if isinstance(v, float) else "-"
+        print(
+            f"{backend:<10} {s['load_time']:>8.1f} {s['latency_mean']:>8.2f} {s['latency_p50']:>8.2f} "
+            f"{s['tokens_per_s']:>8.1f} {s['parse_rate']:>6.2f} {fmt(s.get('op_match')):>6} {fmt(s.get('box_iou')):>6}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
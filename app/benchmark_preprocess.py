@@ -0,0 +1,96 @@
+"""
+This script compares the per-image PIL preprocessing of the chat template (resize, ToTensor,
+Normalize) with the batched preprocessing of image_preprocess.py.
+
+It reports the time per image of both paths and the mean absolute difference of their
+results, on screenshots from a directory or on synthetic ones:
+python benchmark_preprocess.py --screenshots ./screens --batch_size 8 --device cpu
+"""
+
+import argparse
+import os
+import statistics
+import time
+from typing import List
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+
+from image_preprocess import DEFAULT_IMAGE_SIZE, IMAGE_MEAN, IMAGE_STD, preprocess_batch
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+
+def load_images(directory: str, count: int, size: str) -> List[Image.Image]:
+    if directory:
+        names = sorted(f for f in os.listdir(directory) if f.lower().endswith(IMAGE_EXTENSIONS))
+        return [Image.open(os.path.join(directory, name)).convert("RGB") for name in names[:count]]
+    width, height = (int(x) for x in size.lower().split("x"))
+    images = []
+    for i in range(count):
+        image = Image.new("RGB", (width, height), (240, 240, 240))
+        draw = ImageDraw.Draw(image)
+        draw.rectangle([0, 0, width, height // 20], fill=(200, 200, 210))
+        draw.rectangle([width // 4 + i * 10, height // 3, width // 2, height // 2], outline="black")
+        draw.text((width // 3, height // 4), f"Window {i}", fill="black")
+        images.append(image)
+    return images
+
+
+def pil_preprocess(image: Image.Image, size: int) -> torch.Tensor:
+    """What the template does per image: PIL bicubic resize, then ToTensor and Normalize."""
+    resized = image.resize((size, size), Image.BICUBIC)
+    pixels = torch.from_numpy(np.asarray(resized, dtype=np.float32) / 255.0).permute(2, 0, 1)
+    mean = torch.tensor(IMAGE_MEAN).view(3, 1, 1)
+    std = torch.tensor(IMAGE_STD).view(3, 1, 1)
+    return ((pixels - mean) / std).unsqueeze(0)
+
+
+def timed(function, repeats: int) -> List[float]:
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        function()
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CogAgent image preprocessing")
+    parser.add_argument("--screenshots", default=None, help="Directory with screenshots (default: synthetic)")
+    parser.add_argument("--size", default="1920x1080", help="Size of the synthetic screenshots")
+    parser.add_argument("--image_size", type=int, default=DEFAULT_IMAGE_SIZE, help="Side length of the model's images")
+    parser.add_argument("--batch_size", type=int, default=8, help="Images preprocessed together")
+    parser.add_argument("--device", default="cpu", help="Device of the batched path (cpu or cuda)")
+    parser.add_argument("--threads", type=int, default=None, help="Intra-op threads of the batched path on CPU")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    images = load_images(args.screenshots, args.batch_size, args.size)
+    device = torch.device(args.device)
+    pin_memory = device.type == "cuda"
+
+    reference = [pil_preprocess(image, args.image_size) for image in images]
+    batched = preprocess_batch(images, args.image_size, device, pin_memory)
+    difference = statistics.mean(
+        (a.cpu() - b).abs().mean().item() for a, b in zip(batched, reference)
+    )
+
+    pil_times = timed(lambda: [pil_preprocess(image, args.image_size) for image in images], args.repeats)
+    batched_times = timed(lambda: preprocess_batch(images, args.image_size, device, pin_memory), args.repeats)
+
+    per_image = lambda times: statistics.median(times) / len(images) * 1000
+    print(f"{len(images)} images of {images[0].size} -> {args.image_size}x{args.image_size}")
+    print(f"PIL per image:     {per_image(pil_times):8.2f} ms")
+    print(f"Batched ({args.device}):     {per_image(batched_times):8.2f} ms")
+    print(f"Speedup:           {statistics.median(pil_times) / statistics.median(batched_times):8.2f}x")
+    print(f"Mean abs difference: {difference:.4f} (normalized units)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+This script measures vision token pruning (see token_pruning.py) on recorded screenshots:
+prefill latency, end-to-end latency and how often the grounded operation still matches the
+unpruned model, for a list of pruning ratios.
+
+Screenshots and tasks are read like in benchmark_backends.py (a tasks.jsonl file in the
+directory, or --task for all images), e.g. the screenshots cached by the web UI:
+python benchmark_pruning.py --model_path THUDM/cogagent-9b-20241220 --screenshots ./screens --ratios 0.25,0.5,0.75
+"""
+
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Dict, List
+
+import torch
+from PIL import Image
+from transformers import AutoModel
+
+from benchmark_backends import load_samples, summarize
+from model_backend import BACKENDS, load_model
+from token_pruning import PRUNING_MODES, VisionTokenPruner
+
+
+@torch.inference_mode()
+def run_sample(model, tokenizer, image_path: str, task: str, args) -> Dict:
+    query = f"Task: {task}\nHistory steps: \n(Platform: {args.platform})\n{args.format}\n"
+    image = Image.open(image_path).convert("RGB")
+    inputs = tokenizer.apply_chat_template(
+        [{"role": "user", "image": image, "content": query}],
+        add_generation_prompt=True,
+        tokenize=True,
+        return_tensors="pt",
+        return_dict=True,
+    ).to(model.device)
+
+    # One new token: vision tower plus prefill
+    start = time.perf_counter()
+    model.generate(**inputs, max_new_tokens=1, do_sample=False, top_k=1)
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    prefill = time.perf_counter() - start
+
+    start = time.perf_counter()
+    outputs = model.generate(**inputs, max_new_tokens=args.max_new_tokens, do_sample=False, top_k=1)
+    new_tokens = outputs[0][inputs["input_ids"].shape[1] :]
+    latency = time.perf_counter() - start
+    return {
+        "image": os.path.basename(image_path),
+        "response": tokenizer.decode(new_tokens, skip_special_tokens=True),
+        "prefill": prefill,
+        "latency": latency,
+        "tokens": len(new_tokens),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark CogAgent vision token pruning")
+    parser.add_argument("--model_path", required=True, help="Path or name of the CogAgent model")
+    parser.add_argument("--screenshots", required=True, help="Directory with screenshots")
+    parser.add_argument("--task", default="Open the settings", help="Task used without tasks.jsonl")
+    parser.add_argument("--ratios", default="0.25,0.5,0.75", help="Comma separated pruning ratios")
+    parser.add_argument("--mode", choices=PRUNING_MODES, default="drop")
+    parser.add_argument("--backend", choices=BACKENDS, default="default")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="Threads of the CPU backends")
+    parser.add_argument("--max_new_tokens", type=int, default=256)
+    parser.add_argument("--platform", default="WIN")
+    parser.add_argument("--format", default="(Answer in Action-Operation-Sensitive format.)")
+    parser.add_argument("--output", default=None, help="Write all responses and metrics to this JSON file")
+    args = parser.parse_args()
+
+    samples = load_samples(args.screenshots, args.task)
+    if not samples:
+        raise ValueError(f"No screenshots found in {args.screenshots}")
+
+    tokenizer, model = load_model(
+        args.model_path, backend=args.backend, model_class=AutoModel, cpu_threads=args.cpu_threads
+    )
+    # Ratio 0 first: the unpruned responses are the reference of the others
+    pruner = VisionTokenPruner(model, 0.0, args.mode)
+    ratios = [0.0] + [float(r) for r in args.ratios.split(",") if float(r) > 0]
+
+    report = {}
+    reference = None
+    for ratio in ratios:
+        pruner.set_ratio(ratio)
+        run_sample(model, tokenizer, *samples[0], args)  # warmup
+        results: List[Dict] = [run_sample(model, tokenizer, path, task, args) for path, task in samples]
+        summary = summarize(results, reference)
+        summary["prefill_p50"] = statistics.median(r["prefill"] for r in results)
+        summary["image_tokens"] = pruner.keep
+        report[f"{pruner.ratio:.3f}"] = {"summary": summary, "results": results}
+        if reference is None:
+            reference = results
+
+        line = (
+            f"ratio {pruner.ratio:.3f} ({pruner.keep} image tokens): "
+            f"prefill p50 {summary['prefill_p50'] * 1000:.0f} ms, "
+            f"latency p50 {summary['latency_p50']:.2f}s, parse rate {summary['parse_rate']:.2f}"
+        )
+        if "op_match" in summary:
+            iou = summary["box_iou"]
+            line += f", op match {summary['op_match']:.2f}"
+            line += f", box IoU {iou:.2f}" if iou is not None else ", box IoU -"
+        print(line)
+    pruner.remove()
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
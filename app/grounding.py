@@ -0,0 +1,98 @@
+"""
+Coarse-to-fine grounding for the agent client.
+
+The model resizes every screenshot to 1120x1120, so sending the full screen at native
+resolution spends most pixels on regions that do not matter, while a small screen image
+loses the detail needed for accurate boxes on small widgets. In the coarse-to-fine mode the
+client sends a downscaled screenshot first (`coarse_scale`), then crops a square region of
+the full resolution screenshot around the predicted box (`crop_scale` of the longer screen
+side, at least twice the box) and asks the model to ground the same action in the crop. The
+refined box is mapped back to full-screen coordinates and replaces the coarse one in the
+response, so history and the executor only see full-screen boxes.
+
+Every image, coarse or cropped, costs the model the same number of image tokens, so each
+refinement adds a full vision and prefill pass. Only boxes covering less than
+`max_area` of the screen (small widgets, where the coarse image lacks detail) are refined;
+larger boxes are precise enough on the coarse image.
+
+Boxes are in the model's 0-1000 coordinates relative to the image they were predicted on.
+"""
+
+import re
+from typing import List, Optional, Tuple
+
+from PIL import Image
+
+GROUNDING_MODES = ["single", "coarse_to_fine"]
+
+BOX_PATTERN = re.compile(r"box=\[\[(\d+),(\d+),(\d+),(\d+)\]\]")
+
+Region = Tuple[int, int, int, int]
+
+
+def downscale(image: Image.Image, scale: float) -> Image.Image:
+    """Screenshot resized by `scale` (<1 shrinks), unchanged for scale >= 1."""
+    if scale >= 1.0:
+        return image
+    size = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    return image.resize(size, Image.BILINEAR)
+
+
+def find_box(step: str) -> Optional[List[int]]:
+    match = BOX_PATTERN.search(step)
+    return [int(x) for x in match.groups()] if match else None
+
+
+def needs_refinement(box: List[int], max_area: float) -> bool:
+    """Whether `box` (0-1000 coordinates) covers less than `max_area` of the image."""
+    return (box[2] - box[0]) * (box[3] - box[1]) < max_area * 1000 * 1000
+
+
+def crop_region(box: List[int], size: Tuple[int, int], crop_scale: float) -> Region:
+    """
+    Square pixel region (left, top, right, bottom) of a screen of `size` centered on `box`:
+    `crop_scale` of the longer side, at least twice the box and at most the shorter side,
+    shifted to lie inside the screen.
+    """
+    width, height = size
+    x_min, y_min, x_max, y_max = (
+        box[0] * width / 1000,
+        box[1] * height / 1000,
+        box[2] * width / 1000,
+        box[3] * height / 1000,
+    )
+    side = max(crop_scale * max(width, height), 2 * (x_max - x_min), 2 * (y_max - y_min))
+    side = int(min(side, width, height))
+    left = int((x_min + x_max) / 2 - side / 2)
+    top = int((y_min + y_max) / 2 - side / 2)
+    left = min(max(left, 0), width - side)
+    top = min(max(top, 0), height - side)
+    return left, top, left + side, top + side
+
+
+def remap_box(box: List[int], region: Region, size: Tuple[int, int]) -> List[int]:
+    """Box predicted on the crop `region` -> box on the full screen of `size` (0-1000)."""
+    left, top, right, bottom = region
+    width, height = size
+    return [
+        round((left + box[0] * (right - left) / 1000) * 1000 / width),
+        round((top + box[1] * (bottom - top) / 1000) * 1000 / height),
+        round((left + box[2] * (right - left) / 1000) * 1000 / width),
+        round((top + box[3] * (bottom - top) / 1000) * 1000 / height),
+    ]
+
+
+def replace_box(step: str, box: List[int]) -> str:
+    return BOX_PATTERN.sub(f"box=[[{box[0]},{box[1]},{box[2]},{box[3]}]]", step, count=1)
+
+
+def refine_step(step: str, refined_step: Optional[str], region: Region, size: Tuple[int, int]) -> str:
+    """
+    `step` with its box replaced by the box of `refined_step` (predicted on the crop) in
+    full-screen coordinates. The coarse step is kept when the refinement has no box or a
+    different operation.
+    """
+    box = find_box(refined_step or "")
+    if box is None or step.split("(", 1)[0].strip() != refined_step.split("(", 1)[0].strip():
+        return step
+    return replace_box(step, remap_box(box, region, size))
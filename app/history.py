@@ -0,0 +1,82 @@
+"""
+History strategies for the "History steps" block of the agent prompt.
+
+Strategies:
+    full     every step, as before
+    window   only the last `window` steps; they keep their original numbers, so the model
+             still sees how many steps were taken
+    dedup    consecutive identical steps are collapsed into one line with a repeat count
+    compact  dedup, and steps older than the last `window` are reduced to the operation
+             name and the action description (no boxes or element details)
+
+With window and compact the prompt length stops growing after `window` steps (compact grows
+by a few tokens per step), so late rounds prefill about as fast as early ones.
+"""
+
+import re
+from typing import List, Optional, Sequence, Tuple
+
+HISTORY_STRATEGIES = ["full", "window", "dedup", "compact"]
+
+_OPERATION_PATTERN = re.compile(r"\s*(\w+)")
+
+
+def operation_name(step: str) -> str:
+    """"CLICK(box=[[1,2,3,4]], element_info='OK')" -> "CLICK"."""
+    match = _OPERATION_PATTERN.match(step)
+    return match.group(1) if match else step
+
+
+def select_history(
+    steps: Sequence[str],
+    actions: Optional[Sequence[str]] = None,
+    strategy: str = "full",
+    window: int = 4,
+) -> List[Tuple[int, str, Optional[str]]]:
+    """Returns the (number, step, action) lines to show; actions are None without `actions`."""
+    if strategy not in HISTORY_STRATEGIES:
+        raise ValueError(f"Unknown history strategy {strategy}. Available strategies: {HISTORY_STRATEGIES}")
+    if actions is None:
+        actions = [None] * len(steps)
+    entries = [(i, step, action) for i, (step, action) in enumerate(zip(steps, actions))]
+
+    if strategy in ("dedup", "compact"):
+        collapsed = []
+        repeats = []
+        for entry in entries:
+            if collapsed and collapsed[-1][1:] == entry[1:]:
+                repeats[-1] += 1
+            else:
+                collapsed.append(entry)
+                repeats.append(1)
+        entries = []
+        for (i, step, action), count in zip(collapsed, repeats):
+            if count > 1:
+                note = f"(repeated {count} times)"
+                if action is None:
+                    step = f"{step} {note}"
+                else:
+                    action = f"{action} {note}"
+            entries.append((i, step, action))
+
+    if strategy == "window":
+        entries = entries[-window:] if window > 0 else []
+    elif strategy == "compact":
+        cut = max(0, len(entries) - window)
+        entries = [(i, operation_name(step), action) for i, step, action in entries[:cut]] + entries[cut:]
+    return entries
+
+
+def format_history(
+    steps: Sequence[str],
+    actions: Optional[Sequence[str]] = None,
+    strategy: str = "full",
+    window: int = 4,
+) -> str:
+    """Renders the block as "\\nHistory steps: \\n0. step\\taction ..." (no tab without actions)."""
+    history_str = "\nHistory steps: "
+    for index, step, action in select_history(steps, actions, strategy, window):
+        history_str += f"\n{index}. {step}"
+        if action is not None:
+            history_str += f"\t{action}"
+    return history_str
@@ -0,0 +1,68 @@
+"""
+Content-addressed store of uploaded images, used by `openai_demo.py`.
+
+Clients upload the encoded image bytes once with `POST /v1/images` (raw body, no base64,
+no JSON) and reference them in chat messages as `{"type": "image_url", "image_url":
+{"url": "image://<id>"}}`. The id is derived from the content, so a client can compute it
+locally and skip the upload when `HEAD /v1/images/<id>` reports that the server has it.
+"""
+
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+# URL scheme of uploaded images in chat messages
+IMAGE_URL_PREFIX = "image://"
+
+
+def image_id(data: bytes) -> str:
+    return "img-" + hashlib.sha256(data).hexdigest()[:32]
+
+
+class ImageRegistry:
+    """
+    LRU of uploaded image bytes, bounded by total size.
+
+    Args:
+        max_bytes(int): Total size of the stored images; the least recently used are dropped.
+        max_image_bytes(int): Size of one image; larger ones are rejected so that a single
+            upload cannot evict the images of every other session. At most `max_bytes`.
+    """
+
+    def __init__(self, max_bytes: int = 512 * 1024 * 1024, max_image_bytes: int = 32 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_image_bytes = min(max_image_bytes, max_bytes)
+        self.total_bytes = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def put(self, data: bytes) -> str:
+        """Stores `data` and returns its id; ValueError when it exceeds `max_image_bytes`."""
+        if len(data) > self.max_image_bytes:
+            raise ValueError(f"Image of {len(data)} bytes exceeds {self.max_image_bytes} bytes")
+        key = image_id(data)
+        with self._lock:
+            if key in self._images:
+                self._images.move_to_end(key)
+                return key
+            self._images[key] = data
+            self.total_bytes += len(data)
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.total_bytes -= len(evicted)
+        return key
+
+    def get(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._images.get(key)
+            if data is not None:
+                self._images.move_to_end(key)
+            return data
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._images
+
+    def stats(self) -> dict:
+        return {"images": len(self._images), "bytes": self.total_bytes}
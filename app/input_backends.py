@@ -0,0 +1,419 @@
+"""
+Input/screen backends used by `register.ActionExecutor`.
+
+Backends:
+    pyautogui  the local desktop through pyautogui/pyperclip (Mac, Windows, Linux with a display)
+    xdotool    an X11 display such as Xvfb through the xdotool and xclip command line tools,
+               so that several agents can run side by side on a headless Linux worker
+    fake       records every event in memory and returns blank screenshots, for benchmarking
+               the executor without a desktop
+
+Start a headless display for the xdotool backend with e.g. `Xvfb :99 -screen 0 1920x1080x24 &`.
+"""
+
+import abc
+import glob
+import os
+import platform
+import re
+import shlex
+import subprocess
+import time
+from typing import Dict, List, Optional, Tuple
+
+from PIL import Image
+
+INPUT_BACKENDS = ["pyautogui", "xdotool", "fake"]
+
+
+def identify_os() -> str:
+    os_detail = platform.platform().lower()
+    if "mac" in os_detail or "darwin" in os_detail:
+        return "Mac"
+    elif "windows" in os_detail:
+        return "Win"
+    elif "linux" in os_detail:
+        return "Linux"
+    raise ValueError(f"This {os_detail} operating system is not currently supported!")
+
+
+class AppIndex:
+    """
+    Index of the installed applications used by LAUNCH, built once instead of listing the
+    application directories on every call. A lookup that misses rebuilds the index at most
+    once every `refresh_interval` seconds to pick up newly installed applications.
+
+    Entries map the application name to the command that starts it.
+    """
+
+    def __init__(self, os_name: Optional[str] = None, refresh_interval: float = 60.0):
+        self.os_name = os_name or identify_os()
+        self.refresh_interval = refresh_interval
+        self.entries: Dict[str, List[str]] = {}
+        self.built_at = 0.0
+        self.refresh()
+
+    def refresh(self):
+        scanner = {"Mac": self._scan_mac, "Linux": self._scan_linux, "Win": self._scan_windows}
+        self.entries = scanner[self.os_name]()
+        self.built_at = time.monotonic()
+
+    @staticmethod
+    def _scan_mac() -> Dict[str, List[str]]:
+        entries = {}
+        for directory in ("/System/Applications", "/Applications"):
+            for path in glob.glob(os.path.join(directory, "*.app")):
+                entries[os.path.basename(path)[: -len(".app")]] = ["open", "-a", path]
+        return entries
+
+    @staticmethod
+    def _scan_linux() -> Dict[str, List[str]]:
+        directories = [
+            "/usr/share/applications",
+            "/usr/local/share/applications",
+            os.path.expanduser("~/.local/share/applications"),
+        ]
+        entries = {}
+        for directory in directories:
+            for path in glob.glob(os.path.join(directory, "*.desktop")):
+                name = command = None
+                try:
+                    with open(path, encoding="utf-8", errors="ignore") as f:
+                        for line in f:
+                            if line.startswith("[") and line.strip() != "[Desktop Entry]":
+                                break  # Only the main section, not the desktop actions
+                            if line.startswith("Name=") and name is None:
+                                name = line[len("Name="):].strip()
+                            elif line.startswith("Exec=") and command is None:
+                                command = line[len("Exec="):].strip()
+                except OSError:
+                    continue
+                if name and command:
+                    # Drop field codes such as %U or %f
+                    command = re.sub(r"\s*%[a-zA-Z]", "", command)
+                    entries[name] = shlex.split(command)
+                    entries.setdefault(os.path.basename(path)[: -len(".desktop")], entries[name])
+        return entries
+
+    @staticmethod
+    def _scan_windows() -> Dict[str, List[str]]:
+        directories = [
+            os.path.join(os.environ.get("ProgramData", r"C:\ProgramData"), r"Microsoft\Windows\Start Menu\Programs"),
+            os.path.join(os.environ.get("APPDATA", ""), r"Microsoft\Windows\Start Menu\Programs"),
+        ]
+        entries = {}
+        for directory in directories:
+            for path in glob.glob(os.path.join(directory, "**", "*.lnk"), recursive=True):
+                name = os.path.basename(path)[: -len(".lnk")]
+                entries[name] = ["cmd", "/c", "start", "", path]
+        return entries
+
+    def _match(self, app: str) -> Optional[List[str]]:
+        app = app.lower()
+        for name, command in self.entries.items():
+            if name.lower() == app:
+                return command
+        for name, command in self.entries.items():
+            if app in name.lower():
+                return command
+        return None
+
+    def lookup(self, app: str) -> Optional[List[str]]:
+        command = self._match(app)
+        if command is None and time.monotonic() - self.built_at > self.refresh_interval:
+            self.refresh()
+            command = self._match(app)
+        return command
+
+
+class InputBackend(abc.ABC):
+    """
+    Mouse, keyboard, clipboard and screen operations used by the executor.
+    Coordinates are in the logical coordinates returned by `size`.
+    """
+
+    name = "base"
+
+    def __init__(self, pause: float = 0.1):
+        self.pause = pause
+        self._app_index = None
+
+    @property
+    def os_name(self) -> str:
+        return identify_os()
+
+    @property
+    def app_index(self) -> AppIndex:
+        if self._app_index is None:
+            self._app_index = AppIndex(self.os_name)
+        return self._app_index
+
+    @abc.abstractmethod
+    def size(self) -> Tuple[int, int]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def screenshot(self, all_screens: bool = False) -> Image.Image:
+        """
+        Captures the screen; with `all_screens` the capture covers the whole virtual desktop
+        (all monitors), whose top-left corner is the smallest monitor origin.
+        """
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def click(self, x: float, y: float, clicks: int = 1, button: str = "left"):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def move(self, x: float, y: float):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def scroll(self, amount: int):
+        """Scrolls up for positive and down for negative amounts."""
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def press(self, key: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def hotkey(self, *keys: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def write(self, text: str):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def set_clipboard(self, text: str):
+        raise NotImplementedError
+
+    def run(self, command: List[str]):
+        subprocess.Popen(command)
+
+    def launch(self, app: str) -> bool:
+        command = self.app_index.lookup(app)
+        if command is None:
+            print(f"Application {app} not found")
+            return False
+        self.run(command)
+        return True
+
+
+class PyAutoGUIBackend(InputBackend):
+    name = "pyautogui"
+
+    def __init__(self, pause: float = 0.1):
+        super().__init__(pause)
+        import pyautogui
+        import pyperclip
+
+        self.pyautogui = pyautogui
+        self.pyperclip = pyperclip
+        pyautogui.FAILSAFE = True
+        pyautogui.PAUSE = pause
+
+    def size(self):
+        return tuple(self.pyautogui.size())
+
+    def screenshot(self, all_screens=False):
+        if all_screens:
+            from PIL import ImageGrab
+
+            # pyautogui only captures the primary monitor on Windows
+            return ImageGrab.grab(all_screens=True)
+        return self.pyautogui.screenshot()
+
+    def click(self, x, y, clicks=1, button="left"):
+        self.pyautogui.click(x, y, clicks=clicks, button=button)
+
+    def move(self, x, y):
+        self.pyautogui.moveTo(x, y)
+
+    def scroll(self, amount):
+        self.pyautogui.scroll(amount)
+
+    def press(self, key):
+        self.pyautogui.press(key)
+
+    def hotkey(self, *keys):
+        self.pyautogui.hotkey(*keys)
+
+    def write(self, text):
+        self.pyautogui.write(text, interval=0)
+
+    def set_clipboard(self, text):
+        self.pyperclip.copy(text)
+
+
+class XdotoolBackend(InputBackend):
+    """
+    Drives an X11 display through xdotool (input) and xclip (clipboard); screenshots are
+    taken with Pillow's ImageGrab. Each backend targets its own display, so every agent
+    on a worker can get a private Xvfb server.
+
+    Args:
+        display(str, optional): X display such as ":99", defaults to $DISPLAY.
+        pause(float): Pause after each input event.
+    """
+
+    name = "xdotool"
+    BUTTONS = {"left": "1", "middle": "2", "right": "3"}
+    # pyautogui key names that differ from X keysyms
+    KEYS = {
+        "enter": "Return",
+        "return": "Return",
+        "esc": "Escape",
+        "escape": "Escape",
+        "tab": "Tab",
+        "backspace": "BackSpace",
+        "delete": "Delete",
+        "space": "space",
+        "up": "Up",
+        "down": "Down",
+        "left": "Left",
+        "right": "Right",
+        "home": "Home",
+        "end": "End",
+        "pageup": "Prior",
+        "pagedown": "Next",
+        "ctrl": "ctrl",
+        "alt": "alt",
+        "shift": "shift",
+        "command": "super",
+        "win": "super",
+    }
+
+    def __init__(self, display: Optional[str] = None, pause: float = 0.1):
+        super().__init__(pause)
+        self.display = display or os.environ.get("DISPLAY", ":0")
+        self.env = dict(os.environ, DISPLAY=self.display)
+
+    @property
+    def os_name(self):
+        return "Linux"
+
+    def _xdotool(self, *args: str) -> str:
+        result = subprocess.run(
+            ["xdotool", *args], env=self.env, capture_output=True, text=True, check=True
+        )
+        if self.pause:
+            time.sleep(self.pause)
+        return result.stdout
+
+    def key_name(self, key: str) -> str:
+        return self.KEYS.get(key.lower(), key)
+
+    def size(self):
+        width, height = self._xdotool("getdisplaygeometry").split()
+        return int(width), int(height)
+
+    def screenshot(self, all_screens=False):
+        from PIL import ImageGrab
+
+        # The X screen spans all monitors of the display
+        return ImageGrab.grab(xdisplay=self.display)
+
+    def click(self, x, y, clicks=1, button="left"):
+        self._xdotool(
+            "mousemove", str(int(x)), str(int(y)),
+            "click", "--repeat", str(clicks), self.BUTTONS[button],
+        )
+
+    def move(self, x, y):
+        self._xdotool("mousemove", str(int(x)), str(int(y)))
+
+    def scroll(self, amount):
+        # Buttons 4 and 5 are the scroll wheel
+        button = "4" if amount > 0 else "5"
+        self._xdotool("click", "--repeat", str(abs(amount)), button)
+
+    def press(self, key):
+        self._xdotool("key", self.key_name(key))
+
+    def hotkey(self, *keys):
+        self._xdotool("key", "+".join(self.key_name(key) for key in keys))
+
+    def write(self, text):
+        self._xdotool("type", "--delay", "0", "--", text)
+
+    def set_clipboard(self, text):
+        subprocess.run(
+            ["xclip", "-selection", "clipboard"], input=text.encode("utf-8"), env=self.env, check=True
+        )
+
+    def run(self, command):
+        subprocess.Popen(command, env=self.env)
+
+
+class FakeBackend(InputBackend):
+    """
+    Records events instead of executing them.
+
+    Args:
+        width(int), height(int): Logical screen size.
+        scale(float): Screenshot pixels per logical coordinate.
+        os_name(str): OS reported to the executor.
+        apps(Dict[str, List[str]], optional): Application index used by LAUNCH.
+    """
+
+    name = "fake"
+
+    def __init__(self, width=1920, height=1080, scale=1.0, os_name="Linux", apps=None):
+        super().__init__(pause=0.0)
+        self.width = width
+        self.height = height
+        self.scale = scale
+        self._os_name = os_name
+        self.apps = apps or {}
+        self.clipboard = ""
+        self.events: List[tuple] = []
+
+    @property
+    def os_name(self):
+        return self._os_name
+
+    def size(self):
+        return self.width, self.height
+
+    def screenshot(self, all_screens=False):
+        return Image.new(
+            "RGB", (round(self.width * self.scale), round(self.height * self.scale)), "white"
+        )
+
+    def click(self, x, y, clicks=1, button="left"):
+        self.events.append(("click", x, y, clicks, button))
+
+    def move(self, x, y):
+        self.events.append(("move", x, y))
+
+    def scroll(self, amount):
+        self.events.append(("scroll", amount))
+
+    def press(self, key):
+        self.events.append(("press", key))
+
+    def hotkey(self, *keys):
+        self.events.append(("hotkey", *keys))
+
+    def write(self, text):
+        self.events.append(("write", text))
+
+    def set_clipboard(self, text):
+        self.clipboard = text
+        self.events.append(("clipboard", text))
+
+    def launch(self, app):
+        self.events.append(("launch", app))
+        return True
+
+
+def create_backend(name: str, display: Optional[str] = None, pause: float = 0.1) -> InputBackend:
+    if name == "pyautogui":
+        return PyAutoGUIBackend(pause=pause)
+    if name == "xdotool":
+        return XdotoolBackend(display=display, pause=pause)
+    if name == "fake":
+        return FakeBackend()
+    raise ValueError(f"Unknown input backend {name}. Available backends: {INPUT_BACKENDS}")
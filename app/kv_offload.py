@@ -0,0 +1,388 @@
+"""
+Session-scoped KV cache retention for `openai_demo.py`.
+
+Between two rounds of an agent session the client executes actions and waits for the
+screen to settle, so the server is idle for that session for seconds. `SessionKVStore`
+keeps the KV cache of the session's last generation (prompt and response) in one of
+three tiers and restores it when the next round of the session (`X-Session-ID`) arrives:
+
+    device  stays on the GPU (`--session_kv_device_mb`, taken from the KV capacity)
+    host    copied to (pinned) host RAM (`--session_kv_host_mb`)
+    disk    saved to a file in `--session_kv_dir` and memory-mapped when restored
+            (`--session_kv_disk_mb`)
+
+Entries are kept in LRU order; when a tier is over its budget, its least recently used
+entries move to the next tier, and are dropped from the last one. The copies to host RAM
+(on a side CUDA stream) and the disk writes run on a background thread without holding
+the store lock, so the request that produced the cache does not wait for them.
+
+The cache is reused for the longest common token prefix of the stored sequence and the
+new prompt, if that prefix covers the image: GLM-4v places the screenshot at the start of
+the prompt, so only a round with the same screenshot (by content) can reuse it, e.g. a
+retried request or a round after an action that did not change the screen. The remaining
+prompt tokens are prefilled on top of the restored cache. The first restores are checked
+against a full prefill (same next token) and the store switches itself off on a mismatch.
+
+Sessions whose screen changes every round never reuse their cache. After `opt_out_misses`
+rounds in a row without reuse, the caches of a session are no longer retained; only the
+digest of its last screenshot is, and retention resumes once a round would have hit.
+"""
+
+import hashlib
+import os
+import queue
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import torch
+from PIL import Image
+
+TIERS = ["device", "host", "disk"]
+
+# Sessions whose hit history is kept for the opt-out
+MAX_TRACKED_SESSIONS = 4096
+
+
+def image_digest(image: Image.Image) -> str:
+    """Content hash of a decoded image."""
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def to_legacy(past) -> Tuple[tuple, Optional[type]]:
+    """Nested tuples of tensors and the cache class to rebuild (None for tuple caches)."""
+    if hasattr(past, "to_legacy_cache"):
+        return past.to_legacy_cache(), type(past)
+    return past, None
+
+
+def from_legacy(kv: tuple, cache_class: Optional[type]):
+    return cache_class.from_legacy_cache(kv) if cache_class is not None else kv
+
+
+def tree_map(function, kv):
+    if isinstance(kv, torch.Tensor):
+        return function(kv)
+    return tuple(tree_map(function, item) for item in kv)
+
+
+def tensors(kv) -> List[torch.Tensor]:
+    if isinstance(kv, torch.Tensor):
+        return [kv]
+    return [tensor for item in kv for tensor in tensors(item)]
+
+
+def sequence_dim(kv, length: int) -> Optional[int]:
+    """Dimension of the cache tensors that has `length` entries, None if it is ambiguous."""
+    dims = [dim for dim, size in enumerate(tensors(kv)[0].shape) if size == length]
+    return dims[0] if len(dims) == 1 else None
+
+
+class SessionKV:
+    """
+    KV cache of one session: `kv` covers `token_ids` (prompt and response without the
+    last sampled token), whose image placeholder occupies `offset` more cache positions.
+    """
+
+    def __init__(self, image_key: str, token_ids: List[int], kv: tuple, cache_class, seq_dim: int, offset: int):
+        self.image_key = image_key
+        self.token_ids = token_ids
+        self.kv = kv
+        self.cache_class = cache_class
+        self.seq_dim = seq_dim
+        self.offset = offset
+        self.nbytes = sum(t.numel() * t.element_size() for t in tensors(kv))
+        # Tier the entry is accounted to, and tier that holds `kv` (behind while a move is pending)
+        self.tier = "device"
+        self.stored = "device"
+        self.path = None
+
+
+class SessionKVStore:
+    """
+    Args:
+        device(str | torch.device): Device the caches are restored to.
+        device_bytes(int): Budget of caches kept on the device.
+        host_bytes(int): Budget of caches in host RAM.
+        disk_bytes(int): Budget of caches on disk, 0 disables the disk tier.
+        directory(str, optional): Directory of the disk tier (default: a temporary one).
+        verify(int): Number of restores checked against a full prefill.
+        opt_out_misses(int): Rounds in a row without reuse after which the caches of a
+            session are not retained any more, 0 always retains them.
+    """
+
+    def __init__(
+        self,
+        device,
+        device_bytes: int = 0,
+        host_bytes: int = 0,
+        disk_bytes: int = 0,
+        directory: Optional[str] = None,
+        verify: int = 2,
+        opt_out_misses: int = 3,
+    ):
+        self.device = torch.device(device)
+        self.budgets = {"device": device_bytes, "host": host_bytes, "disk": disk_bytes}
+        self.pin_memory = self.device.type == "cuda"
+        self.owns_directory = disk_bytes > 0 and directory is None
+        self.directory = tempfile.mkdtemp(prefix="session_kv_") if self.owns_directory else directory
+        if disk_bytes and directory:
+            os.makedirs(directory, exist_ok=True)
+        self.verify = verify
+        self.opt_out_misses = opt_out_misses
+        self.enabled = True
+        self.entries: "OrderedDict[str, SessionKV]" = OrderedDict()
+        # Per session: [image digest of the last round, rounds in a row without reuse]
+        self.sessions: "OrderedDict[str, list]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.reused_tokens = 0
+        self.evictions = 0
+        self.skipped = 0
+        self.verify_failures = 0
+        self.stream = torch.cuda.Stream(self.device) if self.pin_memory else None
+        self._lock = threading.Lock()
+        self._moves: "queue.Queue[Optional[Tuple[str, SessionKV, str]]]" = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def put(self, session: str, image_key: str, token_ids: List[int], past, offset: int) -> bool:
+        """
+        Retains the cache `past` returned by `generate` for `token_ids`. Returns False when
+        the layout of the cache is not understood or the session is not retained any more.
+        """
+        if not self.enabled:
+            return False
+        with self._lock:
+            state = self._track(session)
+            state[0] = image_key
+            if self.opt_out_misses and state[1] >= self.opt_out_misses:
+                # The session did not reuse its cache lately: not worth the copy
+                self.skipped += 1
+                self._drop(self.entries.pop(session, None))
+                return False
+        kv, cache_class = to_legacy(past)
+        seq_dim = sequence_dim(kv, len(token_ids) + offset)
+        if seq_dim is None:
+            return False
+        entry = SessionKV(image_key, token_ids, kv, cache_class, seq_dim, offset)
+        with self._lock:
+            self._drop(self.entries.pop(session, None))
+            self.entries[session] = entry
+            self._balance()
+        return True
+
+    def take(self, session: str, image_key: str, token_ids: List[int], boundary: int):
+        """
+        Removes the cache of `session` and returns (cache on the device, prefix length) when
+        it covers at least the first `boundary` tokens of the prompt `token_ids` with the same
+        image, otherwise None. At least the last prompt token is left to prefill.
+        """
+        if not self.enabled:
+            return None
+        with self._lock:
+            entry = self.entries.pop(session, None)
+            state = self.sessions.get(session)
+        if entry is None or entry.image_key != image_key:
+            # A session that is not retained any more is again once a round would have hit
+            would_hit = entry is None and state is not None and state[0] == image_key
+            self._miss(entry, state, would_hit)
+            return None
+        length = min(len(entry.token_ids), len(token_ids) - 1)
+        stored = torch.tensor(entry.token_ids[:length])
+        mismatch = (stored != torch.tensor(token_ids[:length])).nonzero()
+        prefix = mismatch[0, 0].item() if len(mismatch) else length
+        if prefix < boundary:
+            self._miss(entry, state)
+            return None
+
+        kv = self._load(entry)
+        kv = tree_map(lambda t: t.narrow(entry.seq_dim, 0, prefix + entry.offset).to(self.device, non_blocking=True), kv)
+        with self._lock:
+            self.hits += 1
+            self.reused_tokens += prefix
+            if state is not None:
+                state[1] = 0
+        return from_legacy(kv, entry.cache_class), prefix
+
+    def needs_verification(self) -> bool:
+        return self.verify > 0
+
+    def verified(self, ok: bool):
+        """Result of a check against a full prefill; a mismatch switches the store off."""
+        with self._lock:
+            self.verify -= 1
+            if not ok:
+                self.verify_failures += 1
+        if not ok:
+            self.disable()
+
+    def disable(self):
+        self.enabled = False
+        with self._lock:
+            for entry in self.entries.values():
+                self._drop(entry)
+            self.entries.clear()
+
+    def _track(self, session: str) -> list:
+        state = self.sessions.pop(session, None) or [None, 0]
+        self.sessions[session] = state
+        while len(self.sessions) > MAX_TRACKED_SESSIONS:
+            self.sessions.popitem(last=False)
+        return state
+
+    def _miss(self, entry: Optional[SessionKV], state: Optional[list], would_hit: bool = False):
+        self._drop(entry)
+        with self._lock:
+            self.misses += 1
+            if state is not None:
+                state[1] = 0 if would_hit else state[1] + 1
+
+    def _load(self, entry: SessionKV) -> tuple:
+        if entry.stored == "disk":
+            kv = torch.load(entry.path, mmap=True, weights_only=True)
+            os.remove(entry.path)
+            return kv
+        return entry.kv
+
+    def _balance(self):
+        """Moves least recently used entries down the tiers until every tier fits its budget."""
+        for index, tier in enumerate(TIERS):
+            used = sum(e.nbytes for e in self.entries.values() if e.tier == tier)
+            for session, entry in list(self.entries.items()):
+                if used <= self.budgets[tier]:
+                    break
+                if entry.tier != tier:
+                    continue
+                used -= entry.nbytes
+                # The next tier that can hold the entry at all
+                lower = next((t for t in TIERS[index + 1 :] if self.budgets[t] >= entry.nbytes), None)
+                if lower is not None:
+                    # Accounted to the lower tier now, copied by the background thread
+                    entry.tier = lower
+                    self._moves.put((session, entry, lower))
+                else:
+                    self._drop(self.entries.pop(session))
+                    self.evictions += 1
+
+    @torch.no_grad()
+    def _run(self):
+        while True:
+            move = self._moves.get()
+            if move is None:
+                return
+            session, entry, tier = move
+            with self._lock:
+                if self.entries.get(session) is not entry:
+                    continue
+            try:
+                kv, path = self._demote(entry, tier)
+            except Exception as e:
+                print(f"Session KV cache dropped: {e}")
+                kv = path = None
+            with self._lock:
+                current = self.entries.get(session) is entry
+                if current and (kv is not None or path is not None):
+                    entry.kv, entry.path, entry.stored = kv, path, tier
+                elif current:
+                    self.entries.pop(session)
+                    self.evictions += 1
+            # Taken, replaced or dropped while it was copied
+            if not current and path is not None:
+                os.remove(path)
+
+    def _demote(self, entry: SessionKV, tier: str) -> Tuple[Optional[tuple], Optional[str]]:
+        """Copy of the cache of `entry` in `tier`: (tensors in host RAM, None) or (None, file)."""
+        if tier == "host":
+            if self.stream is None:
+                return tree_map(lambda t: t.to("cpu"), entry.kv), None
+            # After the generation that produced the cache, on a side stream
+            self.stream.wait_stream(torch.cuda.default_stream(self.device))
+            with torch.cuda.stream(self.stream):
+                kv = tree_map(
+                    lambda t: torch.empty(t.shape, dtype=t.dtype, pin_memory=True).copy_(t, non_blocking=True),
+                    entry.kv,
+                )
+            # Waits for these copies only, not for the decoding of other requests
+            self.stream.synchronize()
+            return kv, None
+        path = os.path.join(self.directory, f"{id(entry)}.pt")
+        torch.save(tree_map(lambda t: t.contiguous().cpu(), entry.kv), path)
+        return None, path
+
+    def _drop(self, entry: Optional[SessionKV]):
+        if entry is not None and entry.path is not None and os.path.exists(entry.path):
+            os.remove(entry.path)
+
+    def close(self):
+        self.disable()
+        self._moves.put(None)
+        if self.owns_directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            tiers = {
+                tier: {
+                    "sessions": sum(e.tier == tier for e in self.entries.values()),
+                    "bytes": sum(e.nbytes for e in self.entries.values() if e.tier == tier),
+                    "budget_bytes": self.budgets[tier],
+                }
+                for tier in TIERS
+            }
+            return {
+                "enabled": self.enabled,
+                "tiers": tiers,
+                "hits": self.hits,
+                "misses": self.misses,
+                "reused_tokens": self.reused_tokens,
+                "evictions": self.evictions,
+                "skipped": self.skipped,
+                "opted_out_sessions": sum(
+                    bool(self.opt_out_misses) and state[1] >= self.opt_out_misses for state in self.sessions.values()
+                ),
+                "pending_moves": self._moves.qsize(),
+                "verify_failures": self.verify_failures,
+            }
+
+
+@torch.no_grad()
+def prefill_suffix(model, input_ids: torch.Tensor, past, start: int):
+    """
+    Extends `past`, which covers `input_ids[:, :start]`, by the prompt tokens up to the
+    last one; `generate` runs the last token with the extended cache.
+    """
+    end = input_ids.shape[1] - 1
+    if start >= end:
+        return past
+    position_ids = torch.arange(start, end, device=input_ids.device).unsqueeze(0)
+    outputs = model(
+        input_ids=input_ids[:, start:end],
+        position_ids=position_ids,
+        past_key_values=past,
+        use_cache=True,
+        return_dict=True,
+    )
+    return outputs.past_key_values
+
+
+@torch.no_grad()
+def matches_full_prefill(model, model_inputs, past) -> bool:
+    """True when the restored cache predicts the same next token as a full prefill."""
+    input_ids = model_inputs["input_ids"]
+    last = input_ids.shape[1] - 1
+    kv, cache_class = to_legacy(past)
+    cached = model(
+        input_ids=input_ids[:, last:],
+        position_ids=torch.tensor([[last]], device=input_ids.device),
+        # A fresh cache object, so that `past` is not extended in place
+        past_key_values=from_legacy(kv, cache_class),
+        use_cache=True,
+        return_dict=True,
+    ).logits[:, -1]
+    full = model(**model_inputs, return_dict=True).logits[:, -1]
+    return bool((cached.argmax(dim=-1) == full.argmax(dim=-1)).all())
@@ -0,0 +1,160 @@
+"""
+Memory accounting and out-of-memory handling for `openai_demo.py`.
+
+`MemoryMonitor` reports used and free memory of the inference device: CUDA memory of the
+current device, or host memory (process RSS and available RAM) for the CPU backends. An
+artificial cap (`--memory_cap_mb`) limits the memory the server may use; it is applied to
+the KV capacity at startup and checked between decoding steps, where exceeding it raises
+`MemoryCapExceeded` like a real out-of-memory error. With a CPU backend and a small cap,
+admission and OOM recovery can be exercised without a GPU.
+
+`request_memory` estimates what one request needs: the decoded screenshot on the host
+(image pixels), and the KV cache of its prompt and of its reserved output tokens.
+"""
+
+import gc
+import os
+import threading
+import time
+from typing import Dict, Optional
+
+import torch
+
+
+class MemoryCapExceeded(MemoryError):
+    """Raised when the memory in use exceeds the artificial cap."""
+
+
+class RequestTooLarge(ValueError):
+    """Raised when a request needs more memory than the server can provide (HTTP 413)."""
+
+
+def is_oom(e: BaseException) -> bool:
+    """True for CUDA and CPU allocation failures and for `MemoryCapExceeded`."""
+    if isinstance(e, MemoryError):
+        return True
+    oom_error = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_error is not None and isinstance(e, oom_error):
+        return True
+    message = str(e)
+    return isinstance(e, RuntimeError) and (
+        "out of memory" in message or "can't allocate memory" in message
+    )
+
+
+def request_memory(
+    prompt_tokens: int, output_tokens: int, image_pixels: int, kv_bytes_per_token: int
+) -> Dict[str, int]:
+    """
+    Bytes one request needs: the decoded RGB screenshot on the host, and the KV cache of
+    the prompt (including image tokens) and of the reserved output tokens on the device.
+    """
+    return {
+        "image": image_pixels * 3,
+        "prompt": prompt_tokens * kv_bytes_per_token,
+        "output": output_tokens * kv_bytes_per_token,
+    }
+
+
+def _host_memory() -> Dict[str, int]:
+    """RSS of this process and available and total RAM, from psutil or /proc."""
+    try:
+        import psutil
+
+        virtual = psutil.virtual_memory()
+        return {
+            "used": psutil.Process().memory_info().rss,
+            "available": virtual.available,
+            "total": virtual.total,
+        }
+    except ImportError:
+        pass
+    page_size = os.sysconf("SC_PAGE_SIZE")
+    with open("/proc/self/statm") as f:
+        used = int(f.read().split()[1]) * page_size
+    info = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            info[key] = int(value.split()[0]) * 1024
+    return {"used": used, "available": info.get("MemAvailable", 0), "total": info.get("MemTotal", 0)}
+
+
+class MemoryMonitor:
+    """
+    Args:
+        device(str): "cuda" or "cpu".
+        cap_bytes(int, optional): Memory the server may use at most; None uses the device.
+        check_interval(float): Seconds between two reads of the memory in use by `check`,
+            which runs after every decoding step (host memory is read from /proc).
+    """
+
+    def __init__(self, device: str = "cuda", cap_bytes: Optional[int] = None, check_interval: float = 0.1):
+        self.device = device if device == "cpu" or torch.cuda.is_available() else "cpu"
+        self.cap_bytes = cap_bytes
+        self.check_interval = check_interval
+        self.oom_count = 0
+        self.cap_exceeded = 0
+        self._last_check = 0.0
+        self._lock = threading.Lock()
+
+    def used(self) -> int:
+        if self.device == "cuda":
+            return torch.cuda.memory_allocated()
+        return _host_memory()["used"]
+
+    def free(self) -> int:
+        """Free memory of the device, limited by what is left of the cap."""
+        if self.device == "cuda":
+            free, _ = torch.cuda.mem_get_info()
+            used = torch.cuda.memory_allocated()
+        else:
+            host = _host_memory()
+            free, used = host["available"], host["used"]
+        if self.cap_bytes is not None:
+            free = min(free, max(0, self.cap_bytes - used))
+        return free
+
+    def host_available(self) -> int:
+        return _host_memory()["available"]
+
+    def check(self):
+        """
+        Raises MemoryCapExceeded when the memory in use exceeds the cap. The memory is read
+        at most once per `check_interval`.
+        """
+        if self.cap_bytes is None:
+            return
+        now = time.monotonic()
+        if now - self._last_check < self.check_interval:
+            return
+        self._last_check = now
+        if self.used() > self.cap_bytes:
+            with self._lock:
+                self.cap_exceeded += 1
+            raise MemoryCapExceeded(
+                f"Memory in use exceeds the cap of {self.cap_bytes // (1024 * 1024)} MB"
+            )
+
+    def recover(self):
+        """Frees cached memory after an out-of-memory error."""
+        with self._lock:
+            self.oom_count += 1
+        gc.collect()
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
+
+    def stats(self) -> dict:
+        stats = {
+            "device": self.device,
+            "cap_bytes": self.cap_bytes,
+            "used_bytes": self.used(),
+            "free_bytes": self.free(),
+            "oom_count": self.oom_count,
+            "cap_exceeded": self.cap_exceeded,
+        }
+        if self.device == "cuda":
+            stats["reserved_bytes"] = torch.cuda.memory_reserved()
+            stats["peak_bytes"] = torch.cuda.max_memory_allocated()
+        return stats
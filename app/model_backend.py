@@ -0,0 +1,132 @@
+"""
+Model loading backends shared by `openai_demo.py` and `inference/webui/app.py`.
+
+Backends:
+    default   full precision weights (bf16/fp16) on the available GPUs
+    int8      8-bit weight quantization with bitsandbytes (GPU)
+    int4      4-bit NF4 weight quantization with bitsandbytes (GPU)
+    cpu       CPU inference with bf16 (when supported) or fp32 weights and SDPA attention
+    cpu-int8  CPU inference with dynamic int8 quantization of all linear layers
+
+Use `benchmark_backends.py` to compare latency and parse quality against `default`.
+"""
+
+import os
+from typing import Optional, Tuple
+
+import torch
+from transformers import AutoModel, AutoTokenizer
+
+BACKENDS = ["default", "int8", "int4", "cpu", "cpu-int8"]
+
+# Backends whose weights can be written back with `save_pretrained`
+SERIALIZABLE_BACKENDS = {"default", "cpu"}
+
+
+def default_dtype() -> torch.dtype:
+    """bf16 on GPUs that support it, fp16 otherwise."""
+    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8:
+        return torch.bfloat16
+    return torch.float16
+
+
+def cpu_dtype() -> torch.dtype:
+    """bf16 when the CPU has native bf16 instructions, fp32 otherwise."""
+    is_bf16_supported = getattr(torch.backends.mkldnn, "is_bf16_supported", None)
+    if is_bf16_supported is not None and is_bf16_supported():
+        return torch.bfloat16
+    return torch.float32
+
+
+def compute_dtype(model) -> torch.dtype:
+    """
+    Dtype of the activations and KV caches of a loaded model: the dtype of its first
+    floating point parameter (quantized layers keep their weights in integer types).
+    """
+    for parameter in model.parameters():
+        if parameter.is_floating_point():
+            return parameter.dtype
+    return torch.float32
+
+
+def configure_cpu(threads: Optional[int]):
+    """Pins the number of intra-op threads used for CPU inference."""
+    threads = threads or os.cpu_count()
+    torch.set_num_threads(threads)
+    os.environ.setdefault("OMP_NUM_THREADS", str(threads))
+
+
+def load_model(
+    source: str,
+    backend: str = "default",
+    model_class=AutoModel,
+    torch_dtype: Optional[torch.dtype] = None,
+    cpu_threads: Optional[int] = None,
+    **tokenizer_kwargs,
+) -> Tuple[AutoTokenizer, torch.nn.Module]:
+    """
+    Loads the tokenizer and the model for the given backend.
+
+    Args:
+        source(str): Path or name of the model.
+        backend(str): One of `BACKENDS`.
+        model_class: The auto class used to load the model.
+        torch_dtype(torch.dtype, optional): dtype of the GPU backends, see `default_dtype`.
+        cpu_threads(int, optional): Number of threads of the CPU backends.
+        tokenizer_kwargs: Extra arguments for `AutoTokenizer.from_pretrained`.
+    Returns:
+        A tuple (tokenizer, model) with the model in eval mode.
+    """
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown backend {backend}. Available backends: {BACKENDS}")
+
+    tokenizer = AutoTokenizer.from_pretrained(
+        source, trust_remote_code=True, **tokenizer_kwargs
+    )
+    torch_dtype = torch_dtype or default_dtype()
+    kwargs = dict(trust_remote_code=True, low_cpu_mem_usage=True)
+
+    if backend in ("int8", "int4"):
+        if not torch.cuda.is_available():
+            raise ValueError(f"The {backend} backend requires a CUDA device, use cpu-int8 instead")
+        from transformers import BitsAndBytesConfig
+
+        if backend == "int8":
+            quantization_config = BitsAndBytesConfig(load_in_8bit=True)
+        else:
+            quantization_config = BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_use_double_quant=True,
+                bnb_4bit_compute_dtype=torch_dtype,
+            )
+        model = model_class.from_pretrained(
+            source,
+            torch_dtype=torch_dtype,
+            device_map="auto",
+            quantization_config=quantization_config,
+            **kwargs,
+        )
+    elif backend in ("cpu", "cpu-int8"):
+        configure_cpu(cpu_threads)
+        # Dynamic quantization works on fp32 linear layers
+        dtype = torch.float32 if backend == "cpu-int8" else cpu_dtype()
+        try:
+            model = model_class.from_pretrained(
+                source, torch_dtype=dtype, device_map="cpu", attn_implementation="sdpa", **kwargs
+            )
+        except (TypeError, ValueError):
+            # Remote model code without SDPA support
+            model = model_class.from_pretrained(
+                source, torch_dtype=dtype, device_map="cpu", **kwargs
+            )
+        if backend == "cpu-int8":
+            model = torch.ao.quantization.quantize_dynamic(
+                model, {torch.nn.Linear}, dtype=torch.qint8
+            )
+    else:
+        model = model_class.from_pretrained(
+            source, torch_dtype=torch_dtype, device_map="auto", **kwargs
+        )
+
+    return tokenizer, model.eval()
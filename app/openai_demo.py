@@ -4,43 +4,177 @@ using the OpenAI API to interact with the model.
 
 You can specify the model path, host, and port via command-line arguments, for example:
 python openai_demo.py --model_path THUDM/cogagent-9b-20241220 --host 0.0.0.0 --port 8000
+
+With `--response_cache N`, responses to greedy requests (temperature ~0) are cached by a
+hash of the model, messages, image content and sampling parameters and replayed on repeat
+(see response_cache.py); `--response_cache_dir` keeps them across restarts.
+
+Screenshots can be sent as base64 data URLs (OpenAI compatible) or uploaded once as raw
+bytes with `POST /v1/images` and referenced as `image://<id>` (see image_registry.py),
+which avoids the base64 inflation and parsing multi-megabyte JSON strings. A client on the
+same host can also pass raw frames through shared memory (`shm://` handles, see
+shm_transport.py) when the server is started with `--allow_shm`.
+
+Requests are queued by priority class (the `X-Priority` header or `priority` field:
+interactive, normal, batch) and shared fairly between tenants (`X-Tenant-ID`, or the API
+key); see scheduler.py. A full queue answers 429 and a request that waited longer than the
+queue timeout of its class answers 503. Lower classes pause while an interactive request
+decodes and are preempted when it needs their KV memory; they resume afterwards.
+
+Memory is accounted per request (decoded image pixels, prompt and reserved output KV
+tokens, see memory.py). An out-of-memory error frees cached memory and lowers the KV
+capacity; the request is queued again when it shared the memory with others and aborted
+(503) otherwise, and `/v1/batch/completions` halves its batch size. `/metrics` exports
+memory and queue metrics; `--memory_cap_mb` caps the memory, also with a CPU backend.
+
+With `--session_kv_host_mb` (and optionally `--session_kv_device_mb` / `--session_kv_disk_mb`),
+the KV cache of a session's last round (`X-Session-ID`) is kept on the GPU, in host RAM or
+in a memory-mapped file while the agent acts, and restored for its next round when that
+round shares the screenshot and the prompt prefix (see kv_offload.py). The copies run on a
+background thread, and sessions that keep missing stop being retained.
+
+Besides `/v1/chat/completions`, `/v1/batch/completions` accepts a list of independent
+conversations ({"model": ..., "requests": [{"messages": [...]}, ...]}) and evaluates them
+with batched forwards, e.g. to score several screens or windows in one call.
 """
 
 import argparse
+import asyncio
 import gc
+import hashlib
+import os
 import threading
 import time
 import base64
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
+from functools import partial
 from typing import List, Literal, Union, Tuple, Optional
 import torch
 import uvicorn
 import requests
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
 from sse_starlette.sse import EventSourceResponse
-from transformers import AutoTokenizer, AutoModel, TextIteratorStreamer
-from PIL import Image
+from transformers import (
+    AutoTokenizer,
+    AutoModel,
+    StoppingCriteria,
+    StoppingCriteriaList,
+    TextIteratorStreamer,
+)
+from PIL import Image, ImageDraw
 from io import BytesIO
 from pathlib import Path
+from sse import ChunkTemplate, coalesce
+from model_backend import BACKENDS, SERIALIZABLE_BACKENDS, compute_dtype, default_dtype, load_model as load_backend
+from image_preprocess import ImagePreprocessor, image_size_of
+from image_registry import IMAGE_URL_PREFIX, ImageRegistry
+from kv_offload import SessionKVStore, image_digest, matches_full_prefill, prefill_suffix
+from memory import MemoryMonitor, RequestTooLarge, is_oom, request_memory
+from prompt_cache import PromptBuilder
+from shm_transport import SHM_URL_PREFIX, ShmReader
+from response_cache import GREEDY_TEMPERATURE, ResponseCache
+from scheduler import (
+    DEFAULT_MAX_QUEUE,
+    DEFAULT_PRIORITY,
+    DEFAULT_QUEUE_TIMEOUTS,
+    DEFAULT_TENANT,
+    PRIORITIES,
+    KVScheduler,
+    QueueFullError,
+    Reservation,
+    capacity_from_memory,
+    image_token_count,
+    kv_bytes_per_token,
+    parse_class_values,
+)
+from token_budget import budget_for_format
+from token_pruning import PRUNING_MODES, VisionTokenPruner, install_pruner
+
+# Token coalescing for streamed responses, configurable from the command line
+STREAM_FLUSH_TOKENS = 8
+STREAM_FLUSH_MS = 40.0
+
+# Max number of items of a batch request that go through one batched forward
+MAX_BATCH_SIZE = 8
+
+# Opt-in cache of deterministic responses, created from the command line
+RESPONSE_CACHE: Optional[ResponseCache] = None
+
+# KV memory admission control with priority classes; the capacity is set once the model
+# is loaded, queue limits and tenant weights from the command line
+SCHEDULER = KVScheduler()
+# Threads that wait for admission and iterate running generations. Waiting requests block
+# a thread each, so the pool holds a thread for every request that may wait plus
+# `RUNNING_THREADS` for admitted ones (threads are started on demand); in the server's
+# shared threadpool the waiters would take every thread and stall the running streams
+# that release memory.
+RUNNING_THREADS = 256
+REQUEST_POOL = ThreadPoolExecutor(
+    max_workers=SCHEDULER.max_waiting() + RUNNING_THREADS, thread_name_prefix="request"
+)
+PRIORITY_HEADER = "X-Priority"
+TENANT_HEADER = "X-Tenant-ID"
+# Tokens an image adds to the sequence, and the context length of the model
+IMAGE_TOKENS = 0
+CONTEXT_LENGTH: Optional[int] = None
+KV_BYTES_PER_TOKEN = 0
+
+# Used and free memory of the inference device, with the optional --memory_cap_mb
+MEMORY = MemoryMonitor()
+# Larger images are rejected (413) before they are decoded
+MAX_IMAGE_PIXELS = 7680 * 4320
+
+# Images uploaded with POST /v1/images, resized from the command line
+IMAGE_REGISTRY = ImageRegistry()
+
+# Reader of shared-memory frames, only with --allow_shm
+SHM_READER: Optional[ShmReader] = None
+
+# Cached tokenization of prompts (see prompt_cache.py), created with the tokenizer
+PROMPT_BUILDER: Optional[PromptBuilder] = None
+
+# Batched image preprocessing on the model device (see image_preprocess.py), used by
+# PROMPT_BUILDER
+IMAGE_PREPROCESSOR: Optional[ImagePreprocessor] = None
+
+# Drops image tokens of flat screen regions before the language model (--prune_ratio)
+TOKEN_PRUNER: Optional[VisionTokenPruner] = None
+
+# KV caches of idle agent sessions (see kv_offload.py), created with the model
+SESSION_KV: Optional[SessionKVStore] = None
+SESSION_HEADER = "X-Session-ID"
 
 # Determine the appropriate torch dtype based on the GPU capabilities
-TORCH_TYPE = (
-    torch.bfloat16
-    if torch.cuda.is_available() and torch.cuda.get_device_capability()[0] >= 8
-    else torch.float16
-)
+TORCH_TYPE = default_dtype()
+
+# The model is loaded in the background after the port is bound (see `load_model`).
+# `/health` reports liveness immediately, `/ready` only once loading and warmup are done.
+model = None
+tokenizer = None
+server_args = None
+model_status = "loading"
+model_ready = threading.Event()
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """
     An asynchronous context manager for managing the lifecycle of the FastAPI app.
-    It ensures that GPU memory is cleared after the app's lifecycle ends, which is essential
-    for efficient resource management in GPU environments.
+    It starts loading the model in a background thread, so the server answers health
+    checks while the weights are loaded, and ensures that GPU memory is cleared after
+    the app's lifecycle ends, which is essential for efficient resource management in
+    GPU environments.
     """
+    if server_args is not None:
+        threading.Thread(target=load_model, args=(server_args,), daemon=True).start()
     yield
+    REQUEST_POOL.shutdown(wait=False)
+    if SESSION_KV is not None:
+        SESSION_KV.close()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
@@ -112,14 +246,23 @@ class DeltaMessage(BaseModel):
     content: Optional[str] = None
 
 
+class StreamOptions(BaseModel):
+    include_usage: Optional[bool] = False
+
+
 class ChatCompletionRequest(BaseModel):
     model: str
     messages: List[ChatMessageInput]
     temperature: Optional[float] = 0.8
     top_p: Optional[float] = 0.8
     max_tokens: Optional[int] = None
+    # Same meaning as max_tokens (new tokens, not total length); takes precedence
+    max_new_tokens: Optional[int] = None
     stream: Optional[bool] = False
+    stream_options: Optional[StreamOptions] = None
     repetition_penalty: Optional[float] = 1.0
+    # interactive, normal or batch; the X-Priority header takes precedence
+    priority: Optional[str] = None
 
 
 class ChatCompletionResponseChoice(BaseModel):
@@ -136,6 +279,10 @@ class UsageInfo(BaseModel):
     prompt_tokens: int = 0
     total_tokens: int = 0
     completion_tokens: Optional[int] = 0
+    # Image tokens the model prefilled (after pruning), whatever the size of the sent image
+    image_tokens: Optional[int] = 0
+    # Server-side milliseconds by phase, see `server_timing`
+    timings: Optional[dict] = None
 
 
 class ChatCompletionResponse(BaseModel):
@@ -148,6 +295,118 @@ class ChatCompletionResponse(BaseModel):
     usage: Optional[UsageInfo] = None
 
 
+class BatchItem(BaseModel):
+    messages: List[ChatMessageInput]
+
+
+class BatchCompletionRequest(BaseModel):
+    """
+    Several independent (task, screenshot) conversations evaluated in one call.
+    Sampling parameters are shared by all items.
+    """
+
+    model: str
+    requests: List[BatchItem]
+    temperature: Optional[float] = 0.8
+    top_p: Optional[float] = 0.8
+    max_tokens: Optional[int] = None
+    max_new_tokens: Optional[int] = None
+    repetition_penalty: Optional[float] = 1.0
+    # Batch requests default to the batch class
+    priority: Optional[str] = None
+
+
+class BatchCompletionResponse(BaseModel):
+    model: str
+    object: Literal["batch.completion"] = "batch.completion"
+    choices: List[ChatCompletionResponseChoice]
+    created: Optional[int] = Field(default_factory=lambda: int(time.time()))
+    usage: Optional[UsageInfo] = None
+
+
+@app.get("/health")
+async def health():
+    """Liveness probe: the process is up and serving HTTP."""
+    status = {"status": "ok", "model": model_status}
+    status["scheduler"] = SCHEDULER.stats()
+    status["memory"] = MEMORY.stats()
+    status["images"] = IMAGE_REGISTRY.stats()
+    if PROMPT_BUILDER is not None:
+        status["prompt_cache"] = PROMPT_BUILDER.stats()
+    if IMAGE_PREPROCESSOR is not None:
+        status["image_preprocess"] = IMAGE_PREPROCESSOR.stats()
+    if TOKEN_PRUNER is not None:
+        status["token_pruning"] = TOKEN_PRUNER.stats()
+    if SESSION_KV is not None:
+        status["session_kv"] = SESSION_KV.stats()
+    if RESPONSE_CACHE is not None:
+        status["response_cache"] = RESPONSE_CACHE.stats()
+    return status
+
+
+@app.get("/ready")
+async def ready():
+    """Readiness probe: the model is loaded and warmed up."""
+    if not model_ready.is_set():
+        raise HTTPException(status_code=503, detail=model_status)
+    return {"status": "ready"}
+
+
+@app.get("/metrics")
+async def metrics():
+    """Memory, KV capacity and queue metrics in the Prometheus text format."""
+    memory = MEMORY.stats()
+    scheduler = SCHEDULER.stats()
+    lines = []
+
+    def metric(name: str, kind: str, description: str, samples: List[Tuple[str, float]]):
+        lines.append(f"# HELP cogagent_{name} {description}")
+        lines.append(f"# TYPE cogagent_{name} {kind}")
+        for labels, value in samples:
+            lines.append(f"cogagent_{name}{labels} {value}")
+
+    metric("memory_used_bytes", "gauge", "Memory in use on the inference device", [("", memory["used_bytes"])])
+    metric("memory_free_bytes", "gauge", "Free memory, limited by the cap", [("", memory["free_bytes"])])
+    if memory["cap_bytes"] is not None:
+        metric("memory_cap_bytes", "gauge", "Artificial memory cap", [("", memory["cap_bytes"])])
+    if "peak_bytes" in memory:
+        metric("memory_reserved_bytes", "gauge", "Memory held by the CUDA caching allocator", [("", memory["reserved_bytes"])])
+        metric("memory_peak_bytes", "gauge", "Peak allocated memory since the last OOM", [("", memory["peak_bytes"])])
+    metric("oom_total", "counter", "Out-of-memory errors recovered from", [("", memory["oom_count"])])
+    metric("memory_cap_exceeded_total", "counter", "Decoding steps that exceeded the memory cap", [("", memory["cap_exceeded"])])
+    if scheduler["capacity_tokens"] is not None:
+        metric("kv_capacity_tokens", "gauge", "KV cache tokens that may be reserved", [("", scheduler["capacity_tokens"])])
+    metric("kv_reserved_tokens", "gauge", "KV cache tokens reserved by running requests", [("", scheduler["reserved_tokens"])])
+    metric(
+        "request_memory_bytes",
+        "gauge",
+        "Estimated memory of running requests by kind",
+        [(f'{{kind="{kind}"}}', size) for kind, size in sorted(scheduler["memory_bytes"].items())],
+    )
+    for state in ("running", "waiting"):
+        metric(
+            f"requests_{state}",
+            "gauge",
+            f"Requests {state} per priority class",
+            [(f'{{priority="{priority}"}}', counts[state]) for priority, counts in scheduler["classes"].items()],
+        )
+    metric("preemptions_total", "counter", "Requests preempted for a higher priority class", [("", scheduler["preemptions"])])
+    metric("rejected_total", "counter", "Requests rejected because their queue was full", [("", scheduler["rejected"])])
+    metric("queue_timeouts_total", "counter", "Requests that waited longer than their queue timeout", [("", scheduler["timeouts"])])
+    if SESSION_KV is not None:
+        session_kv = SESSION_KV.stats()
+        metric(
+            "session_kv_bytes",
+            "gauge",
+            "Bytes of retained session KV caches by tier",
+            [(f'{{tier="{tier}"}}', tier_stats["bytes"]) for tier, tier_stats in session_kv["tiers"].items()],
+        )
+        metric("session_kv_hits_total", "counter", "Rounds that restored the KV cache of their session", [("", session_kv["hits"])])
+        metric("session_kv_reused_tokens_total", "counter", "Prompt tokens not prefilled thanks to restored caches", [("", session_kv["reused_tokens"])])
+    metric("max_batch_size", "gauge", "Current batch size of /v1/batch/completions", [("", MAX_BATCH_SIZE)])
+    return Response("\n".join(lines) + "\n", media_type="text/plain; version=0.0.4")
+
+
 @app.get("/v1/models", response_model=ModelList)
 async def list_models():
     """
@@ -158,42 +417,251 @@ async def list_models():
     return ModelList(data=[model_card])
 
 
+@app.post("/v1/images")
+async def upload_image(request: Request):
+    """
+    Stores the raw request body (an encoded PNG/JPEG) and returns its id, to be referenced
+    in messages as `image://<id>`. Uploading the same bytes again returns the same id.
+    Bodies over `--max_upload_mb` and images over `MAX_IMAGE_PIXELS` (read from the header)
+    are rejected with 413 before they are stored, anything that is not an image with 400.
+    """
+    limit = IMAGE_REGISTRY.max_image_bytes
+    too_large = HTTPException(status_code=413, detail=f"Image exceeds {limit} bytes")
+    length = request.headers.get("content-length")
+    if length is not None and length.isdigit() and int(length) > limit:
+        raise too_large
+    data = bytearray()
+    async for chunk in request.stream():
+        data += chunk
+        if len(data) > limit:
+            raise too_large
+    if not data:
+        raise HTTPException(status_code=400, detail="Empty image")
+    data = bytes(data)
+    try:
+        size = Image.open(BytesIO(data)).size
+    except Image.DecompressionBombError as e:
+        raise HTTPException(status_code=413, detail=str(e))
+    except OSError:
+        raise HTTPException(status_code=400, detail="Not an image")
+    if MAX_IMAGE_PIXELS and size[0] * size[1] > MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=413, detail=f"Image of {size} exceeds {MAX_IMAGE_PIXELS} pixels")
+    return {"id": IMAGE_REGISTRY.put(data), "object": "image", "bytes": len(data)}
+
+
+@app.head("/v1/images/{image_id}")
+async def check_image(image_id: str):
+    """200 when the image is stored, 404 when it has to be uploaded (again)."""
+    if image_id not in IMAGE_REGISTRY:
+        raise HTTPException(status_code=404)
+    return Response()
+
+
+def image_urls(messages: List[ChatMessageInput]) -> List[str]:
+    return [
+        item.image_url.url
+        for message in messages
+        if isinstance(message.content, list)
+        for item in message.content
+        if isinstance(item, ImageUrlContent)
+    ]
+
+
+def missing_images(messages: List[ChatMessageInput]) -> List[str]:
+    """
+    Ids of `image://` references that are not (or no longer) stored, and `shm://`
+    handles that cannot be used.
+    """
+    missing = []
+    for url in image_urls(messages):
+        if url.startswith(IMAGE_URL_PREFIX):
+            if url[len(IMAGE_URL_PREFIX) :] not in IMAGE_REGISTRY:
+                missing.append(url[len(IMAGE_URL_PREFIX) :])
+        elif url.startswith(SHM_URL_PREFIX):
+            try:
+                if SHM_READER is None or not SHM_READER.valid(url):
+                    missing.append(url)
+            except (ValueError, OSError):
+                missing.append(url)
+    return missing
+
+
+def check_frame(image: Optional[Image.Image]):
+    """Raises if a shared-memory frame was overwritten while it was being preprocessed."""
+    if image is not None and "shm_handle" in image.info:
+        if not SHM_READER.valid(image.info["shm_handle"]):
+            raise ValueError(f"Shared-memory frame {image.info['shm_handle']} was overwritten")
+
+
+def request_priority(http_request: Request, priority: Optional[str], default: str) -> str:
+    """Priority class from the `X-Priority` header, the body field or the default."""
+    priority = http_request.headers.get(PRIORITY_HEADER) or priority or default
+    if priority not in PRIORITIES:
+        raise HTTPException(status_code=400, detail=f"Unknown priority {priority}. Available priorities: {PRIORITIES}")
+    return priority
+
+
+def request_tenant(http_request: Request) -> str:
+    """Tenant from the `X-Tenant-ID` header, or a hash of the API key (never the key itself)."""
+    tenant = http_request.headers.get(TENANT_HEADER)
+    if tenant:
+        return tenant
+    authorization = http_request.headers.get("Authorization", "")
+    if authorization.startswith("Bearer ") and len(authorization) > len("Bearer "):
+        return "key-" + hashlib.sha256(authorization[len("Bearer ") :].encode()).hexdigest()[:12]
+    return DEFAULT_TENANT
+
+
+def queue_error(e: Exception) -> HTTPException:
+    """
+    429 when the queue of the class is full, 413 when the request can never fit, and 503
+    when the queue timeout has passed or memory ran out.
+    """
+    if isinstance(e, QueueFullError):
+        return HTTPException(status_code=429, detail=str(e), headers={"Retry-After": "1"})
+    if isinstance(e, RequestTooLarge):
+        return HTTPException(status_code=413, detail=str(e))
+    if is_oom(e):
+        return HTTPException(status_code=503, detail=f"Out of memory: {e}", headers={"Retry-After": "5"})
+    return HTTPException(status_code=503, detail=str(e), headers={"Retry-After": "5"})
+
+
+def recover_from_oom() -> bool:
+    """
+    Frees cached memory after an out-of-memory error and lowers the KV capacity below what
+    was reserved when it happened. Returns True when other requests shared the memory, so
+    that the failed request may be queued again.
+    """
+    shared = SCHEDULER.stats()["running"] > 1
+    MEMORY.recover()
+    capacity = SCHEDULER.shrink_capacity()
+    print(f"Out of memory, KV capacity lowered to {capacity} tokens")
+    return shared
+
+
+def request_pool_size(scheduler: KVScheduler, running_threads: int = RUNNING_THREADS) -> int:
+    """Threads of `REQUEST_POOL`: every request that may wait, plus the running ones."""
+    waiting = scheduler.max_waiting()
+    if waiting is None:
+        waiting = sum(DEFAULT_MAX_QUEUE.values())
+        print(f"A priority class has no queue limit; requests beyond {waiting} waiting may stall running ones")
+    return waiting + running_threads
+
+
+async def run_in_pool(function, *args, **kwargs):
+    """Runs a blocking call (admission, generation) in `REQUEST_POOL`."""
+    return await asyncio.get_running_loop().run_in_executor(REQUEST_POOL, partial(function, *args, **kwargs))
+
+
+async def iterate_in_pool(iterator):
+    """Iterates a blocking generator (e.g. `predict`) in `REQUEST_POOL`."""
+    done = object()
+    while True:
+        item = await run_in_pool(next, iterator, done)
+        if item is done:
+            return
+        yield item
+
+
+async def admit(params: dict):
+    """
+    Starts `generate_stream_cogagent` in a worker thread and returns the stream once the
+    request is admitted, so that queueing and input errors become HTTP errors before any
+    response is sent. The wait for admission blocks a `REQUEST_POOL` thread, not one of
+    the server's shared threadpool.
+    """
+    stream = generate_stream_cogagent(model, tokenizer, params)
+    try:
+        await run_in_pool(next, stream)
+    except (QueueFullError, TimeoutError, RequestTooLarge, MemoryError) as e:
+        raise queue_error(e)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except RuntimeError as e:
+        if is_oom(e):
+            raise queue_error(e)
+        raise
+    return stream
+
+
 @app.post("/v1/chat/completions", response_model=ChatCompletionResponse)
-async def create_chat_completion(request: ChatCompletionRequest):
+async def create_chat_completion(
+    request: ChatCompletionRequest, http_request: Request, http_response: Response
+):
     """
     An endpoint to create chat completions given a set of messages and model parameters.
     Returns either a single completion or streams tokens as they are generated.
+    Greedy requests are answered from `RESPONSE_CACHE` when enabled; the `X-Cache`
+    header reports whether the response was a hit. Other requests wait in `SCHEDULER`
+    in their priority class and tenant (429/503 when the queue is full or too slow).
     """
     global model, tokenizer
 
+    if not model_ready.is_set():
+        raise HTTPException(status_code=503, detail=f"Model is not ready: {model_status}")
+
     if len(request.messages) < 1 or request.messages[-1].role == "assistant":
         raise HTTPException(status_code=400, detail="Invalid request")
 
+    missing = missing_images(request.messages)
+    if missing:
+        raise HTTPException(status_code=400, detail=f"Unknown image ids: {missing}")
+
     gen_params = dict(
         messages=request.messages,
         temperature=request.temperature,
         top_p=request.top_p,
-        max_tokens=request.max_tokens or 1024,
+        max_tokens=resolve_max_new_tokens(request.max_new_tokens, request.max_tokens, request.messages),
         echo=False,
         stream=request.stream,
         repetition_penalty=request.repetition_penalty,
+        priority=request_priority(http_request, request.priority, DEFAULT_PRIORITY),
+        tenant=request_tenant(http_request),
+        session=http_request.headers.get(SESSION_HEADER),
     )
 
+    cache_key = cached = None
+    # Shared-memory handles are not content addresses, so those requests are not cached
+    if (
+        RESPONSE_CACHE is not None
+        and RESPONSE_CACHE.eligible(gen_params)
+        and not any(url.startswith(SHM_URL_PREFIX) for url in image_urls(request.messages))
+    ):
+        # Hashing multi-MB image URLs and reading the disk tier happen in a worker thread
+        cache_key, cached = await run_in_threadpool(cache_lookup, request.model, request.messages, gen_params)
+    cache_headers = {"X-Cache": "hit" if cached else "miss"} if cache_key else None
+
     if request.stream:
         # If streaming is requested, return an EventSourceResponse that yields tokens as they are generated
-        generate = predict(request.model, gen_params)
-        return EventSourceResponse(generate, media_type="text/event-stream")
+        include_usage = bool(request.stream_options and request.stream_options.include_usage)
+        if cached:
+            generate = replay(request.model, cached, include_usage)
+        else:
+            generate = iterate_in_pool(predict(request.model, await admit(gen_params), cache_key, include_usage))
+        return EventSourceResponse(generate, media_type="text/event-stream", headers=cache_headers)
 
     # Otherwise, return a complete response after generation
-    response = generate_cogagent(model, tokenizer, gen_params)
+    if cached:
+        response = cached
+    else:
+        # In a worker thread, so that waiting for KV memory does not block the event loop
+        stream = await admit(gen_params)
+        try:
+            response = await run_in_pool(last_response, stream)
+        except MemoryError as e:
+            raise queue_error(e)
+        if cache_key:
+            RESPONSE_CACHE.put(cache_key, response)
+    if cache_headers:
+        http_response.headers.update(cache_headers)
 
-    usage = UsageInfo()
     message = ChatMessageResponse(role="assistant", content=response["text"])
     choice_data = ChatCompletionResponseChoice(index=0, message=message)
 
-    task_usage = UsageInfo.model_validate(response["usage"])
-    for usage_key, usage_value in task_usage.model_dump().items():
-        setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
+    usage = UsageInfo.model_validate(response["usage"])
+    if not cached:
+        usage.timings = response["timings"]
+        http_response.headers["Server-Timing"] = server_timing(response["timings"])
 
     return ChatCompletionResponse(
         model=request.model,
@@ -203,40 +671,277 @@ async def create_chat_completion(request: ChatCompletionRequest):
     )
 
 
-def predict(model_id: str, params: dict):
+@app.post("/v1/batch/completions", response_model=BatchCompletionResponse)
+async def create_batch_completion(request: BatchCompletionRequest, http_request: Request):
     """
-    A generator function that streams the model output tokens.
-    Used for the `stream=True` scenario, returning tokens as SSE events.
+    An endpoint that evaluates many (task, screenshot) conversations at once.
+    Items are grouped into batches of at most `MAX_BATCH_SIZE`, and each batch runs the
+    vision encoder, prefill and decoding as a single batched forward. Choices are
+    returned in the order of `requests`, with `index` pointing to the item.
     """
     global model, tokenizer
 
-    # Initially, return the role delta message
-    choice_data = ChatCompletionResponseStreamChoice(
-        index=0, delta=DeltaMessage(role="assistant")
-    )
-    chunk = ChatCompletionResponse(
-        model=model_id, choices=[choice_data], object="chat.completion.chunk"
-    )
-    yield chunk.model_dump_json(exclude_unset=True)
-
-    previous_text = ""
-    for new_response in generate_stream_cogagent(model, tokenizer, params):
-        decoded_unicode = new_response["text"]
-        delta_text = decoded_unicode[len(previous_text) :]
-        previous_text = decoded_unicode
-        delta = DeltaMessage(content=delta_text, role="assistant")
-        choice_data = ChatCompletionResponseStreamChoice(index=0, delta=delta)
-        chunk = ChatCompletionResponse(
-            model=model_id, choices=[choice_data], object="chat.completion.chunk"
+    if not model_ready.is_set():
+        raise HTTPException(status_code=503, detail=f"Model is not ready: {model_status}")
+
+    for item in request.requests:
+        if len(item.messages) < 1 or item.messages[-1].role == "assistant":
+            raise HTTPException(status_code=400, detail="Invalid request")
+        missing = missing_images(item.messages)
+        if missing:
+            raise HTTPException(status_code=400, detail=f"Unknown image ids: {missing}")
+
+    gen_params = dict(
+        temperature=request.temperature,
+        top_p=request.top_p,
+        repetition_penalty=request.repetition_penalty,
+        priority=request_priority(http_request, request.priority, "batch"),
+        tenant=request_tenant(http_request),
+    )
+
+    global MAX_BATCH_SIZE
+    choices = []
+    usage = UsageInfo()
+    start = 0
+    while start < len(request.requests):
+        items = request.requests[start : start + MAX_BATCH_SIZE]
+        # Items without a budget of their own share the largest budget of the batch
+        gen_params["max_tokens"] = max(
+            resolve_max_new_tokens(request.max_new_tokens, request.max_tokens, item.messages)
+            for item in items
         )
-        yield chunk.model_dump_json(exclude_unset=True)
+        try:
+            responses = await run_in_pool(
+                generate_batch_cogagent,
+                model,
+                tokenizer,
+                [item.messages for item in items],
+                gen_params,
+            )
+        except MemoryError as e:
+            if len(items) == 1:
+                raise queue_error(e)
+            # Smaller batches from now on, and this one is retried
+            MAX_BATCH_SIZE = max(1, len(items) // 2)
+            print(f"Out of memory with a batch of {len(items)}, batch size lowered to {MAX_BATCH_SIZE}")
+            continue
+        except (QueueFullError, TimeoutError, RequestTooLarge) as e:
+            raise queue_error(e)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        for offset, response in enumerate(responses):
+            message = ChatMessageResponse(role="assistant", content=response["text"])
+            choices.append(ChatCompletionResponseChoice(index=start + offset, message=message))
+            for usage_key, usage_value in response["usage"].items():
+                setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
+        start += len(items)
+
+    return BatchCompletionResponse(model=request.model, choices=choices, usage=usage)
+
+
+def query_text(messages: List[ChatMessageInput]) -> str:
+    """Text of the last message, which carries the task and the answer format."""
+    content = messages[-1].content
+    if isinstance(content, list):
+        return " ".join(item.text for item in content if isinstance(item, TextContent))
+    return content
+
+
+def resolve_max_new_tokens(
+    max_new_tokens: Optional[int], max_tokens: Optional[int], messages: List[ChatMessageInput]
+) -> int:
+    """
+    Number of new tokens to generate: the request's max_new_tokens or max_tokens, or
+    otherwise the budget of the answer format named in the prompt (see token_budget.py).
+    """
+    return max_new_tokens or max_tokens or budget_for_format(query_text(messages))
 
-    # End of stream message
-    choice_data = ChatCompletionResponseStreamChoice(index=0, delta=DeltaMessage())
-    chunk = ChatCompletionResponse(
-        model=model_id, choices=[choice_data], object="chat.completion.chunk"
+
+def build_inputs(
+    tokenizer: AutoTokenizer,
+    query: str,
+    image: Optional[Image.Image],
+    pixel_values: Optional[torch.Tensor] = None,
+):
+    """
+    Model inputs for one user message, through `PROMPT_BUILDER` when enabled.
+    `pixel_values` is the image already preprocessed by `IMAGE_PREPROCESSOR`.
+    """
+    if PROMPT_BUILDER is not None:
+        return PROMPT_BUILDER.build(query, image, pixel_values)
+    message = {"role": "user", "content": query}
+    if image is not None:
+        message["image"] = image
+    return tokenizer.apply_chat_template(
+        [message],
+        add_generation_prompt=True,
+        tokenize=True,
+        return_tensors="pt",
+        return_dict=True,
     )
-    yield chunk.model_dump_json(exclude_unset=True)
+
+
+class CountingStreamer(TextIteratorStreamer):
+    """
+    TextIteratorStreamer that keeps the generated token ids, so that they are counted
+    without re-encoding the text and a stopped generation can be resumed from them.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.token_ids = []
+
+    @property
+    def token_count(self) -> int:
+        return len(self.token_ids)
+
+    def put(self, value):
+        if not (self.skip_prompt and self.next_tokens_are_prompt):
+            self.token_ids.extend(value.reshape(-1).tolist())
+        super().put(value)
+
+
+class PreemptionGate(StoppingCriteria):
+    """
+    Checked by `generate` after every decoding step: waits while a higher priority class
+    is decoding and stops generation once the reservation is preempted or cancelled.
+    Raises MemoryCapExceeded when the memory in use exceeds `--memory_cap_mb`.
+    """
+
+    def __init__(self, reservation: Reservation):
+        self.reservation = reservation
+        self.stopped = False
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        MEMORY.check()
+        self.stopped = self.reservation.checkpoint()
+        return torch.full((input_ids.shape[0],), self.stopped, dtype=torch.bool, device=input_ids.device)
+
+
+def extend_inputs(inputs, new_tokens: torch.Tensor) -> dict:
+    """Inputs of a resumed generation: the prompt followed by the tokens generated so far."""
+    input_ids = torch.cat([inputs["input_ids"], new_tokens.to(inputs["input_ids"].device)], dim=1)
+    extended = dict(inputs)
+    extended["input_ids"] = input_ids
+    extended["attention_mask"] = torch.ones_like(input_ids)
+    if "position_ids" in inputs:
+        extended["position_ids"] = torch.arange(input_ids.shape[1], device=input_ids.device).unsqueeze(0)
+    return extended
+
+
+def session_inputs(model: AutoModel, model_inputs, restored) -> Optional[dict]:
+    """
+    Inputs of a generation that starts from the restored KV cache of its session (see
+    `SESSION_KV`): the prompt tokens after the reused prefix are prefilled on top of the
+    cache, and `generate` continues with the last prompt token, without the image. Returns
+    None when the check against a full prefill fails.
+    """
+    past, prefix = restored
+    input_ids = model_inputs["input_ids"]
+    past = prefill_suffix(model, input_ids, past, prefix)
+    if SESSION_KV.needs_verification():
+        ok = matches_full_prefill(model, model_inputs, past)
+        SESSION_KV.verified(ok)
+        if not ok:
+            return None
+    inputs = {
+        "input_ids": input_ids,
+        "attention_mask": torch.ones_like(input_ids),
+        "past_key_values": past,
+        "is_first_forward": False,
+    }
+    if "position_ids" in model_inputs:
+        inputs["position_ids"] = torch.arange(input_ids.shape[1], device=input_ids.device).unsqueeze(0)
+    return inputs
+
+
+def reservation(input_len: int, max_new_tokens: int, with_image: bool) -> Tuple[int, int]:
+    """
+    Returns (max_new_tokens, KV tokens to reserve) for one sequence. max_new_tokens is
+    clipped so that the sequence fits into the context of the model and, when the prompt
+    fits, into the KV capacity.
+    """
+    prompt_len = input_len + (IMAGE_TOKENS if with_image else 0)
+    if CONTEXT_LENGTH is not None:
+        max_new_tokens = max(1, min(max_new_tokens, CONTEXT_LENGTH - prompt_len))
+    capacity = SCHEDULER.capacity_tokens
+    if capacity is not None and prompt_len < capacity:
+        max_new_tokens = max(1, min(max_new_tokens, capacity - prompt_len))
+    return max_new_tokens, prompt_len + max_new_tokens
+
+
+def memory_estimate(reserved_tokens: int, max_new_tokens: int, images: List[Optional[Image.Image]]) -> dict:
+    """Bytes of one reservation by kind (see memory.request_memory)."""
+    pixels = sum(image.size[0] * image.size[1] for image in images if image is not None)
+    return request_memory(reserved_tokens - max_new_tokens, max_new_tokens, pixels, KV_BYTES_PER_TOKEN)
+
+
+def predict(
+    model_id: str, stream, cache_key: Optional[str] = None, include_usage: bool = False
+):
+    """
+    A generator function that streams the model output tokens of an admitted request
+    (the stream returned by `admit`).
+    Used for the `stream=True` scenario, returning tokens as SSE events.
+    Consecutive tokens are coalesced into one chunk (see `STREAM_FLUSH_TOKENS` and
+    `STREAM_FLUSH_MS`), and chunks are rendered from a pre-serialized template.
+    With a `cache_key`, the complete response is stored in `RESPONSE_CACHE`. With
+    `include_usage`, a final chunk reports the prompt and completion token counts.
+    """
+    template = ChunkTemplate(model_id)
+    final = {}
+
+    # Initially, return the role delta message
+    yield template.role()
+
+    def deltas():
+        previous_text = ""
+        for new_response in stream:
+            decoded_unicode = new_response["text"]
+            yield decoded_unicode[len(previous_text) :]
+            previous_text = decoded_unicode
+            final.update(new_response)
+
+    for delta_text in coalesce(deltas(), STREAM_FLUSH_TOKENS, STREAM_FLUSH_MS):
+        yield template.content(delta_text)
+
+    # Only responses that were generated to the end are cached
+    if cache_key and final:
+        RESPONSE_CACHE.put(cache_key, final)
+
+    # End of stream message
+    yield template.end()
+    if include_usage and final:
+        yield template.usage(dict(final["usage"], timings=final["timings"]))
+
+
+def cache_lookup(model_id: str, messages: List[ChatMessageInput], params: dict) -> Tuple[str, Optional[dict]]:
+    """Key of a request in `RESPONSE_CACHE` and the cached response, if any."""
+    cache_key = RESPONSE_CACHE.key(model_id, [message.model_dump() for message in messages], params)
+    return cache_key, RESPONSE_CACHE.get(cache_key)
+
+
+def server_timing(timings: dict) -> str:
+    """`Server-Timing` header value of the phase timings of a response."""
+    return ", ".join(f"{name};dur={ms}" for name, ms in timings.items())
+
+
+def replay(model_id: str, response: dict, include_usage: bool = False):
+    """Streams a cached response as one content chunk, with the same framing as `predict`."""
+    template = ChunkTemplate(model_id)
+    yield template.role()
+    if response["text"]:
+        yield template.content(response["text"])
+    yield template.end()
+    if include_usage:
+        yield template.usage(response["usage"])
+
+
+def last_response(stream) -> Optional[dict]:
+    response = None
+    for response in stream:
+        pass
+    return response
 
 
 def generate_cogagent(model: AutoModel, tokenizer: AutoTokenizer, params: dict):
@@ -245,10 +950,21 @@ def generate_cogagent(model: AutoModel, tokenizer: AutoTokenizer, params: dict):
     It processes the chat history and any provided images,
     and then invokes the model to generate a complete response.
     """
-    response = None
-    for response in generate_stream_cogagent(model, tokenizer, params):
-        pass
-    return response
+    return last_response(generate_stream_cogagent(model, tokenizer, params))
+
+
+def open_image(data: bytes) -> Image.Image:
+    """
+    Decodes an encoded image after checking its size, read from the header, against
+    `MAX_IMAGE_PIXELS` and the available host memory.
+    """
+    image = Image.open(BytesIO(data))
+    pixels = image.size[0] * image.size[1]
+    if MAX_IMAGE_PIXELS and pixels > MAX_IMAGE_PIXELS:
+        raise RequestTooLarge(f"Image of {image.size} exceeds {MAX_IMAGE_PIXELS} pixels")
+    if pixels * 3 > MEMORY.host_available():
+        raise RequestTooLarge(f"Not enough host memory to decode an image of {image.size}")
+    return image.convert("RGB")
 
 
 def process_history_and_images(
@@ -286,86 +1002,441 @@ def process_history_and_images(
             for item in content:
                 if isinstance(item, ImageUrlContent):
                     image_url = item.image_url.url
-                    if image_url.startswith("data:image/jpeg;base64,"):
+                    if image_url.startswith(SHM_URL_PREFIX):
+                        # Raw frame in shared memory, mapped without a copy
+                        if SHM_READER is None:
+                            raise ValueError("Shared-memory images require --allow_shm")
+                        image = SHM_READER.read(image_url)
+                    elif image_url.startswith(IMAGE_URL_PREFIX):
+                        # Image uploaded with POST /v1/images
+                        image_data = IMAGE_REGISTRY.get(image_url[len(IMAGE_URL_PREFIX) :])
+                        if image_data is None:
+                            raise ValueError(f"Unknown image: {image_url}")
+                        image = open_image(image_data)
+                    elif image_url.startswith("data:image/jpeg;base64,"):
                         # Base64 encoded image
                         base64_encoded_image = image_url.split(
                             "data:image/jpeg;base64,"
                         )[1]
                         image_data = base64.b64decode(base64_encoded_image)
-                        image = Image.open(BytesIO(image_data)).convert("RGB")
+                        image = open_image(image_data)
                     else:
                         # Fetch image from a remote URL
                         response = requests.get(image_url, verify=False)
-                        image = Image.open(BytesIO(response.content)).convert("RGB")
+                        image = open_image(response.content)
     return text_content, image
 
 
+@torch.inference_mode()
+def generate_batch_cogagent(
+    model: AutoModel,
+    tokenizer: AutoTokenizer,
+    conversations: List[List[ChatMessageInput]],
+    params: dict,
+) -> List[dict]:
+    """
+    Generates responses for several conversations with one batched `generate` call.
+
+    Every conversation is templated on its own, then the inputs are left-padded to a
+    common length and the images are stacked, so the vision tower and the prefill see
+    the whole batch at once. Either all conversations carry an image or none does.
+    """
+    temperature = float(params.get("temperature", 1.0))
+    top_p = float(params.get("top_p", 1.0))
+    max_new_tokens = int(params.get("max_tokens", 256))
+
+    queries, images = zip(*(process_history_and_images(messages) for messages in conversations))
+    # All images of the batch go to the preprocessor at once and are resized together
+    preprocessor = PROMPT_BUILDER.active_image_preprocessor if PROMPT_BUILDER is not None else None
+    pending = [
+        preprocessor.submit(image) if preprocessor is not None and image is not None else None
+        for image in images
+    ]
+    inputs = []
+    for query, image, future in zip(queries, images, pending):
+        inputs.append(build_inputs(tokenizer, query, image, preprocessor.result(future) if future else None))
+        check_frame(image)
+
+    with_images = ["images" in x for x in inputs]
+    if any(with_images) and not all(with_images):
+        raise ValueError("Either all batch items or none must contain an image")
+
+    pad_token_id = tokenizer.pad_token_id
+    if pad_token_id is None:
+        pad_token_id = tokenizer.eos_token_id
+    lengths = [x["input_ids"].shape[1] for x in inputs]
+    max_len = max(lengths)
+
+    def left_pad(key: str, value: int) -> torch.Tensor:
+        return torch.cat(
+            [
+                torch.nn.functional.pad(x[key], (max_len - length, 0), value=value)
+                for x, length in zip(inputs, lengths)
+            ]
+        )
+
+    batch = {
+        "input_ids": left_pad("input_ids", pad_token_id),
+        "attention_mask": left_pad("attention_mask", 0),
+    }
+    if "position_ids" in inputs[0]:
+        batch["position_ids"] = left_pad("position_ids", 0)
+    if all(with_images):
+        batch["images"] = torch.cat([x["images"] for x in inputs])
+    batch = {key: value.to(model.device) for key, value in batch.items()}
+
+    # Every row of the batch is padded to max_len and decodes up to max_new_tokens
+    max_new_tokens, row_tokens = reservation(max_len, max_new_tokens, all(with_images))
+
+    gen_kwargs = {
+        "max_new_tokens": max_new_tokens,
+        "do_sample": True if temperature > 1e-5 else False,
+        "top_p": top_p if temperature > 1e-5 else 0,
+        "top_k": 1,
+        "pad_token_id": pad_token_id,
+    }
+    if temperature > 1e-5:
+        gen_kwargs["temperature"] = temperature
+
+    with SCHEDULER.reserve(
+        row_tokens * len(inputs),
+        priority=params.get("priority", DEFAULT_PRIORITY),
+        tenant=params.get("tenant", DEFAULT_TENANT),
+        memory=memory_estimate(row_tokens * len(inputs), max_new_tokens * len(inputs), images),
+    ) as slot:
+        while True:
+            gate = PreemptionGate(slot)
+            try:
+                outputs = model.generate(**batch, **gen_kwargs, stopping_criteria=StoppingCriteriaList([gate]))
+            except Exception as e:
+                if not is_oom(e):
+                    raise
+                # The endpoint retries with smaller batches
+                recover_from_oom()
+                raise MemoryError(f"Out of memory with a batch of {len(inputs)}: {e}") from e
+            if not gate.stopped:
+                break
+            # Preempted: the batch runs again from the prompts once memory is available
+            SCHEDULER.readmit(slot)
+
+    eos_token_ids = model.generation_config.eos_token_id
+    if not isinstance(eos_token_ids, list):
+        eos_token_ids = [eos_token_ids]
+    stop_ids = set(eos_token_ids) | {pad_token_id}
+
+    responses = []
+    for row, prompt_len, image in zip(outputs[:, max_len:].tolist(), lengths, images):
+        completion_len = next((i for i, t in enumerate(row) if t in stop_ids), len(row))
+        responses.append(
+            {
+                "text": tokenizer.decode(row[:completion_len], skip_special_tokens=True),
+                "usage": {
+                    "prompt_tokens": prompt_len,
+                    "completion_tokens": completion_len,
+                    "total_tokens": prompt_len + completion_len,
+                    "image_tokens": IMAGE_TOKENS if image is not None else 0,
+                },
+            }
+        )
+    return responses
+
+
 @torch.inference_mode()
 def generate_stream_cogagent(model: AutoModel, tokenizer: AutoTokenizer, params: dict):
     """
     Streams the generation results from the model token-by-token.
     Uses TextIteratorStreamer to yield partial responses as they are generated.
+
+    The last response carries `timings`: milliseconds spent on preprocessing (image and
+    tokenization), waiting for admission, prefill (until the first token, including the
+    vision encoder) and decoding, so clients can tell server time from network time.
+
+    `max_tokens` is the number of new tokens (clipped to the context length). KV memory
+    for the prompt plus that budget is reserved in `SCHEDULER` (in the `priority` class
+    and for the `tenant` of params) before generation starts; the first response, with
+    empty text, is yielded once the request is admitted. The memory is released when the
+    generator finishes or is closed. A preempted request stops, queues again and resumes
+    by recomputing the prompt plus the tokens generated so far; so does a request that ran
+    out of memory while sharing it with others (once). Otherwise out-of-memory errors are
+    raised as MemoryError.
+
+    With `SESSION_KV` and a `session` in params, generation starts from the retained KV
+    cache of the session's previous round when it shares the image and a prompt prefix,
+    and the cache of this round is retained for the next one.
     """
     messages = params["messages"]
     temperature = float(params.get("temperature", 1.0))
     top_p = float(params.get("top_p", 1.0))
     max_new_tokens = int(params.get("max_tokens", 256))
+    start = time.perf_counter()
     query, image = process_history_and_images(messages)
 
     # Apply a chat template (assumed to be provided by the model or custom logic)
-    model_inputs = tokenizer.apply_chat_template(
-        [{"role": "user", "image": image, "content": query}],
-        add_generation_prompt=True,
-        tokenize=True,
-        return_tensors="pt",
-        return_dict=True,
-    ).to(model.device)
+    model_inputs = build_inputs(tokenizer, query, image).to(model.device)
+    check_frame(image)
+    marks = {"preprocess": time.perf_counter()}
 
     input_echo_len = len(model_inputs["input_ids"][0])
-    streamer = TextIteratorStreamer(
-        tokenizer=tokenizer, timeout=60.0, skip_prompt=True, skip_special_tokens=True
-    )
+    session = params.get("session")
+    eoi_token_id = getattr(model.config, "eoi_token_id", None)
+    image_key = None
+    if SESSION_KV is not None and SESSION_KV.enabled and session and image is not None and eoi_token_id is not None:
+        image_key = image_digest(image)
+    max_new_tokens, reserved_tokens = reservation(input_echo_len, max_new_tokens, image is not None)
     gen_kwargs = {
-        "max_length": max_new_tokens,
         "do_sample": True if temperature > 1e-5 else False,
         "top_p": top_p if temperature > 1e-5 else 0,
         "top_k": 1,
-        "streamer": streamer,
     }
     if temperature > 1e-5:
         gen_kwargs["temperature"] = temperature
+    eos_token_ids = model.generation_config.eos_token_id
+    if not isinstance(eos_token_ids, list):
+        eos_token_ids = [eos_token_ids]
 
     generated_text = ""
+    # Tokens of the segments before a preemption, and the streamer of the current one
+    done_tokens = 0
+    streamer = None
 
-    def generate_text():
-        with torch.no_grad():
-            model.generate(**model_inputs, **gen_kwargs)
-
-    generation_thread = threading.Thread(target=generate_text)
-    generation_thread.start()
-
-    total_len = input_echo_len
-    for next_text in streamer:
-        generated_text += next_text
-        total_len = len(tokenizer.encode(generated_text))
-        yield {
-            "text": generated_text,
-            "usage": {
-                "prompt_tokens": input_echo_len,
-                "completion_tokens": total_len - input_echo_len,
-                "total_tokens": total_len,
-            },
+    def usage():
+        completion_tokens = done_tokens + (streamer.token_count if streamer else 0)
+        return {
+            "prompt_tokens": input_echo_len,
+            "completion_tokens": completion_tokens,
+            "total_tokens": input_echo_len + completion_tokens,
+            "image_tokens": IMAGE_TOKENS if image is not None else 0,
         }
 
-    generation_thread.join()
-    yield {
-        "text": generated_text,
-        "usage": {
-            "prompt_tokens": input_echo_len,
-            "completion_tokens": total_len - input_echo_len,
-            "total_tokens": total_len,
-        },
-    }
+    def timings():
+        # Milliseconds between consecutive marks; a phase that has not started is left out
+        durations, previous = {}, start
+        for name, mark in marks.items():
+            durations[name] = round((mark - previous) * 1000, 1)
+            previous = mark
+        return durations
+
+    oom_retried = False
+
+    with SCHEDULER.reserve(
+        reserved_tokens,
+        priority=params.get("priority", DEFAULT_PRIORITY),
+        tenant=params.get("tenant", DEFAULT_TENANT),
+        memory=memory_estimate(reserved_tokens, max_new_tokens, [image]),
+    ) as slot:
+        marks["queue"] = time.perf_counter()
+        yield {"text": generated_text, "usage": usage()}
+        restored = None
+        if image_key is not None:
+            prompt_ids = model_inputs["input_ids"][0].tolist()
+            # Only a prefix that includes the whole image can be reused
+            restored = SESSION_KV.take(session, image_key, prompt_ids, prompt_ids.index(eoi_token_id) + 1)
+        while True:
+            # No timeout: a paused generation produces no tokens until it may continue
+            streamer = CountingStreamer(
+                tokenizer=tokenizer, timeout=None, skip_prompt=True, skip_special_tokens=True
+            )
+            gate = PreemptionGate(slot)
+            result = {}
+
+            def generate_text():
+                try:
+                    inputs = model_inputs
+                    if restored is not None:
+                        inputs = session_inputs(model, model_inputs, restored) or model_inputs
+                    with torch.no_grad():
+                        result["outputs"] = model.generate(
+                            **inputs,
+                            **gen_kwargs,
+                            max_new_tokens=max_new_tokens - done_tokens,
+                            streamer=streamer,
+                            stopping_criteria=StoppingCriteriaList([gate]),
+                            return_dict_in_generate=image_key is not None,
+                        )
+                except Exception as e:
+                    result["error"] = e
+                    streamer.end()
+
+            generation_thread = threading.Thread(target=generate_text)
+            generation_thread.start()
+            finished = False
+            try:
+                for next_text in streamer:
+                    if "prefill" not in marks:
+                        marks["prefill"] = time.perf_counter()
+                    generated_text += next_text
+                    yield {"text": generated_text, "usage": usage()}
+                finished = True
+            finally:
+                if not finished:
+                    # The client is gone: stop at the next decoding step
+                    SCHEDULER.cancel(slot)
+                # The reservation is held until generation has stopped
+                generation_thread.join()
+            error = result.get("error")
+            if error is not None and restored is not None and not is_oom(error) and not streamer.token_count:
+                # The model does not accept the restored cache: stop retaining caches
+                print(f"Session KV caches disabled: {error}")
+                SESSION_KV.disable()
+                restored = image_key = None
+                continue
+            restored = None
+            if error is not None:
+                if not is_oom(error):
+                    raise error
+                if oom_retried or not recover_from_oom():
+                    raise MemoryError(f"Out of memory: {error}") from error
+                # Ran out of memory next to other requests: queue again with the lowered capacity
+                oom_retried = True
+            elif not gate.stopped:
+                break
+
+            new_tokens = torch.tensor([streamer.token_ids], dtype=torch.long)
+            done_tokens += streamer.token_count
+            streamer = None
+            if done_tokens >= max_new_tokens or (new_tokens.shape[1] and new_tokens[0, -1].item() in eos_token_ids):
+                break
+            # Preempted by a higher priority request: continue once memory is available
+            model_inputs = extend_inputs(model_inputs, new_tokens)
+            SCHEDULER.readmit(slot)
+
+        outputs = result.get("outputs")
+        if image_key is not None and outputs is not None:
+            # Retained while the agent acts; the image placeholder (begin, placeholder and
+            # end of image) takes IMAGE_TOKENS cache positions
+            SESSION_KV.put(
+                session, image_key, outputs.sequences[0, :-1].tolist(), outputs.past_key_values, IMAGE_TOKENS - 3
+            )
+
+    marks.setdefault("prefill", time.perf_counter())
+    marks["decode"] = time.perf_counter()
+    yield {"text": generated_text, "usage": usage(), "timings": timings()}
+
+
+def warmup(rounds: int, image_size: Tuple[int, int], max_tokens: int):
+    """
+    Runs a few generations on a synthetic screenshot, so that CUDA kernel compilation
+    and allocator growth happen before the first real request.
+    """
+    image = Image.new("RGB", image_size, "white")
+    draw = ImageDraw.Draw(image)
+    draw.rectangle([0, 0, image_size[0], image_size[1] // 20], fill="lightgray")
+    draw.rectangle([image_size[0] // 3, image_size[1] // 3, image_size[0] // 2, image_size[1] // 2], outline="black")
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    image_url = "data:image/jpeg;base64," + base64.b64encode(buffer.getvalue()).decode("utf-8")
+    messages = [
+        ChatMessageInput(
+            role="user",
+            content=[
+                TextContent(
+                    type="text",
+                    text="Task: Open the settings\nHistory steps: \n(Platform: WIN)\n"
+                    "(Answer in Action-Operation-Sensitive format.)\n",
+                ),
+                ImageUrlContent(type="image_url", image_url=ImageUrl(url=image_url)),
+            ],
+        )
+    ]
+    params = dict(messages=messages, temperature=0.0, top_p=0.8, max_tokens=max_tokens)
+    for i in range(rounds):
+        start = time.time()
+        generate_cogagent(model, tokenizer, params)
+        print(f"Warmup round {i + 1}/{rounds} took {time.time() - start:.2f}s")
+
+
+def load_model(args):
+    """
+    Loads the tokenizer and model, runs the warmup and marks the server as ready.
+
+    With `--weights_cache`, the weights are loaded from a safetensors copy in that
+    directory (memory-mapped by `from_pretrained`); if the copy does not exist yet it
+    is written after the server became ready, so the next start is faster. Quantized
+    backends read the cache but do not write it.
+    """
+    global model, tokenizer, model_status, IMAGE_TOKENS, CONTEXT_LENGTH, PROMPT_BUILDER, KV_BYTES_PER_TOKEN
+    global IMAGE_PREPROCESSOR, TOKEN_PRUNER, SESSION_KV
+    try:
+        source = args.model_path
+        cache_dir = Path(args.weights_cache).expanduser().resolve() if args.weights_cache else None
+        cached = cache_dir is not None and (cache_dir / "config.json").exists()
+        if cached:
+            source = str(cache_dir)
+
+        start = time.time()
+        # Load tokenizer and model with the selected backend (see model_backend.py)
+        tokenizer, model = load_backend(
+            source,
+            backend=args.backend,
+            model_class=AutoModel,
+            torch_dtype=TORCH_TYPE,
+            cpu_threads=args.cpu_threads,
+            encode_special_tokens=True,
+        )
+        print(f"Model loaded from {source} with the {args.backend} backend in {time.time() - start:.2f}s")
+
+        if args.image_preprocess_batch:
+            IMAGE_PREPROCESSOR = ImagePreprocessor(
+                image_size_of(tokenizer),
+                model.device,
+                max_batch=args.image_preprocess_batch,
+                max_wait_ms=args.image_preprocess_wait_ms,
+            )
+        if args.prompt_cache_size or IMAGE_PREPROCESSOR is not None:
+            # Checked against apply_chat_template during warmup and the first requests; the
+            # preprocessor is used also when the segment cache is off or has switched itself off
+            PROMPT_BUILDER = PromptBuilder(
+                tokenizer, cache_size=args.prompt_cache_size, image_preprocessor=IMAGE_PREPROCESSOR
+            )
+
+        # Installed first: it lowers the number of image tokens in the config
+        TOKEN_PRUNER = install_pruner(model, args.prune_ratio, args.prune_mode)
+        IMAGE_TOKENS = image_token_count(model.config)
+        CONTEXT_LENGTH = getattr(model.config, "seq_length", None) or getattr(
+            model.config, "max_position_embeddings", None
+        )
+        # The CPU backends load fp32 or bf16 whatever TORCH_TYPE is
+        kv_dtype = compute_dtype(model)
+        KV_BYTES_PER_TOKEN = kv_bytes_per_token(model.config, kv_dtype)
+        # Measured before warmup, so that the fraction leaves room for activations; free
+        # memory of the GPU or of the host (CPU backends), limited by --memory_cap_mb
+        SCHEDULER.capacity_tokens = args.kv_capacity_tokens or capacity_from_memory(
+            model.config, kv_dtype, args.kv_memory_fraction, MEMORY.free()
+        )
+        if args.session_kv_device_mb or args.session_kv_host_mb or args.session_kv_disk_mb:
+            device_bytes = args.session_kv_device_mb * 1024 * 1024
+            SESSION_KV = SessionKVStore(
+                model.device,
+                device_bytes=device_bytes,
+                host_bytes=args.session_kv_host_mb * 1024 * 1024,
+                disk_bytes=args.session_kv_disk_mb * 1024 * 1024,
+                directory=args.session_kv_dir,
+                verify=args.session_kv_verify,
+                opt_out_misses=args.session_kv_opt_out_misses,
+            )
+            # Caches kept on the device are not reserved by requests
+            if SCHEDULER.capacity_tokens is not None and KV_BYTES_PER_TOKEN:
+                SCHEDULER.capacity_tokens = max(0, SCHEDULER.capacity_tokens - device_bytes // KV_BYTES_PER_TOKEN)
+        print(f"KV capacity: {SCHEDULER.capacity_tokens or 'unlimited'} tokens, {IMAGE_TOKENS} tokens per image")
+
+        model_status = "warming"
+        width, height = (int(x) for x in args.warmup_image_size.lower().split("x"))
+        warmup(args.warmup_rounds, (width, height), args.warmup_tokens)
+
+        model_status = "ready"
+        model_ready.set()
+
+        if cache_dir is not None and not cached and args.backend in SERIALIZABLE_BACKENDS:
+            print(f"Writing safetensors weights cache to {cache_dir}")
+            os.makedirs(cache_dir, exist_ok=True)
+            tokenizer.save_pretrained(cache_dir)
+            model.save_pretrained(cache_dir, safe_serialization=True)
+            if TOKEN_PRUNER is not None:
+                # The cache is loaded unpruned, --prune_ratio applies to the original size
+                TOKEN_PRUNER.restore_saved_config(cache_dir)
+    except Exception as e:
+        model_status = f"failed: {e}"
+        raise
 
 
 # Clean up GPU memory if possible
@@ -382,21 +1453,230 @@ if __name__ == "__main__":
     parser.add_argument(
         "--port", type=int, default=8000, help="Port to run the server on"
     )
+    parser.add_argument(
+        "--stream_flush_tokens",
+        type=int,
+        default=STREAM_FLUSH_TOKENS,
+        help="Max number of tokens coalesced into one streamed chunk (1 disables coalescing)",
+    )
+    parser.add_argument(
+        "--stream_flush_ms",
+        type=float,
+        default=STREAM_FLUSH_MS,
+        help="Max time in milliseconds a token is buffered before its chunk is sent",
+    )
+    parser.add_argument(
+        "--max_batch_size",
+        type=int,
+        default=MAX_BATCH_SIZE,
+        help="Max number of items of /v1/batch/completions run in one batched forward",
+    )
+    parser.add_argument(
+        "--backend",
+        choices=BACKENDS,
+        default="default",
+        help="Inference backend: full precision, int8/int4 weight quantization, or CPU",
+    )
+    parser.add_argument(
+        "--cpu_threads", type=int, default=None, help="Number of threads of the CPU backends"
+    )
+    parser.add_argument(
+        "--weights_cache",
+        default=None,
+        help="Directory with a pre-converted safetensors copy of the model (created on first start)",
+    )
+    parser.add_argument(
+        "--warmup_rounds", type=int, default=1, help="Number of warmup generations (0 disables warmup)"
+    )
+    parser.add_argument(
+        "--warmup_image_size", default="1920x1080", help="Size of the synthetic warmup screenshot"
+    )
+    parser.add_argument(
+        "--warmup_tokens", type=int, default=32, help="Max tokens generated per warmup round"
+    )
+    parser.add_argument(
+        "--kv_capacity_tokens",
+        type=int,
+        default=None,
+        help="KV cache tokens reserved by concurrent requests at most (default: from free GPU memory)",
+    )
+    parser.add_argument(
+        "--kv_memory_fraction",
+        type=float,
+        default=0.8,
+        help="Fraction of the free GPU (or host, for CPU backends) memory after loading used for the KV capacity",
+    )
+    parser.add_argument(
+        "--image_registry_mb",
+        type=int,
+        default=512,
+        help="Memory for images uploaded with POST /v1/images, in MB",
+    )
+    parser.add_argument(
+        "--max_upload_mb",
+        type=int,
+        default=32,
+        help="Largest image accepted by POST /v1/images, in MB (larger bodies get 413)",
+    )
+    parser.add_argument(
+        "--allow_shm",
+        action="store_true",
+        help="Accept shm:// image handles from clients on the same host",
+    )
+    parser.add_argument(
+        "--prompt_cache_size",
+        type=int,
+        default=4096,
+        help="Number of tokenized prompt segments cached (0 tokenizes every prompt in full)",
+    )
+    parser.add_argument(
+        "--image_preprocess_batch",
+        type=int,
+        default=8,
+        help="Max images resized and normalized together on the model device (0 uses the tokenizer's PIL path)",
+    )
+    parser.add_argument(
+        "--image_preprocess_wait_ms",
+        type=float,
+        default=2.0,
+        help="Time the image preprocessor waits for images of other requests to batch with",
+    )
+    parser.add_argument(
+        "--prune_ratio",
+        type=float,
+        default=0.0,
+        help="Fraction of image tokens of low-variance screen regions dropped before the language model (0 disables)",
+    )
+    parser.add_argument(
+        "--prune_mode",
+        choices=PRUNING_MODES,
+        default="drop",
+        help="Drop pruned image tokens, or merge them into the preceding kept token",
+    )
+    parser.add_argument(
+        "--session_kv_device_mb",
+        type=int,
+        default=0,
+        help="Memory of the GPU (taken from the KV capacity) for KV caches of idle sessions",
+    )
+    parser.add_argument(
+        "--session_kv_host_mb",
+        type=int,
+        default=0,
+        help="Host RAM for KV caches of idle sessions (X-Session-ID); 0 with the other budgets disables retention",
+    )
+    parser.add_argument(
+        "--session_kv_disk_mb",
+        type=int,
+        default=0,
+        help="Disk space for KV caches evicted from host RAM, memory-mapped when restored",
+    )
+    parser.add_argument(
+        "--session_kv_dir",
+        default=None,
+        help="Directory of the disk tier (default: a temporary directory)",
+    )
+    parser.add_argument(
+        "--session_kv_verify",
+        type=int,
+        default=2,
+        help="Number of restored caches checked against a full prefill",
+    )
+    parser.add_argument(
+        "--session_kv_opt_out_misses",
+        type=int,
+        default=3,
+        help="Rounds in a row without reuse after which a session's caches are not retained (0 always retains)",
+    )
+    parser.add_argument(
+        "--response_cache",
+        type=int,
+        default=0,
+        help="Number of responses to greedy requests cached in memory (0 disables the cache)",
+    )
+    parser.add_argument(
+        "--response_cache_dir",
+        default=None,
+        help="Directory where cached responses are persisted (e.g. for CI replays)",
+    )
+    parser.add_argument(
+        "--response_cache_max_temperature",
+        type=float,
+        default=GREEDY_TEMPERATURE,
+        help="Requests up to this temperature are cached; above ~0 responses are sampled",
+    )
+    parser.add_argument(
+        "--memory_cap_mb",
+        type=int,
+        default=None,
+        help="Memory the server may use in MB; exceeding it during decoding is handled like an OOM",
+    )
+    parser.add_argument(
+        "--max_image_pixels",
+        type=int,
+        default=MAX_IMAGE_PIXELS,
+        help="Images with more pixels are rejected with 413 before decoding (0 = no limit)",
+    )
+    parser.add_argument(
+        "--max_queue",
+        default=",".join(f"{k}={v}" for k, v in DEFAULT_MAX_QUEUE.items()),
+        help="Max waiting requests per priority class before 429, e.g. interactive=64,batch=256",
+    )
+    parser.add_argument(
+        "--queue_timeout",
+        default=",".join(f"{k}={v:g}" for k, v in DEFAULT_QUEUE_TIMEOUTS.items()),
+        help="Seconds a request of a priority class may wait before 503, e.g. interactive=30,batch=600",
+    )
+    parser.add_argument(
+        "--tenant_weights",
+        default="",
+        help="Fair-share weights of tenants (X-Tenant-ID or API key hash), e.g. team-a=2,nightly=0.5",
+    )
+    parser.add_argument(
+        "--running_threads",
+        type=int,
+        default=RUNNING_THREADS,
+        help="Threads for admitted requests, on top of one per request that may wait in the queues",
+    )
+    parser.add_argument(
+        "--no_preemption",
+        action="store_true",
+        help="Do not pause or preempt lower priority requests for interactive ones",
+    )
     args = parser.parse_args()
 
-    model_dir = Path(args.model_path).expanduser().resolve()
-
-    # Load tokenizer
-    tokenizer = AutoTokenizer.from_pretrained(
-        args.model_path, trust_remote_code=True, encode_special_tokens=True
+    MEMORY = MemoryMonitor(
+        "cpu" if args.backend.startswith("cpu") else "cuda",
+        args.memory_cap_mb * 1024 * 1024 if args.memory_cap_mb else None,
+    )
+    MAX_IMAGE_PIXELS = args.max_image_pixels
+    SCHEDULER = KVScheduler(
+        max_queue=parse_class_values(args.max_queue, int),
+        queue_timeouts=parse_class_values(args.queue_timeout),
+        tenant_weights=parse_class_values(args.tenant_weights),
+        preemption=not args.no_preemption,
     )
-    # Load model
-    model = AutoModel.from_pretrained(
-        args.model_path,
-        torch_dtype=TORCH_TYPE,
-        trust_remote_code=True,
-        device_map="auto",
-    ).eval()
+    REQUEST_POOL = ThreadPoolExecutor(
+        max_workers=request_pool_size(SCHEDULER, args.running_threads), thread_name_prefix="request"
+    )
+    IMAGE_REGISTRY = ImageRegistry(args.image_registry_mb * 1024 * 1024, args.max_upload_mb * 1024 * 1024)
+    if args.allow_shm:
+        SHM_READER = ShmReader()
+
+    if args.response_cache:
+        RESPONSE_CACHE = ResponseCache(
+            max_entries=args.response_cache,
+            directory=args.response_cache_dir,
+            namespace=f"{args.model_path}|{args.backend}",
+            max_temperature=args.response_cache_max_temperature,
+        )
+
+    STREAM_FLUSH_TOKENS = args.stream_flush_tokens
+    STREAM_FLUSH_MS = args.stream_flush_ms
+    MAX_BATCH_SIZE = args.max_batch_size
+
+    # The model is loaded by the lifespan handler after the port is bound
+    server_args = args
 
     # Run the Uvicorn server with the specified host and port
     uvicorn.run(app, host=args.host, port=args.port, workers=1)
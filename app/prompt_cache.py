@@ -0,0 +1,241 @@
+"""
+Prompt building with cached tokenization, used instead of calling
+`tokenizer.apply_chat_template` over the whole prompt for every request.
+
+The chat template wraps the user content in a fixed frame of special tokens
+([gMASK]<sop><|user|> ... <|assistant|>, plus the image placeholder). The frame is
+produced once from an empty message, and the content is tokenized in segments that
+end with a line break. The agent prompt consists of lines that repeat across requests
+(task, earlier history steps, platform and format strings), so with a segment cache
+only the newly appended history line is tokenized in each round.
+
+Splitting between a line break and the next non-space character keeps the result
+identical to tokenizing the whole text: no pre-token of the GLM-4 tokenizer's regex runs
+from a line break into a following non-space character (punctuation, on the other hand,
+is merged with the line breaks after it, so splitting before "\n" would change the
+tokens). The first builds are checked against `apply_chat_template` and the builder
+switches itself off on any difference; `python prompt_cache.py --model_dir ...` checks
+typical agent prompts with the real tokenizer. After a difference the content is
+tokenized as a whole and still inserted into the frame; only when that differs as well
+does the builder fall back to `apply_chat_template`.
+
+With an `image_preprocessor` (see image_preprocess.py) the image tensor is produced by the
+batched preprocessing stage and the template is not run at all, also when the segment
+cache is off (`cache_size` 0); the first images are compared with the template's within
+`IMAGE_TOLERANCE`.
+"""
+
+import argparse
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import torch
+from transformers import BatchEncoding
+
+# Split after a line break that is followed by a non-space character
+SEGMENT_PATTERN = re.compile(r"(?<=\n)(?=\S)")
+# Content used to find where the content goes inside the template frame
+PROBE = "Task"
+# Mean absolute difference (in normalized units) allowed between preprocessed images and
+# the template's; bicubic implementations differ by rounding
+IMAGE_TOLERANCE = 0.02
+
+
+class PromptBuilder:
+    """
+    Args:
+        tokenizer: The CogAgent tokenizer.
+        cache_size(int): Number of tokenized segments kept, 0 tokenizes the content whole.
+        verify_builds(int): Number of builds compared with `apply_chat_template`.
+        image_preprocessor(callable, optional): Maps a PIL image to its image tensor,
+            e.g. image_preprocess.ImagePreprocessor.
+    """
+
+    def __init__(
+        self, tokenizer, cache_size: int = 4096, verify_builds: int = 8, image_preprocessor=None
+    ):
+        self.tokenizer = tokenizer
+        self.image_preprocessor = image_preprocessor
+        self.cache_size = cache_size
+        self.verify_builds = verify_builds
+        # Segment cache of the content, and insertion of the content into the frame
+        self.enabled = cache_size > 0
+        self.use_frames = True
+        self.hits = 0
+        self.misses = 0
+        self._segments = OrderedDict()
+        # Per frame kind (with or without image): (frame ids, insertion index)
+        self._frames: Dict[bool, Tuple[List[int], int]] = {}
+        self._with_position_ids = True
+        self._lock = threading.Lock()
+
+    @property
+    def active_image_preprocessor(self):
+        """The image preprocessor while builds use it, otherwise None."""
+        return self.image_preprocessor if self.use_frames else None
+
+    def _template(self, content: str, image=None) -> BatchEncoding:
+        message = {"role": "user", "content": content}
+        if image is not None:
+            message["image"] = image
+        return self.tokenizer.apply_chat_template(
+            [message],
+            add_generation_prompt=True,
+            tokenize=True,
+            return_tensors="pt",
+            return_dict=True,
+        )
+
+    def _frame(self, with_image: bool, image=None) -> Tuple[List[int], int]:
+        """Frame ids of an empty message and the index where content tokens go."""
+        if with_image not in self._frames:
+            encoding = self._template("", image)
+            self._with_position_ids = "position_ids" in encoding
+            empty = encoding["input_ids"][0].tolist()
+            probe = self._template(PROBE, image)["input_ids"][0].tolist()
+            probe_ids = self.tokenizer.encode(PROBE, add_special_tokens=False)
+            index = 0
+            while index < len(empty) and empty[index] == probe[index]:
+                index += 1
+            if probe != empty[:index] + probe_ids + empty[index:]:
+                raise ValueError("Chat template does not wrap the content in a fixed frame")
+            self._frames[with_image] = empty, index
+        return self._frames[with_image]
+
+    def encode_text(self, text: str) -> List[int]:
+        """Tokenizes `text` segment by segment, reusing cached segments."""
+        ids = []
+        for segment in SEGMENT_PATTERN.split(text):
+            if not segment:
+                continue
+            with self._lock:
+                cached = self._segments.get(segment)
+                if cached is not None:
+                    self._segments.move_to_end(segment)
+                    self.hits += 1
+            if cached is None:
+                cached = self.tokenizer.encode(segment, add_special_tokens=False)
+                with self._lock:
+                    self.misses += 1
+                    self._segments[segment] = cached
+                    if len(self._segments) > self.cache_size:
+                        self._segments.popitem(last=False)
+            ids.extend(cached)
+        return ids
+
+    def build(self, content: str, image=None, pixel_values=None) -> BatchEncoding:
+        """
+        Returns the same inputs as `apply_chat_template` with one user message
+        (input_ids, attention_mask, position_ids and, with an image, images).
+        `pixel_values` is the already preprocessed image tensor, if any.
+        """
+        if not self.use_frames:
+            return self._template(content, image)
+
+        try:
+            frame, index = self._frame(image is not None, image)
+        except ValueError as e:
+            print(f"Prompt builder disabled: {e}")
+            self.use_frames = False
+            return self._template(content, image)
+
+        if image is not None:
+            if pixel_values is None and self.image_preprocessor is not None:
+                pixel_values = self.image_preprocessor(image)
+            if pixel_values is not None:
+                images = pixel_values
+            else:
+                # Only the image is processed here; the frame tokens are a handful
+                empty = self._template("", image)
+                frame = empty["input_ids"][0].tolist()
+                images = empty["images"]
+        if self.enabled:
+            content_ids = self.encode_text(content)
+        else:
+            content_ids = self.tokenizer.encode(content, add_special_tokens=False)
+        input_ids = torch.tensor([frame[:index] + content_ids + frame[index:]])
+        inputs = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        if self._with_position_ids:
+            inputs["position_ids"] = torch.arange(input_ids.shape[1]).unsqueeze(0)
+        if image is not None:
+            inputs["images"] = images
+        inputs = BatchEncoding(inputs)
+
+        if self.verify_builds > 0:
+            self.verify_builds -= 1
+            expected = self._template(content, image)
+            if not self._verify(inputs, expected):
+                return expected
+        return inputs
+
+    def _verify(self, built: BatchEncoding, expected: BatchEncoding) -> bool:
+        """Compares a build with the template; False (and a step back) on a difference."""
+        for key in ("input_ids", "attention_mask", "position_ids"):
+            if key not in expected:
+                continue
+            if key not in built or not torch.equal(built[key], expected[key].to(built[key].dtype)):
+                if self.enabled:
+                    # Tokenize the content whole from now on, and check that as well
+                    print(f"Prompt cache disabled: {key} differs from apply_chat_template")
+                    self.enabled = False
+                    self.verify_builds = max(self.verify_builds, 1)
+                else:
+                    print(f"Prompt builder disabled: {key} differs from apply_chat_template")
+                    self.use_frames = False
+                return False
+        if self.image_preprocessor is not None and "images" in expected:
+            difference = (built["images"].float().cpu() - expected["images"].float()).abs().mean().item()
+            if difference > IMAGE_TOLERANCE:
+                print(f"Image preprocessor disabled: images differ from apply_chat_template by {difference:.4f}")
+                self.image_preprocessor = None
+                return False
+        return True
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled,
+            "frames": self.use_frames,
+            "image_preprocessor": self.image_preprocessor is not None,
+            "segments": len(self._segments),
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+
+# Agent prompts as built by the clients (task, history, platform and format lines)
+SAMPLE_PROMPTS = [
+    "Task: Open the settings and turn on dark mode\n(Platform: WIN)\n"
+    "(Answer in Status-Plan-Action-Operation-Sensitive format.)\n",
+    "Task: Search for flights to Berlin (one way).\nHistory steps: \n"
+    "0. CLICK(box=[[212,35,516,61]], element_info='Search')\tClick the search box.\n"
+    "1. TYPE(box=[[212,35,516,61]], text='flights to Berlin', element_info='Search')\tType the query.\n"
+    "(Platform: Mac)\n(Answer in Action-Operation format.)\n",
+    "Task: 打开设置，关闭蓝牙。\nHistory steps: \n0. KEY_PRESS(key='Enter')\t按回车。\n"
+    "(Platform: Mobile)\n(Answer in Status-Action-Operation-Sensitive format.)\n",
+]
+
+
+def check_segments(tokenizer, prompts: List[str] = SAMPLE_PROMPTS) -> List[str]:
+    """Prompts whose segmented tokenization differs from tokenizing them whole."""
+    builder = PromptBuilder(tokenizer)
+    return [
+        prompt
+        for prompt in prompts
+        if builder.encode_text(prompt) != tokenizer.encode(prompt, add_special_tokens=False)
+    ]
+
+
+if __name__ == "__main__":
+    from transformers import AutoTokenizer
+
+    parser = argparse.ArgumentParser(description="Check segmented tokenization against the real tokenizer")
+    parser.add_argument("--model_dir", default="THUDM/cogagent-9b-20241220", help="Path or identifier of the model.")
+    args = parser.parse_args()
+
+    mismatches = check_segments(AutoTokenizer.from_pretrained(args.model_dir, trust_remote_code=True))
+    for prompt in mismatches:
+        print(f"Segmented tokenization differs for {prompt!r}")
+    print(f"{len(SAMPLE_PROMPTS) - len(mismatches)}/{len(SAMPLE_PROMPTS)} prompts match")
+    raise SystemExit(1 if mismatches else 0)
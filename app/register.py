@@ -6,14 +6,12 @@ key: value
 meta-operation: keyword
 """
 
-import pyautogui
-import pyperclip
 import time
-import os
-import platform
 
-pyautogui.FAILSAFE = True
-pyautogui.PAUSE = 1
+from PIL import ImageChops
+
+from input_backends import InputBackend, PyAutoGUIBackend
+from visual_locate import VisualLocator
 
 # TODO: Support other META_PARAMETER and other META_OPERATION
 META_PARAMETER = {
@@ -37,27 +35,303 @@ META_PARAMETER = {
 }
 
 
-def identify_os():
-    os_detail = platform.platform()
-    if "mac" in os_detail.lower():
-        return "Mac"
-    elif "windows" in os_detail.lower():
-        return "Win"
-    else:
-        raise ValueError(
-            f"This {os_detail} operating system is not currently supported!"
+class ScreenGeometry:
+    """
+    Geometry of the display the agent acts on, captured once instead of per operation.
+
+    width/height are in the logical coordinates used by the input backend, left/top is the origin
+    of the selected monitor, and scale is the ratio between screenshot pixels and logical
+    coordinates (e.g. 2.0 on a Retina display). When a monitor is selected, desktop is the
+    (left, top, width, height) of the virtual desktop spanning all monitors, which an
+    all-screens capture covers and from which the monitor is cropped.
+    """
+
+    def __init__(self, width, height, left=0, top=0, scale=1.0, desktop=None):
+        self.width = width
+        self.height = height
+        self.left = left
+        self.top = top
+        self.scale = scale
+        self.desktop = desktop
+
+    @classmethod
+    def detect(cls, backend, monitor=None):
+        """
+        Reads the screen size from the input backend, or the geometry of monitor number
+        `monitor` when the optional `screeninfo` package is installed.
+        """
+        if monitor is not None:
+            try:
+                from screeninfo import get_monitors
+
+                monitors = get_monitors()
+                m = monitors[monitor]
+                left = min(n.x for n in monitors)
+                top = min(n.y for n in monitors)
+                right = max(n.x + n.width for n in monitors)
+                bottom = max(n.y + n.height for n in monitors)
+                return cls(m.width, m.height, m.x, m.y, desktop=(left, top, right - left, bottom - top))
+            except ImportError:
+                print("screeninfo is not installed, using the primary screen")
+        width, height = backend.size()
+        return cls(width, height)
+
+    @property
+    def screenshot_size(self):
+        return round(self.width * self.scale), round(self.height * self.scale)
+
+    def crop(self, capture):
+        """Crops the selected monitor out of an all-screens capture of the desktop."""
+        if self.desktop is None:
+            return capture
+        left, top, width, height = self.desktop
+        scale = capture.width / width
+        box = (
+            round((self.left - left) * scale),
+            round((self.top - top) * scale),
+            round((self.left - left + self.width) * scale),
+            round((self.top - top + self.height) * scale),
         )
+        return capture.crop(box)
+
+    def to_point(self, box):
+        """
+        Converts a box normalized to 0-1000 (x_min, y_min, x_max, y_max) into the
+        screen coordinates of its center.
+        """
+        x_min, y_min, x_max, y_max = [
+            int(num / 1000 * self.width) if i % 2 == 0 else int(num / 1000 * self.height)
+            for i, num in enumerate(box)
+        ]
+        return self.left + (x_min + x_max) / 2, self.top + (y_min + y_max) / 2
+
+
+class ActionExecutor:
+    """
+    Executes meta-operations through a dispatch table.
+
+    The OS, its hotkeys and the screen geometry are determined once when the executor is
+    created; call `observe_screenshot` with the size of each new screenshot so that a
+    changed resolution or DPI scaling refreshes the geometry. With a selected monitor,
+    `screenshot` captures all screens and crops the monitor, so screenshot pixels and
+    the monitor geometry always match.
+
+    Args:
+        backend(InputBackend, optional): Mouse/keyboard/screen backend, pyautogui by default.
+        pause(float): Pause after each input event of the default backend.
+        type_mode(str): "paste" types through the clipboard, "type" sends key events,
+            "auto" sends key events for ASCII text and pastes everything else.
+        clipboard_delay(float): Wait between copying to the clipboard and pasting.
+        settle(float): Wait after each operation so the UI can update before the next screenshot.
+        monitor(int, optional): Monitor number, see `ScreenGeometry.detect`.
+        locator(VisualLocator, optional): Template matcher used by `locate`.
+        guard_threshold(float): Fraction of changed pixels in the target region of a batched
+            step above which the step is considered stale, see `execute_batch`.
+    """
+
+    def __init__(
+        self,
+        backend: InputBackend = None,
+        pause=0.1,
+        type_mode="auto",
+        clipboard_delay=0.2,
+        settle=2.0,
+        monitor=None,
+        locator: VisualLocator = None,
+        guard_threshold=0.5,
+    ):
+        self.backend = backend or PyAutoGUIBackend(pause=pause)
+        self.type_mode = type_mode
+        self.clipboard_delay = clipboard_delay
+        self.settle = settle
+        self.monitor = monitor
+        self.locator = locator or VisualLocator()
+        self.guard_threshold = guard_threshold
+
+        self.os_name = self.backend.os_name
+        self.paste_modifier = "command" if self.os_name == "Mac" else "ctrl"
+        self.geometry = ScreenGeometry.detect(self.backend, monitor)
+        self.dispatch = {
+            "CLICK": self.click,
+            "DOUBLE_CLICK": self.double_click,
+            "RIGHT_CLICK": self.right_click,
+            "TYPE": self.type_input,
+            "HOVER": self.hover,
+            "SCROLL_DOWN": self.scroll_down,
+            "SCROLL_UP": self.scroll_up,
+            "KEY_PRESS": self.key_press,
+            "LAUNCH": self.launch,
+            "END": end,
+        }
+
+    def observe_screenshot(self, size):
+        """Refreshes the geometry when the screenshot size no longer matches it."""
+        if tuple(size) != self.geometry.screenshot_size:
+            self.geometry = ScreenGeometry.detect(self.backend, self.monitor)
+            self.geometry.scale = size[0] / self.geometry.width
+
+    def screenshot(self):
+        """Takes a screenshot through the backend and refreshes the geometry if needed."""
+        if self.geometry.desktop is None:
+            screenshot = self.backend.screenshot()
+            self.observe_screenshot(screenshot.size)
+            return screenshot
+
+        capture = self.backend.screenshot(all_screens=True)
+        screenshot = self.geometry.crop(capture)
+        if screenshot.size != self.geometry.screenshot_size:
+            # The monitor layout or scaling changed: crop again with the new geometry
+            self.geometry = ScreenGeometry.detect(self.backend, self.monitor)
+            screenshot = self.geometry.crop(capture)
+            self.geometry.scale = screenshot.width / self.geometry.width
+        return screenshot
+
+    def locate(self, template, box=None, timeout=None):
+        """
+        Finds `template` on screen, optionally near the model's 0-1000 `box`, polling until
+        `timeout`. Returns the center in screen coordinates, or None.
+        """
+        match = self.locator.locate_on_screen(template, self.screenshot, region=box, timeout=timeout)
+        if match is None:
+            return None
+        x, y = match.center
+        scale = self.geometry.scale
+        return self.geometry.left + x / scale, self.geometry.top + y / scale
+
+    def paste(self, text):
+        self.backend.set_clipboard(text)
+        time.sleep(self.clipboard_delay)
+        self.backend.hotkey(self.paste_modifier, "v")
+
+    def write(self, text):
+        if self.type_mode == "type" or (
+            self.type_mode == "auto" and text.isascii() and text.isprintable()
+        ):
+            self.backend.write(text)
+        else:
+            self.paste(text)
+
+    def click(self, params):
+        self.backend.click(*params["box"])
+
+    def double_click(self, params):
+        self.backend.click(*params["box"], clicks=2)
+
+    def right_click(self, params):
+        self.backend.click(*params["box"], button="right")
+
+    def type_input(self, params):
+        self.write(params["text"])
+        self.backend.press("Return")
+
+    def hover(self, params):
+        self.backend.move(*params["box"])
+
+    def scroll_down(self, params):
+        self.backend.move(*params["box"])
+        self.backend.scroll(-10)
+
+    def scroll_up(self, params):
+        self.backend.move(*params["box"])
+        self.backend.scroll(10)
+
+    def key_press(self, params):
+        self.backend.press(params["key"])
+
+    def launch(self, params):
+        self.backend.launch(params["app"])
+
+    def convert(self, Grounded_Operation):
+        if Grounded_Operation["operation"] not in META_PARAMETER:
+            raise ValueError("Wrong operation or operation not registered!")
+        detailed_operation = {"meta": Grounded_Operation["operation"]}
+        for value in META_PARAMETER[Grounded_Operation["operation"]]:
+            if value in Grounded_Operation:
+                if value == "box":
+                    detailed_operation[value] = self.geometry.to_point(Grounded_Operation["box"])
+                else:
+                    detailed_operation[value] = Grounded_Operation[value][1:-1]
+        return detailed_operation
+
+    def execute(self, detailed_operation):
+        self.dispatch[detailed_operation["meta"]](detailed_operation)
+
+    def is_stale(self, reference, box):
+        """
+        Guard of a batched step: compares the region of `box` (0-1000) in a fresh screenshot
+        with the screenshot the model saw. Small changes such as a focus ring or a caret are
+        expected after the previous step; a mostly different region means the UI moved on
+        and the remaining steps no longer apply.
+        """
+        current = self.screenshot()
+        if current.size != reference.size:
+            return True
+        width, height = reference.size
+        region = (
+            int(box[0] / 1000 * width),
+            int(box[1] / 1000 * height),
+            max(int(box[2] / 1000 * width), int(box[0] / 1000 * width) + 1),
+            max(int(box[3] / 1000 * height), int(box[1] / 1000 * height) + 1),
+        )
+        difference = ImageChops.difference(
+            reference.crop(region).convert("L"), current.crop(region).convert("L")
+        )
+        histogram = difference.histogram()
+        changed = sum(histogram[32:]) / sum(histogram)
+        return changed > self.guard_threshold
+
+    def execute_batch(self, Grounded_Operations, reference=None, settle=True):
+        """
+        Executes several operations from one model response back-to-back and waits for the
+        UI to settle only once at the end. When `reference` (the screenshot the model saw) is
+        given, every step after the first with a box is guarded by `is_stale`, and the batch
+        stops at the first stale step so the model can look at the new screen.
+
+        Returns:
+            The metas of the executed operations, in order.
+        """
+        executed = []
+        for i, Grounded_Operation in enumerate(Grounded_Operations):
+            if (
+                i > 0
+                and reference is not None
+                and "box" in Grounded_Operation
+                and self.is_stale(reference, Grounded_Operation["box"])
+            ):
+                print(f"Skipping stale step {i}: {Grounded_Operation}")
+                break
+            detailed_operation = self.convert(Grounded_Operation)
+            print(detailed_operation)
+            self.execute(detailed_operation)
+            executed.append(detailed_operation["meta"])
+            if detailed_operation["meta"] == "END":
+                break
+        if settle:
+            time.sleep(self.settle)
+        return executed
+
+    def __call__(self, Grounded_Operation):
+        return self.execute_batch([Grounded_Operation])[0]
+
+
+_executor = None
+
+
+def get_executor():
+    """Returns the executor shared by the module-level functions, creating it on first use."""
+    global _executor
+    if _executor is None:
+        _executor = ActionExecutor()
+    return _executor
+
+
+def set_executor(executor):
+    global _executor
+    _executor = executor
 
 
 def paste(text):
-    pyperclip.copy(text)
-    time.sleep(1)
-    if identify_os() == "Mac":
-        with pyautogui.hold("command"):
-            pyautogui.press("v")
-    elif identify_os() == "Win":
-        with pyautogui.hold("ctrl"):
-            pyautogui.press("v")
+    get_executor().paste(text)
 
 
 def click(params):
@@ -65,7 +339,7 @@ def click(params):
     Meta-operation: CLICK
     CLICK: Simulate a left-click at the center position of the box.
     """
-    pyautogui.doubleClick(params["box"])
+    get_executor().click(params)
 
 
 def double_click(params):
@@ -73,7 +347,7 @@ def double_click(params):
     Meta-operation: DOUBLE_CLICK
     DOUBLE_CLICK: Simulate a double-click the center position of the box.
     """
-    pyautogui.doubleClick(params["box"])
+    get_executor().double_click(params)
 
 
 def right_click(params):
@@ -81,7 +355,7 @@ def right_click(params):
     Meta-operation: RIGHT_CLICK
     RIGHT_CLICK: Simulate a right-click at the center position of the box.
     """
-    pyautogui.rightClick(params["box"])
+    get_executor().right_click(params)
 
 
 def type_input(params):
@@ -89,8 +363,7 @@ def type_input(params):
     Meta-operation: TYPE
     TYPE: At the center position of the box, simulate keyboard input to enter text.
     """
-    paste(params["text"])
-    pyautogui.press("Return")
+    get_executor().type_input(params)
 
 
 def hover(params):
@@ -98,7 +371,7 @@ def hover(params):
     Meta-operation: HOVER
     HOVER: Move the mouse to the center position of the box.
     """
-    pyautogui.moveTo(params["box"])
+    get_executor().hover(params)
 
 
 def scroll_down(params):
@@ -106,8 +379,7 @@ def scroll_down(params):
     Meta-operation: SCROLL_DOWN
     SCROLL_DOWN: Move the mouse to the center position of the box, then scroll the screen downward.
     """
-    pyautogui.moveTo(params["box"])
-    pyautogui.scroll(-10)
+    get_executor().scroll_down(params)
 
 
 def scroll_up(params):
@@ -115,8 +387,7 @@ def scroll_up(params):
     Meta-operation: SCROLL_UP
     SCROLL_UP: Move the mouse to the center position of the box, then scroll the screen up.
     """
-    pyautogui.moveTo(params["box"])
-    pyautogui.scroll(10)
+    get_executor().scroll_up(params)
 
 
 def key_press(params):
@@ -124,7 +395,7 @@ def key_press(params):
     Meta-operation: KEY_PRESS
     TYPE: Press a special key on the keyboard. eg: KEY_PRESS(key='Return').
     """
-    pyautogui.press(params["key"])
+    get_executor().key_press(params)
 
 
 def end(params):
@@ -132,15 +403,12 @@ def end(params):
 
 
 def launch(params):
-    system_app_dir = "/System/Applications"  # For Mac
-    applications_dir = "/Applications"  # For Mac
-    applications = [app for app in os.listdir(applications_dir) if app.endswith(".app")]
-    system_apps = [app for app in os.listdir(system_app_dir) if app.endswith(".app")]
-    all_apps = applications + system_apps
-    for app in all_apps:
-        if params["app"][1:-1] in app:
-            app_dir = applications_dir + "/" + app
-            os.system(f"open -a '{app_dir}'")
+    """
+    Meta-operation: LAUNCH
+    LAUNCH: Start an application found in the cached application index of the backend.
+    """
+    get_executor().launch(params)
+
 
 META_OPERATION = {
     # Defining meta-operation functions
@@ -163,57 +431,25 @@ META_OPERATION = {
 }
 
 
-def locateOnScreen(image, screenshotIm):
-    print(image, screenshotIm)
-    start = time.time()
-    while True:
-        try:
-            # the locateAll() function must handle cropping to return accurate coordinates,
-            # so don't pass a region here.
-            retVal = pyautogui.locate(image, screenshotIm)
-            try:
-                screenshotIm.fp.close()
-            except AttributeError:
-                # Screenshots on Windows won't have an fp since they came from
-                # ImageGrab, not a file. Screenshots on Linux will have fp set
-                # to None since the file has been unlinked
-                pass
-            if retVal or time.time() - start > 0:
-                return retVal
-        except:
-            if time.time() - start > 0:
-                return None
+def locateOnScreen(image, screenshotIm, region=None):
+    """
+    Finds `image` in the screenshot and returns the match (left, top, width, height, score)
+    in screenshot pixels, or None. `region` is an optional 0-1000 box to search around.
+    """
+    return get_executor().locator.locate(image, screenshotIm, region=region)
 
 
 def convert_to_meta_operation(Grounded_Operation):
-    detailed_operation = {}
-    if Grounded_Operation["operation"] in META_PARAMETER:
-        detailed_operation["meta"] = Grounded_Operation["operation"]
-        for value in META_PARAMETER[Grounded_Operation["operation"]]:
-            if value in Grounded_Operation:
-                if value == "box":
-                    # number = (left, top, width, height)
-                    numbers = Grounded_Operation["box"]
-                    box = [num / 1000 for num in numbers]
-                    # box = (left/1000, top/1000, width/1000, height/1000)
-                    width, height = pyautogui.size()
-                    # x_min, y_min, x_max, y_max = left, top, right, down)
-                    x_min, y_min, x_max, y_max = [
-                        int(coord * width) if i % 2 == 0 else int(coord * height)
-                        for i, coord in enumerate(box)
-                    ]
-                    x, y = (x_min + x_max) / 2, (y_min + y_max) / 2
-                    detailed_operation[value] = (x, y)
-                else:
-                    detailed_operation[value] = Grounded_Operation[value][1:-1]
-        print(detailed_operation)
-        return detailed_operation
-    else:
-        raise "Wrong operation or operation not registered!"
+    detailed_operation = get_executor().convert(Grounded_Operation)
+    print(detailed_operation)
+    return detailed_operation
 
 
-def agent(Grounded_Operation):
-    detailed_operation = convert_to_meta_operation(Grounded_Operation)
-    META_OPERATION[detailed_operation["meta"]](detailed_operation)
-    time.sleep(2)
-    return detailed_operation["meta"]
+def agent(Grounded_Operation, reference=None, settle=True):
+    """
+    Executes one grounded operation and returns its meta, or a list of grounded operations
+    (see `ActionExecutor.execute_batch`) and returns the metas of the executed ones.
+    """
+    if isinstance(Grounded_Operation, list):
+        return get_executor().execute_batch(Grounded_Operation, reference, settle)
+    return get_executor()(Grounded_Operation)
@@ -0,0 +1,158 @@
+"""
+Cache of complete responses for deterministic requests, used by `openai_demo.py`.
+
+With temperature ~0 the server decodes greedily, so the same prompt and screenshot always
+produce the same text. Responses are keyed on a hash of the model, the messages (with images
+replaced by a hash of their content) and the sampling parameters, kept in an in-memory LRU and
+written through to a directory so that they survive restarts (e.g. for CI replays).
+"""
+
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+
+# Requests with a temperature up to this value are decoded greedily by the server
+GREEDY_TEMPERATURE = 1e-5
+
+
+def _image_digest(url: str) -> str:
+    """
+    Hashes the base64 payload of a data URL (without decoding it, the encoding of the same
+    bytes is the same), or returns the URL itself for remote images.
+    """
+    if url.startswith("data:") and "," in url:
+        return "sha256:" + hashlib.sha256(url.split(",", 1)[1].encode("ascii")).hexdigest()
+    return "url:" + url
+
+
+def normalize_messages(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Messages as plain dicts, with image URLs replaced by their content hash."""
+    normalized = []
+    for message in messages:
+        content = message["content"]
+        if isinstance(content, list):
+            items = []
+            for item in content:
+                if item["type"] == "image_url":
+                    items.append({"type": "image", "digest": _image_digest(item["image_url"]["url"])})
+                else:
+                    items.append({"type": item["type"], "text": item["text"]})
+            content = items
+        normalized.append({"role": message["role"], "content": content})
+    return normalized
+
+
+class ResponseCache:
+    """
+    LRU of responses in memory, written through to `directory` when given.
+
+    Args:
+        max_entries(int): Number of responses kept in memory.
+        directory(str, optional): Directory of the persistent tier.
+        max_disk_entries(int): Number of files kept in `directory`; the oldest are removed.
+        namespace(str): Mixed into every key, e.g. the model path and backend, so that a
+            directory shared between models never returns another model's response.
+        max_temperature(float): Requests with a higher temperature are not cached.
+    """
+
+    def __init__(
+        self,
+        max_entries: int = 256,
+        directory: Optional[str] = None,
+        max_disk_entries: int = 10000,
+        namespace: str = "",
+        max_temperature: float = GREEDY_TEMPERATURE,
+    ):
+        self.max_entries = max_entries
+        self.directory = directory
+        self.max_disk_entries = max_disk_entries
+        self.namespace = namespace
+        self.max_temperature = max_temperature
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._writes = 0
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def eligible(self, params: Dict[str, Any]) -> bool:
+        return float(params.get("temperature") or 0.0) <= self.max_temperature
+
+    def key(self, model: str, messages: List[Dict[str, Any]], params: Dict[str, Any]) -> str:
+        payload = {
+            "namespace": self.namespace,
+            "model": model,
+            "messages": normalize_messages(messages),
+            "params": {
+                name: params.get(name)
+                for name in ("temperature", "top_p", "max_tokens", "repetition_penalty")
+            },
+        }
+        encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")
+        return hashlib.sha256(encoded).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            if key in self._entries:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return self._entries[key]
+        if self.directory:
+            try:
+                with open(self._path(key), encoding="utf-8") as f:
+                    value = json.load(f)
+            except (OSError, ValueError):
+                value = None
+            if value is not None:
+                os.utime(self._path(key))
+                self._remember(key, value)
+                with self._lock:
+                    self.hits += 1
+                return value
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key: str, value: Dict[str, Any]):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def put(self, key: str, value: Dict[str, Any]):
+        self._remember(key, value)
+        if not self.directory:
+            return
+        tmp = self._path(key) + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(value, f, ensure_ascii=False)
+        os.replace(tmp, self._path(key))
+        self._writes += 1
+        if self._writes % 64 == 0:
+            self._prune()
+
+    def _prune(self):
+        files = [
+            os.path.join(self.directory, name)
+            for name in os.listdir(self.directory)
+            if name.endswith(".json")
+        ]
+        if len(files) <= self.max_disk_entries:
+            return
+        files.sort(key=os.path.getmtime)
+        for path in files[: len(files) - self.max_disk_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,414 @@
+"""
+This script starts a router in front of several OpenAI-compatible CogAgent replicas
+(`openai_demo.py` processes pinned to different devices or hosts).
+
+Requests are sent to the least-loaded healthy replica, or, with session affinity, to the
+replica that served the same session before so that its prefix/image caches are reused.
+Replicas are health-checked in the background and skipped while they are down.
+`/v1/chat/completions`, `/v1/batch/completions` and image uploads are forwarded; `/ready`
+succeeds while any replica is ready, `/health` collects the replicas' `/health` reports and
+`/metrics` merges their metrics with a `replica` label.
+
+Front existing replicas:
+python router.py --replicas http://10.0.0.1:8000,http://10.0.0.2:8000 --port 7870
+
+Spawn one replica per GPU on this machine:
+python router.py --spawn 2 --devices 0,1 --model_path THUDM/cogagent-9b-20241220 --port 7870
+
+Several CPU stand-in replicas on one machine (an empty device string hides all GPUs and
+starts the replicas with `--backend cpu` unless --replica_args chooses a backend):
+python router.py --spawn 3 --devices "" --model_path THUDM/cogagent-9b-20241220 --port 7870
+"""
+
+import argparse
+import asyncio
+import hashlib
+import os
+import re
+import shlex
+import subprocess
+import sys
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+
+# Header used by clients to pin a session to one replica
+SESSION_HEADER = "x-session-id"
+# Hop-by-hop headers that must not be forwarded
+HOP_HEADERS = {"host", "content-length", "connection", "transfer-encoding", "keep-alive"}
+# A Prometheus sample line: name, optional labels, value (and timestamp)
+SAMPLE_PATTERN = re.compile(r"^([a-zA-Z_:][a-zA-Z0-9_:]*)(\{[^}]*\})?(\s.*)$")
+
+
+class Replica:
+    """A backend replica together with its load and health state."""
+
+    def __init__(self, url: str, process: Optional[subprocess.Popen] = None):
+        self.url = url.rstrip("/")
+        self.process = process
+        self.in_flight = 0
+        self.healthy = False
+        self.failures = 0
+        self.last_check = 0.0
+
+    def state(self) -> dict:
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "in_flight": self.in_flight,
+            "failures": self.failures,
+            "last_check": self.last_check,
+        }
+
+
+class Router:
+    """
+    Chooses a replica per request.
+
+    Args:
+        replicas(List[Replica]): The replicas to route to.
+        policy(str): "least_loaded" or "session_affinity".
+        health_path(str): Path polled to decide whether a replica is healthy (its readiness probe).
+        health_interval(float): Seconds between health checks.
+        max_failures(int): Consecutive failed checks before a replica is marked down.
+    """
+
+    def __init__(
+        self,
+        replicas: List[Replica],
+        policy: str = "least_loaded",
+        health_path: str = "/ready",
+        health_interval: float = 5.0,
+        max_failures: int = 2,
+    ):
+        self.replicas = replicas
+        self.policy = policy
+        self.health_path = health_path
+        self.health_interval = health_interval
+        self.max_failures = max_failures
+
+    def healthy(self) -> List[Replica]:
+        return [replica for replica in self.replicas if replica.healthy]
+
+    def choose(self, session_id: Optional[str], exclude=()) -> Optional[Replica]:
+        candidates = [r for r in self.healthy() if r not in exclude]
+        if not candidates:
+            return None
+        if self.policy == "session_affinity" and session_id:
+            # Rendezvous hashing: a session keeps its replica as long as that replica is
+            # healthy, and only the sessions of a failed replica move elsewhere.
+            return max(
+                candidates,
+                key=lambda r: hashlib.blake2b(
+                    f"{session_id}|{r.url}".encode(), digest_size=8
+                ).digest(),
+            )
+        return min(candidates, key=lambda r: r.in_flight)
+
+    async def check(self, client: httpx.AsyncClient, replica: Replica):
+        try:
+            response = await client.get(replica.url + self.health_path, timeout=5.0)
+            ok = response.status_code == 200
+        except httpx.HTTPError:
+            ok = False
+        replica.last_check = time.time()
+        if ok:
+            replica.failures = 0
+            replica.healthy = True
+        else:
+            replica.failures += 1
+            if replica.failures >= self.max_failures:
+                replica.healthy = False
+
+    async def health_loop(self, client: httpx.AsyncClient):
+        while True:
+            await asyncio.gather(*(self.check(client, r) for r in self.replicas))
+            await asyncio.sleep(self.health_interval)
+
+    def mark_failed(self, replica: Replica):
+        replica.failures = self.max_failures
+        replica.healthy = False
+
+
+router: Router = None
+http_client: httpx.AsyncClient = None
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Starts the shared HTTP client and the health-check loop, and terminates
+    spawned replica processes when the router shuts down.
+    """
+    global http_client
+    http_client = httpx.AsyncClient(timeout=httpx.Timeout(None, connect=5.0))
+    health_task = asyncio.create_task(router.health_loop(http_client))
+    yield
+    health_task.cancel()
+    await http_client.aclose()
+    for replica in router.replicas:
+        if replica.process is not None:
+            replica.process.terminate()
+
+
+app = FastAPI(lifespan=lifespan)
+
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+
+
+@app.get("/router/replicas")
+async def list_replicas():
+    """Reports the health and load of every replica."""
+    return {"policy": router.policy, "replicas": [r.state() for r in router.replicas]}
+
+
+@app.get("/v1/models")
+async def list_models():
+    replica = router.choose(None)
+    if replica is None:
+        raise HTTPException(status_code=503, detail="No healthy replica")
+    response = await http_client.get(replica.url + "/v1/models")
+    return JSONResponse(response.json(), status_code=response.status_code)
+
+
+@app.get("/ready")
+async def ready():
+    """Ready while at least one replica is ready."""
+    if not router.healthy():
+        return JSONResponse({"status": "not ready"}, status_code=503)
+    return {"status": "ready", "replicas": len(router.healthy())}
+
+
+async def fetch_replicas(path: str) -> List[Tuple[Replica, Optional[httpx.Response]]]:
+    """GETs `path` from every replica concurrently; None for replicas that cannot be reached."""
+
+    async def fetch(replica: Replica) -> Optional[httpx.Response]:
+        try:
+            return await http_client.get(replica.url + path, timeout=5.0)
+        except httpx.HTTPError:
+            return None
+
+    responses = await asyncio.gather(*(fetch(replica) for replica in router.replicas))
+    return list(zip(router.replicas, responses))
+
+
+@app.get("/health")
+async def health():
+    """Liveness of the router together with the `/health` report of every replica."""
+    reports = {}
+    for replica, response in await fetch_replicas("/health"):
+        if response is None or response.status_code != 200:
+            reports[replica.url] = {"status": "unreachable", **replica.state()}
+        else:
+            reports[replica.url] = response.json()
+    return {"status": "ok", "policy": router.policy, "replicas": reports}
+
+
+def merge_metrics(texts: List[Tuple[str, str]]) -> str:
+    """
+    Merges the Prometheus text expositions of several replicas: every sample gets a
+    `replica` label, and the samples of one metric family stay together under one
+    HELP/TYPE header.
+    """
+    families: Dict[str, Tuple[List[str], List[str]]] = {}
+    for url, text in texts:
+        family = None
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            if line.startswith("#"):
+                parts = line.split()
+                if len(parts) >= 3 and parts[1] in ("HELP", "TYPE"):
+                    family = parts[2]
+                    header = families.setdefault(family, ([], []))[0]
+                    if line not in header:
+                        header.append(line)
+                continue
+            match = SAMPLE_PATTERN.match(line)
+            if match is None:
+                continue
+            name, labels, rest = match.groups()
+            labels = f'replica="{url}"' + (f",{labels[1:-1]}" if labels and labels != "{}" else "")
+            families.setdefault(family or name, ([], []))[1].append(f"{name}{{{labels}}}{rest}")
+    return "".join(f"{line}\n" for header, samples in families.values() for line in header + samples)
+
+
+@app.get("/metrics")
+async def metrics():
+    """Metrics of all reachable replicas, labelled by replica."""
+    texts = [
+        (replica.url, response.text)
+        for replica, response in await fetch_replicas("/metrics")
+        if response is not None and response.status_code == 200
+    ]
+    return Response(merge_metrics(texts), media_type="text/plain; version=0.0.4")
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    """
+    Forwards the request body unchanged to a replica and streams the response back,
+    which covers both JSON and SSE responses. A replica that cannot be reached is
+    marked down and the request is retried on another one.
+    """
+    return await forward(request, "/v1/chat/completions")
+
+
+@app.post("/v1/batch/completions")
+async def batch_completions(request: Request):
+    """Forwards batch evaluations like chat completions, with the same retries."""
+    return await forward(request, "/v1/batch/completions")
+
+
+async def forward(request: Request, path: str) -> StreamingResponse:
+    """Sends the request to a chosen replica (retrying on unreachable ones) and relays the response."""
+    body = await request.body()
+    headers = {k: v for k, v in request.headers.items() if k not in HOP_HEADERS}
+    session_id = request.headers.get(SESSION_HEADER)
+
+    tried = []
+    while True:
+        replica = router.choose(session_id, exclude=tried)
+        if replica is None:
+            raise HTTPException(status_code=503, detail="No healthy replica")
+        tried.append(replica)
+
+        upstream = http_client.build_request(
+            "POST", replica.url + path, content=body, headers=headers
+        )
+        replica.in_flight += 1
+        try:
+            response = await http_client.send(upstream, stream=True)
+        except httpx.TransportError:
+            replica.in_flight -= 1
+            router.mark_failed(replica)
+            continue
+        break
+
+    async def relay():
+        try:
+            async for chunk in response.aiter_raw():
+                yield chunk
+        finally:
+            await response.aclose()
+            replica.in_flight -= 1
+
+    response_headers = {
+        k: v for k, v in response.headers.items() if k.lower() not in HOP_HEADERS
+    }
+    response_headers["x-replica"] = replica.url
+    return StreamingResponse(
+        relay(), status_code=response.status_code, headers=response_headers
+    )
+
+
+@app.api_route("/v1/images", methods=["POST"])
+@app.api_route("/v1/images/{image_id}", methods=["HEAD"])
+async def images(request: Request):
+    """
+    Forwards image uploads (see image_registry.py). Uploaded images live on one replica,
+    so clients must send the same X-Session-ID as with their completions and the router
+    must use session affinity.
+    """
+    replica = router.choose(request.headers.get(SESSION_HEADER))
+    if replica is None:
+        raise HTTPException(status_code=503, detail="No healthy replica")
+    headers = {k: v for k, v in request.headers.items() if k not in HOP_HEADERS}
+    try:
+        response = await http_client.request(
+            request.method, replica.url + request.url.path, content=await request.body(), headers=headers
+        )
+    except httpx.TransportError:
+        router.mark_failed(replica)
+        raise HTTPException(status_code=503, detail="Replica unavailable")
+    return Response(
+        response.content,
+        status_code=response.status_code,
+        media_type=response.headers.get("content-type"),
+        headers={"x-replica": replica.url},
+    )
+
+
+def spawn_replicas(args) -> List[Replica]:
+    """Starts one `openai_demo.py` process per device on consecutive ports."""
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)), "openai_demo.py")
+    devices = args.devices.split(",") if args.devices else [""]
+    replica_args = shlex.split(args.replica_args)
+    if not args.devices and not any(a == "--backend" or a.startswith("--backend=") for a in replica_args):
+        # Without GPUs the default backend would load fp16 weights onto the CPU
+        replica_args += ["--backend", "cpu"]
+    replicas = []
+    for i in range(args.spawn):
+        port = args.base_port + i
+        env = dict(os.environ, CUDA_VISIBLE_DEVICES=devices[i % len(devices)])
+        command = [
+            sys.executable,
+            server,
+            "--model_path",
+            args.model_path,
+            "--host",
+            "127.0.0.1",
+            "--port",
+            str(port),
+        ] + replica_args
+        print(f"Spawning replica {i} on port {port}: CUDA_VISIBLE_DEVICES={env['CUDA_VISIBLE_DEVICES']!r}")
+        process = subprocess.Popen(command, env=env)
+        replicas.append(Replica(f"http://127.0.0.1:{port}", process))
+    return replicas
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Router for CogAgent OpenAI replicas")
+    parser.add_argument("--host", default="0.0.0.0", help="Host to run the router on")
+    parser.add_argument("--port", type=int, default=7870, help="Port to run the router on")
+    parser.add_argument(
+        "--replicas", default="", help="Comma separated base URLs of running replicas"
+    )
+    parser.add_argument(
+        "--spawn", type=int, default=0, help="Number of local replicas to start"
+    )
+    parser.add_argument(
+        "--devices",
+        default="0",
+        help='Comma separated CUDA devices for spawned replicas ("" runs them on CPU with --backend cpu)',
+    )
+    parser.add_argument("--model_path", help="Model path passed to spawned replicas")
+    parser.add_argument(
+        "--base_port", type=int, default=8100, help="First port used by spawned replicas"
+    )
+    parser.add_argument(
+        "--replica_args", default="", help="Extra arguments for spawned replicas"
+    )
+    parser.add_argument(
+        "--policy",
+        choices=["least_loaded", "session_affinity"],
+        default="session_affinity",
+        help="Routing policy; session affinity falls back to least loaded without a session id",
+    )
+    parser.add_argument(
+        "--health_interval", type=float, default=5.0, help="Seconds between health checks"
+    )
+    args = parser.parse_args()
+
+    replicas = [Replica(url) for url in args.replicas.split(",") if url]
+    if args.spawn:
+        if not args.model_path:
+            parser.error("--model_path is required with --spawn")
+        replicas += spawn_replicas(args)
+    if not replicas:
+        parser.error("Specify --replicas and/or --spawn")
+
+    router = Router(replicas, policy=args.policy, health_interval=args.health_interval)
+    uvicorn.run(app, host=args.host, port=args.port, workers=1)
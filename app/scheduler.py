@@ -0,0 +1,373 @@
+"""
+Admission control for generation requests based on KV cache memory.
+
+Every request reserves KV cache space for its prompt plus its output budget
+(`max_new_tokens`) before it starts, and releases it when it finishes. Requests wait
+while the reservations of running requests would exceed the capacity, so right-sized
+budgets (see token_budget.py) admit more concurrent requests than a fixed worst case.
+
+Waiting requests are ordered by priority class (interactive, normal, batch) and, within
+a class, by start-time fair queueing over tenants, weighted per tenant and charged by
+reserved tokens. Each class has a queue length limit (QueueFullError) and a queue
+timeout (TimeoutError). With preemption, running requests of a lower class pause between
+decoding steps while a higher class is decoding, and are preempted (asked to stop and
+release their memory) when a waiting higher class request does not fit.
+"""
+
+import itertools
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Optional
+
+import torch
+
+# Priority classes, highest first
+PRIORITIES = ["interactive", "normal", "batch"]
+DEFAULT_PRIORITY = "normal"
+DEFAULT_TENANT = "default"
+# Waiting requests per class, and seconds a request of the class may wait
+DEFAULT_MAX_QUEUE = {"interactive": 64, "normal": 64, "batch": 256}
+DEFAULT_QUEUE_TIMEOUTS = {"interactive": 30.0, "normal": 120.0, "batch": 600.0}
+
+
+def kv_bytes_per_token(config, dtype: torch.dtype) -> int:
+    """
+    Size of the keys and values of one token over all layers, from a model config.
+    Understands GLM-style (num_layers, multi_query_group_num, kv_channels) and
+    Llama-style (num_hidden_layers, num_key_value_heads, head_dim) names.
+    """
+    layers = getattr(config, "num_layers", None) or config.num_hidden_layers
+    heads = (
+        getattr(config, "multi_query_group_num", None)
+        or getattr(config, "num_key_value_heads", None)
+        or config.num_attention_heads
+    )
+    head_dim = (
+        getattr(config, "kv_channels", None)
+        or getattr(config, "head_dim", None)
+        or config.hidden_size // config.num_attention_heads
+    )
+    element_size = torch.tensor([], dtype=dtype).element_size()
+    return 2 * layers * heads * head_dim * element_size
+
+
+def image_token_count(config) -> int:
+    """
+    Number of positions an image occupies in the KV cache. GLM-4v expands the image
+    placeholder to (image_size / patch_size / 2)^2 patches plus begin/end tokens.
+    """
+    vision_config = getattr(config, "vision_config", None)
+    if not vision_config:
+        return 0
+    if not isinstance(vision_config, dict):
+        vision_config = vision_config.to_dict()
+    image_size, patch_size = vision_config.get("image_size"), vision_config.get("patch_size")
+    if not image_size or not patch_size:
+        return 0
+    return (image_size // patch_size // 2) ** 2 + 2
+
+
+def capacity_from_memory(
+    config, dtype: torch.dtype, fraction: float = 0.9, free_bytes: Optional[int] = None
+) -> Optional[int]:
+    """
+    KV capacity in tokens from `free_bytes` (see memory.MemoryMonitor) or the free memory
+    of the current CUDA device, measured after the weights are loaded. Returns None (no
+    limit) without either.
+    """
+    if free_bytes is None:
+        if not torch.cuda.is_available():
+            return None
+        free_bytes, _ = torch.cuda.mem_get_info()
+    return int(free_bytes * fraction) // kv_bytes_per_token(config, dtype)
+
+
+def parse_class_values(spec: str, cast=float) -> Dict[str, float]:
+    """Parses "interactive=30,batch=600" into {"interactive": 30.0, "batch": 600.0}."""
+    values = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        key, _, value = item.partition("=")
+        if not value:
+            raise ValueError(f"Expected key=value, got {item}")
+        values[key.strip()] = cast(value)
+    return values
+
+
+class QueueFullError(RuntimeError):
+    """Raised when the queue of a priority class is full."""
+
+
+class Reservation:
+    """
+    KV memory of one request, waiting or admitted.
+
+    `preempted` is set when a waiting request of a higher class needs the memory; the
+    holder stops generating and calls `KVScheduler.readmit` to continue later.
+    """
+
+    def __init__(
+        self,
+        scheduler: "KVScheduler",
+        tokens: int,
+        priority: str,
+        tenant: str,
+        memory: Optional[Dict[str, int]] = None,
+    ):
+        self.scheduler = scheduler
+        self.tokens = tokens
+        # Estimated bytes by kind (see memory.request_memory), for metrics
+        self.memory = memory or {}
+        self.priority = priority
+        self.rank = PRIORITIES.index(priority)
+        self.tenant = tenant
+        self.preempted = False
+        self.cancelled = False
+        # Virtual start time and arrival order, kept when the request is readmitted
+        self.tag = 0.0
+        self.sequence = 0
+
+    def checkpoint(self) -> bool:
+        """Called between decoding steps; True when generation must stop."""
+        return self.scheduler.checkpoint(self)
+
+
+class KVScheduler:
+    """
+    Token-based reservation of KV cache memory with priority classes and tenant fairness.
+
+    Args:
+        capacity_tokens(int, optional): Total tokens that may be reserved at once; None
+            admits every request immediately.
+        max_queue(dict, optional): Max waiting requests per class (missing: unlimited).
+        queue_timeouts(dict, optional): Seconds a request of a class may wait (missing:
+            no limit).
+        tenant_weights(dict, optional): Share of each tenant within a class (default 1).
+        preemption(bool): Pause and preempt lower classes for higher ones.
+    """
+
+    def __init__(
+        self,
+        capacity_tokens: Optional[int] = None,
+        max_queue: Optional[Dict[str, int]] = None,
+        queue_timeouts: Optional[Dict[str, float]] = None,
+        tenant_weights: Optional[Dict[str, float]] = None,
+        preemption: bool = True,
+    ):
+        self.capacity_tokens = capacity_tokens
+        self.max_queue = dict(DEFAULT_MAX_QUEUE if max_queue is None else max_queue)
+        self.queue_timeouts = dict(DEFAULT_QUEUE_TIMEOUTS if queue_timeouts is None else queue_timeouts)
+        self.tenant_weights = dict(tenant_weights or {})
+        self.preemption = preemption
+        self.reserved = 0
+        self.preemptions = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self._running: List[Reservation] = []
+        self._waiting: List[Reservation] = []
+        self._virtual_time = 0.0
+        self._tenant_finish: Dict[str, float] = {}
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def _fits(self, tokens: int) -> bool:
+        # A request larger than the capacity still runs alone rather than waiting forever
+        return (
+            self.capacity_tokens is None
+            or self.reserved + tokens <= self.capacity_tokens
+            or not self._running
+        )
+
+    def _head(self) -> Reservation:
+        return min(self._waiting, key=lambda r: (r.rank, r.tag, r.sequence))
+
+    def _enqueue(self, reservation: Reservation):
+        weight = self.tenant_weights.get(reservation.tenant, 1.0)
+        start = max(self._virtual_time, self._tenant_finish.get(reservation.tenant, 0.0))
+        reservation.tag = start
+        reservation.sequence = next(self._sequence)
+        self._tenant_finish[reservation.tenant] = start + reservation.tokens / weight
+        self._waiting.append(reservation)
+
+    def _try_admit(self, reservation: Reservation) -> bool:
+        """Admits the reservation if it is the head of the queue and fits."""
+        if self._head() is not reservation:
+            return False
+        if not self._fits(reservation.tokens):
+            if self.preemption:
+                self._preempt_for(reservation)
+            return False
+        self._waiting.remove(reservation)
+        self._running.append(reservation)
+        self.reserved += reservation.tokens
+        self._virtual_time = max(self._virtual_time, reservation.tag)
+        if len(self._tenant_finish) > 1024:
+            self._tenant_finish = {
+                tenant: finish
+                for tenant, finish in self._tenant_finish.items()
+                if finish > self._virtual_time
+            }
+        # The next waiter may fit as well
+        self._condition.notify_all()
+        return True
+
+    def _preempt_for(self, reservation: Reservation):
+        """Preempts the most recently admitted lower class requests until `reservation` fits."""
+        stopping = [r for r in self._running if r.preempted]
+        free = self.capacity_tokens - self.reserved + sum(r.tokens for r in stopping)
+        victims = []
+        for running in reversed(self._running):
+            if free >= reservation.tokens:
+                break
+            if not running.preempted and running.rank > reservation.rank:
+                victims.append(running)
+                free += running.tokens
+        # Only preempt when it makes room (or empties the server for an oversized request)
+        if victims and (
+            free >= reservation.tokens or len(victims) + len(stopping) == len(self._running)
+        ):
+            for victim in victims:
+                victim.preempted = True
+            self.preemptions += len(victims)
+            self._condition.notify_all()
+
+    def _wait(self, reservation: Reservation, timeout: Optional[float]):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not self._try_admit(reservation):
+            remaining = None if deadline is None else deadline - time.monotonic()
+            if remaining is not None and remaining <= 0:
+                self._waiting.remove(reservation)
+                self.timeouts += 1
+                self._condition.notify_all()
+                raise TimeoutError(
+                    f"Could not reserve {reservation.tokens} KV tokens for a "
+                    f"{reservation.priority} request within {timeout}s"
+                )
+            self._condition.wait(remaining)
+
+    def acquire(
+        self,
+        tokens: int,
+        priority: str = DEFAULT_PRIORITY,
+        tenant: str = DEFAULT_TENANT,
+        timeout: Optional[float] = None,
+        memory: Optional[Dict[str, int]] = None,
+    ) -> Reservation:
+        """
+        Blocks until `tokens` can be reserved. `timeout` defaults to the queue timeout of
+        the class. Raises QueueFullError when the class queue is full and TimeoutError
+        when the timeout passes first.
+        """
+        if priority not in PRIORITIES:
+            raise ValueError(f"Unknown priority {priority}. Available priorities: {PRIORITIES}")
+        if timeout is None:
+            timeout = self.queue_timeouts.get(priority)
+        reservation = Reservation(self, tokens, priority, tenant, memory)
+        with self._condition:
+            limit = self.max_queue.get(priority)
+            if limit is not None and sum(r.priority == priority for r in self._waiting) >= limit:
+                self.rejected += 1
+                raise QueueFullError(f"Queue of {priority} requests is full ({limit} waiting)")
+            self._enqueue(reservation)
+            self._wait(reservation, timeout)
+        return reservation
+
+    def max_waiting(self) -> Optional[int]:
+        """Most requests that can wait at once over all classes; None when a class has no limit."""
+        if any(self.max_queue.get(priority) is None for priority in PRIORITIES):
+            return None
+        return sum(self.max_queue[priority] for priority in PRIORITIES)
+
+    def release(self, reservation: Reservation):
+        with self._condition:
+            if reservation in self._running:
+                self._running.remove(reservation)
+                self.reserved -= reservation.tokens
+            elif reservation in self._waiting:
+                self._waiting.remove(reservation)
+            self._condition.notify_all()
+
+    def readmit(self, reservation: Reservation):
+        """
+        Releases the memory of a preempted request and waits until it can continue. The
+        request keeps its place in the fair queue and has no queue timeout.
+        """
+        with self._condition:
+            self._running.remove(reservation)
+            self.reserved -= reservation.tokens
+            reservation.preempted = False
+            self._waiting.append(reservation)
+            self._condition.notify_all()
+            self._wait(reservation, None)
+
+    def shrink_capacity(self, factor: float = 0.9) -> Optional[int]:
+        """
+        Called after an out-of-memory error: what was reserved did not fit, so the
+        capacity drops below it.
+        """
+        with self._condition:
+            if self.reserved:
+                limit = int(self.reserved * factor)
+                if self.capacity_tokens is None or limit < self.capacity_tokens:
+                    self.capacity_tokens = limit
+            return self.capacity_tokens
+
+    def cancel(self, reservation: Reservation):
+        """Stops the generation of a request whose client is gone at its next checkpoint."""
+        with self._condition:
+            reservation.cancelled = True
+            self._condition.notify_all()
+
+    def _outranked(self, reservation: Reservation) -> bool:
+        return self.preemption and any(r.rank < reservation.rank for r in self._running)
+
+    def checkpoint(self, reservation: Reservation) -> bool:
+        """
+        Waits while a higher class is decoding, so that it gets the whole GPU, and
+        returns True once the request is preempted or cancelled.
+        """
+        with self._condition:
+            while not (reservation.preempted or reservation.cancelled) and self._outranked(reservation):
+                self._condition.wait()
+            return reservation.preempted or reservation.cancelled
+
+    @contextmanager
+    def reserve(
+        self,
+        tokens: int,
+        timeout: Optional[float] = None,
+        priority: str = DEFAULT_PRIORITY,
+        tenant: str = DEFAULT_TENANT,
+        memory: Optional[Dict[str, int]] = None,
+    ):
+        """Reserves `tokens` (see `acquire`) and releases them on exit."""
+        reservation = self.acquire(tokens, priority, tenant, timeout, memory)
+        try:
+            yield reservation
+        finally:
+            self.release(reservation)
+
+    def stats(self) -> dict:
+        with self._condition:
+            classes = {
+                priority: {
+                    "running": sum(r.priority == priority for r in self._running),
+                    "waiting": sum(r.priority == priority for r in self._waiting),
+                }
+                for priority in PRIORITIES
+            }
+            memory = {}
+            for reservation in self._running:
+                for kind, size in reservation.memory.items():
+                    memory[kind] = memory.get(kind, 0) + size
+            return {
+                "capacity_tokens": self.capacity_tokens,
+                "reserved_tokens": self.reserved,
+                "running": len(self._running),
+                "waiting": len(self._waiting),
+                "classes": classes,
+                "preemptions": self.preemptions,
+                "rejected": self.rejected,
+                "timeouts": self.timeouts,
+                "memory_bytes": memory,
+            }
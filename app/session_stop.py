@@ -0,0 +1,38 @@
+"""
+Per-session stop flags shared by the web UIs (Flask and ASGI versions).
+
+Each running workflow or generation registers an event under its session id; `/stop`
+sets only the event of the session that asked, so one user's Stop does not end the
+streams of other sessions, and starting a stream never clears another session's flag.
+"""
+
+import threading
+from typing import Dict, Optional
+
+
+class SessionStops:
+    def __init__(self):
+        self._events: Dict[str, threading.Event] = {}
+        self._lock = threading.Lock()
+
+    def start(self, session_id: str) -> threading.Event:
+        """New flag for a stream of `session_id`; replaces the flag of an earlier stream."""
+        event = threading.Event()
+        with self._lock:
+            self._events[session_id] = event
+        return event
+
+    def stop(self, session_id: Optional[str]) -> bool:
+        """Sets the flag of the running stream of `session_id`; False when there is none."""
+        with self._lock:
+            event = self._events.get(session_id)
+        if event is None:
+            return False
+        event.set()
+        return True
+
+    def finish(self, session_id: str, event: threading.Event):
+        """Unregisters `event` once its stream has ended."""
+        with self._lock:
+            if self._events.get(session_id) is event:
+                del self._events[session_id]
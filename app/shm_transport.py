@@ -0,0 +1,154 @@
+"""
+Shared-memory screenshot transport for a client and `openai_demo.py` on the same host.
+
+The client writes raw RGB frames into a ring of slots in a POSIX shared-memory segment and
+sends only a handle `shm://<segment>/<slot>/<sequence>` as the image URL. The server maps
+the slot into a PIL image without copying (`Image.frombuffer`), skipping PNG encoding,
+base64 and decoding entirely.
+
+Every slot has a sequence counter used as a seqlock: it is odd while the client writes and
+even afterwards. A handle is valid only while the slot still holds its sequence, so the
+server can detect a frame that was overwritten before it finished reading it.
+
+Slot layout: header (sequence u64, width u32, height u32) followed by width*height*3 bytes.
+"""
+
+import os
+import struct
+import threading
+from multiprocessing import shared_memory
+from typing import Dict, Tuple
+
+from PIL import Image
+
+SHM_URL_PREFIX = "shm://"
+# Only segments with this prefix are attached by the server
+SEGMENT_PREFIX = "cogagent_"
+
+_MAGIC = b"CGSHM001"
+# magic, number of slots, bytes per slot
+_SEGMENT_HEADER = struct.Struct("<8sII")
+_SLOT_HEADER = struct.Struct("<QII")
+
+
+def _slot_offset(slot: int, slot_bytes: int) -> int:
+    return _SEGMENT_HEADER.size + slot * (_SLOT_HEADER.size + slot_bytes)
+
+
+def parse_handle(url: str) -> Tuple[str, int, int]:
+    """(segment, slot, sequence) of a handle; ValueError for anything malformed."""
+    parts = url[len(SHM_URL_PREFIX) :].split("/")
+    if not url.startswith(SHM_URL_PREFIX) or len(parts) != 3:
+        raise ValueError(f"Malformed shared-memory handle {url}")
+    name, slot, sequence = parts
+    return name, int(slot), int(sequence)
+
+
+class ShmWriter:
+    """
+    Client side: owns the segment and writes frames round-robin.
+
+    Args:
+        slots(int): Number of frames kept; a frame stays readable until `slots` newer
+            frames have been written.
+        max_pixels(int): Largest frame (width * height) that fits into a slot.
+        name(str, optional): Segment name, unique per client process by default.
+    """
+
+    def __init__(self, slots: int = 4, max_pixels: int = 3840 * 2160, name: str = None):
+        self.slots = slots
+        self.slot_bytes = max_pixels * 3
+        self.name = name or f"{SEGMENT_PREFIX}{os.getpid()}"
+        size = _slot_offset(slots, self.slot_bytes)
+        self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        _SEGMENT_HEADER.pack_into(self.shm.buf, 0, _MAGIC, slots, self.slot_bytes)
+        for slot in range(slots):
+            _SLOT_HEADER.pack_into(self.shm.buf, _slot_offset(slot, self.slot_bytes), 0, 0, 0)
+        self.next_slot = 0
+        self._lock = threading.Lock()
+
+    def write(self, image: Image.Image) -> str:
+        """Copies the frame into the next slot and returns its handle."""
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        data = image.tobytes()
+        if len(data) > self.slot_bytes:
+            raise ValueError(f"Frame of {image.size} does not fit into a shared-memory slot")
+        with self._lock:
+            slot = self.next_slot
+            self.next_slot = (slot + 1) % self.slots
+            offset = _slot_offset(slot, self.slot_bytes)
+            sequence = _SLOT_HEADER.unpack_from(self.shm.buf, offset)[0]
+            # Odd while writing
+            _SLOT_HEADER.pack_into(self.shm.buf, offset, sequence + 1, *image.size)
+            start = offset + _SLOT_HEADER.size
+            self.shm.buf[start : start + len(data)] = data
+            sequence += 2
+            _SLOT_HEADER.pack_into(self.shm.buf, offset, sequence, *image.size)
+        return f"{SHM_URL_PREFIX}{self.name}/{slot}/{sequence}"
+
+    def close(self):
+        self.shm.close()
+        self.shm.unlink()
+
+
+class ShmReader:
+    """Server side: attaches segments by name and maps frames without copying."""
+
+    def __init__(self):
+        # Segment, number of slots and bytes per slot by name
+        self._segments: Dict[str, Tuple[shared_memory.SharedMemory, int, int]] = {}
+        self._lock = threading.Lock()
+
+    def _attach(self, name: str) -> Tuple[shared_memory.SharedMemory, int, int]:
+        if not name.startswith(SEGMENT_PREFIX) or "/" in name:
+            raise ValueError(f"Shared-memory segment {name} is not allowed")
+        with self._lock:
+            if name not in self._segments:
+                shm = shared_memory.SharedMemory(name=name)
+                try:
+                    # The client owns the segment; do not unlink it when the server exits
+                    from multiprocessing import resource_tracker
+
+                    resource_tracker.unregister(shm._name, "shared_memory")
+                except Exception:
+                    pass
+                if shm.size < _SEGMENT_HEADER.size:
+                    shm.close()
+                    raise ValueError(f"Shared-memory segment {name} is not a frame ring")
+                magic, slots, slot_bytes = _SEGMENT_HEADER.unpack_from(shm.buf, 0)
+                if magic != _MAGIC or shm.size < _slot_offset(slots, slot_bytes):
+                    shm.close()
+                    raise ValueError(f"Shared-memory segment {name} is not a frame ring")
+                self._segments[name] = shm, slots, slot_bytes
+            return self._segments[name]
+
+    def _slot(self, url: str) -> Tuple[shared_memory.SharedMemory, int, int, int]:
+        """(segment, slot offset, bytes per slot, sequence) of a handle, checked against the segment."""
+        name, slot, sequence = parse_handle(url)
+        shm, slots, slot_bytes = self._attach(name)
+        if not 0 <= slot < slots:
+            raise ValueError(f"Shared-memory handle {url} has no slot {slot}")
+        return shm, _slot_offset(slot, slot_bytes), slot_bytes, sequence
+
+    def read(self, url: str) -> Image.Image:
+        """
+        Returns the frame of a handle as an image backed by the shared memory. The handle
+        is stored in `image.info["shm_handle"]` so that `valid` can be checked after use.
+        """
+        shm, offset, slot_bytes, sequence = self._slot(url)
+        current, width, height = _SLOT_HEADER.unpack_from(shm.buf, offset)
+        if current != sequence:
+            raise ValueError(f"Shared-memory frame {url} was overwritten")
+        if not 0 < width * height * 3 <= slot_bytes:
+            raise ValueError(f"Shared-memory frame {url} of {width}x{height} does not fit into its slot")
+        start = offset + _SLOT_HEADER.size
+        view = shm.buf[start : start + width * height * 3]
+        image = Image.frombuffer("RGB", (width, height), view, "raw", "RGB", 0, 1)
+        image.info["shm_handle"] = url
+        return image
+
+    def valid(self, url: str) -> bool:
+        """True while the slot of the handle has not been rewritten."""
+        shm, offset, _, sequence = self._slot(url)
+        return _SLOT_HEADER.unpack_from(shm.buf, offset)[0] == sequence
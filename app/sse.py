@@ -0,0 +1,114 @@
+"""
+Helpers for Server-Sent Events streaming shared by the OpenAI server and the web UIs.
+
+- `dumps` uses orjson when it is installed and falls back to a compact `json.dumps`.
+- `coalesce` batches streamed text pieces so that one frame carries several tokens;
+  `acoalesce` does the same for async iterables (ASGI web UIs).
+- `ChunkTemplate` pre-serializes the fixed fields of `chat.completion.chunk` responses,
+  so only the delta text has to be encoded for each frame.
+"""
+
+import json
+import time
+from typing import Any, AsyncIterable, AsyncIterator, Iterable, Iterator
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj: Any) -> str:
+    """Serialize `obj` to a compact JSON string."""
+    if orjson is not None:
+        return orjson.dumps(obj).decode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":"))
+
+
+def event(obj: Any) -> str:
+    """Frame `obj` as a single SSE `data:` event."""
+    return f"data: {dumps(obj)}\n\n"
+
+
+def coalesce(
+    pieces: Iterable[str], max_tokens: int = 8, max_interval_ms: float = 40.0
+) -> Iterator[str]:
+    """
+    Join consecutive text pieces and yield them once `max_tokens` pieces have been
+    buffered or `max_interval_ms` has elapsed since the last flush. The first piece
+    is always flushed immediately so the time to first token is not affected.
+
+    The interval is checked when a piece arrives, so a buffered piece waits at most
+    one token interval longer than the configured flush interval.
+    """
+    max_interval = max_interval_ms / 1000
+    buffer = []
+    first = True
+    last_flush = time.monotonic()
+    for piece in pieces:
+        if not piece:
+            continue
+        buffer.append(piece)
+        now = time.monotonic()
+        if first or len(buffer) >= max_tokens or now - last_flush >= max_interval:
+            yield "".join(buffer)
+            buffer.clear()
+            first = False
+            last_flush = now
+    if buffer:
+        yield "".join(buffer)
+
+
+async def acoalesce(
+    pieces: AsyncIterable[str], max_tokens: int = 8, max_interval_ms: float = 40.0
+) -> AsyncIterator[str]:
+    """`coalesce` for an async iterable of text pieces."""
+    max_interval = max_interval_ms / 1000
+    buffer = []
+    first = True
+    last_flush = time.monotonic()
+    async for piece in pieces:
+        if not piece:
+            continue
+        buffer.append(piece)
+        now = time.monotonic()
+        if first or len(buffer) >= max_tokens or now - last_flush >= max_interval:
+            yield "".join(buffer)
+            buffer.clear()
+            first = False
+            last_flush = now
+    if buffer:
+        yield "".join(buffer)
+
+
+class ChunkTemplate:
+    """
+    Pre-serialized `chat.completion.chunk` frames for one model id.
+
+    The output matches `ChatCompletionResponse.model_dump_json(exclude_unset=True)`
+    for the role, content and end-of-stream chunks of a single choice.
+    """
+
+    def __init__(self, model_id: str):
+        head = '{"model":%s,"object":"chat.completion.chunk","choices":[{"index":0,"delta":' % (
+            dumps(model_id)
+        )
+        self._content_prefix = head + '{"role":"assistant","content":'
+        self._role = head + '{"role":"assistant"}}]}'
+        self._end = head + "{}}]}"
+        self._usage_prefix = '{"model":%s,"object":"chat.completion.chunk","choices":[],"usage":' % (
+            dumps(model_id)
+        )
+
+    def role(self) -> str:
+        return self._role
+
+    def content(self, text: str) -> str:
+        return self._content_prefix + dumps(text) + "}}]}"
+
+    def end(self) -> str:
+        return self._end
+
+    def usage(self, usage: dict) -> str:
+        """Final chunk with token usage and no choices (`stream_options.include_usage`)."""
+        return self._usage_prefix + dumps(usage) + "}"
@@ -0,0 +1,56 @@
+"""
+Output token budgets for CogAgent answers.
+
+The answer length depends on the prompt format: an Action-Operation answer is one action
+sentence plus one grounded operation, while Status-Plan-... formats add a status and a plan.
+Budgets are the number of new tokens to generate (not the total sequence length) and leave
+headroom over typical answers; they are used as the default `max_tokens` by the clients and
+by `openai_demo.py` when a request does not set one, so that KV memory is reserved for the
+expected answer instead of a fixed 1024/4096 tokens.
+"""
+
+import re
+from typing import Optional
+
+# Prompt format keys as used by `inference/webui/app.py --format_key`
+FORMAT_BUDGETS = {
+    "action_op": 192,
+    "action_op_sensitive": 224,
+    "status_action_op": 320,
+    "status_action_op_sensitive": 352,
+    "status_plan_action_op": 512,
+    "status_plan_action_op_sensitive": 576,
+}
+
+DEFAULT_BUDGET = 512
+
+# Each further Action/Grounded Operation pair of a multi-operation answer
+STEP_BUDGET = 96
+
+_FORMAT_PATTERN = re.compile(r"Answer in ([A-Za-z-]+) format")
+_FORMAT_WORDS = {"operation": "op"}
+
+
+def format_key(text: str) -> Optional[str]:
+    """
+    Returns the format key of a prompt or format string,
+    e.g. "(Answer in Status-Plan-Action-Operation format.)" -> "status_plan_action_op".
+    """
+    match = _FORMAT_PATTERN.search(text)
+    if not match:
+        return None
+    words = [word.lower() for word in match.group(1).split("-")]
+    return "_".join(_FORMAT_WORDS.get(word, word) for word in words)
+
+
+def budget_for_format(text_or_key: Optional[str], default: int = DEFAULT_BUDGET, steps: int = 1) -> int:
+    """
+    Max new tokens for a format key, a format string or a whole prompt, whose answer
+    holds up to `steps` operations.
+    """
+    extra = STEP_BUDGET * max(steps - 1, 0)
+    if not text_or_key:
+        return default + extra
+    if text_or_key in FORMAT_BUDGETS:
+        return FORMAT_BUDGETS[text_or_key] + extra
+    return FORMAT_BUDGETS.get(format_key(text_or_key), default) + extra
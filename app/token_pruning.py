@@ -0,0 +1,154 @@
+"""
+Vision token pruning for screenshots: drops (or merges) the image tokens of flat,
+low-information regions before they reach the language model.
+
+The CogAgent vision tower turns a 1120x1120 image into a 40x40 grid of tokens (one per
+28x28 pixel block) framed by begin/end-of-image tokens, and the language model prefills
+all 1600 of them. `VisionTokenPruner` hooks the output of the vision tower, scores every
+token by the pixel variance of its block in the preprocessed image (computed with one
+pooling pass on the device), and keeps the highest scoring tokens in raster order.
+
+All image tokens share one rotary position in GLM-4v, so dropping some of them leaves the
+positions of the text intact. The language model derives the number of image tokens from
+`config.vision_config["image_size"]`, so the kept count is a square (m*m tokens for a
+virtual image size of m*28) and the config is updated accordingly; every image of a batch
+keeps the same number of tokens.
+
+Modes:
+    drop   low-variance tokens are removed
+    merge  each removed token is averaged into the kept token before it in raster order,
+           so that its content is not lost entirely
+"""
+
+import json
+import math
+from pathlib import Path
+from typing import Optional
+
+import torch
+import torch.nn.functional as F
+
+PRUNING_MODES = ["drop", "merge"]
+
+
+def kept_grid(grid: int, ratio: float) -> int:
+    """Side of the square token grid kept when dropping `ratio` of `grid * grid` tokens."""
+    return max(1, min(grid, round(grid * math.sqrt(1.0 - ratio))))
+
+
+def token_scores(images: torch.Tensor, block: int) -> torch.Tensor:
+    """
+    Pixel variance of each `block` x `block` region, summed over channels: (B, tokens)
+    in the raster order of the vision tower's grid.
+    """
+    images = images.float()
+    mean = F.avg_pool2d(images, block)
+    mean_of_squares = F.avg_pool2d(images * images, block)
+    return (mean_of_squares - mean * mean).sum(dim=1).flatten(1)
+
+
+def prune_tokens(features: torch.Tensor, scores: torch.Tensor, keep: int, mode: str = "drop") -> torch.Tensor:
+    """
+    Keeps the `keep` highest scoring tokens of `features` (B, tokens, hidden) in their
+    original order; with "merge" every dropped token is averaged into the preceding kept one.
+    """
+    keep_index = scores.topk(keep, dim=1).indices.sort(dim=1).values
+    hidden = features.shape[-1]
+    if mode == "drop":
+        return features.gather(1, keep_index.unsqueeze(-1).expand(-1, -1, hidden))
+
+    positions = torch.arange(features.shape[1], device=features.device).expand(features.shape[0], -1)
+    owner = (torch.searchsorted(keep_index, positions.contiguous(), right=True) - 1).clamp_(min=0)
+    sums = torch.zeros(
+        features.shape[0], keep, hidden, dtype=torch.float32, device=features.device
+    ).scatter_add_(1, owner.unsqueeze(-1).expand(-1, -1, hidden), features.float())
+    counts = torch.zeros(features.shape[0], keep, device=features.device).scatter_add_(
+        1, owner, torch.ones_like(owner, dtype=torch.float32)
+    )
+    return (sums / counts.unsqueeze(-1)).to(features.dtype)
+
+
+class VisionTokenPruner:
+    """
+    Forward hook on the vision tower of a GLM-4v/CogAgent model.
+
+    Args:
+        model: The loaded CogAgent model.
+        ratio(float): Fraction of image tokens dropped, 0 disables pruning.
+        mode(str): One of `PRUNING_MODES`.
+    """
+
+    def __init__(self, model, ratio: float = 0.0, mode: str = "drop"):
+        if mode not in PRUNING_MODES:
+            raise ValueError(f"Unknown pruning mode {mode}. Available modes: {PRUNING_MODES}")
+        transformer = getattr(model, "transformer", model)
+        self.vision = getattr(transformer, "vision", None)
+        if self.vision is None:
+            raise ValueError("Model has no vision tower to prune")
+        self.vision_config = model.config.vision_config
+        if not isinstance(self.vision_config, dict):
+            raise ValueError("Token pruning requires a GLM-4v style vision_config dict")
+        self.image_size = self.vision_config["image_size"]
+        self.patch_size = self.vision_config["patch_size"]
+        # Each token covers 2x2 patches after the vision tower's downsampling convolution
+        self.block = self.patch_size * 2
+        self.grid = self.image_size // self.block
+        self.mode = mode
+        self.ratio = 0.0
+        self.keep = self.grid * self.grid
+        self.tokens = 0
+        self.kept = 0
+        self._handle = self.vision.register_forward_hook(self._hook)
+        self.set_ratio(ratio)
+
+    def set_ratio(self, ratio: float):
+        """Changes the aggressiveness; the kept grid is rounded to a square."""
+        if not 0.0 <= ratio < 1.0:
+            raise ValueError("The pruning ratio must be in [0, 1)")
+        side = kept_grid(self.grid, ratio)
+        self.keep = side * side
+        self.ratio = 1.0 - self.keep / (self.grid * self.grid)
+        # The language model computes the number of image tokens from this size
+        self.vision_config["image_size"] = side * self.block
+
+    def _hook(self, module, inputs, output):
+        if self.keep == self.grid * self.grid:
+            return output
+        images = inputs[0]
+        scores = token_scores(images, self.block)
+        patches = prune_tokens(output[:, 1:-1], scores, self.keep, self.mode)
+        self.tokens += output.shape[0] * (output.shape[1] - 2)
+        self.kept += output.shape[0] * self.keep
+        return torch.cat([output[:, :1], patches, output[:, -1:]], dim=1)
+
+    def remove(self):
+        """Removes the hook and restores the original number of image tokens."""
+        self._handle.remove()
+        self.vision_config["image_size"] = self.image_size
+
+    def restore_saved_config(self, directory):
+        """
+        Writes the original image size into a config.json saved by `save_pretrained`
+        while the pruner was installed. The live config is left alone, requests in
+        flight read it.
+        """
+        path = Path(directory) / "config.json"
+        config = json.loads(path.read_text(encoding="utf-8"))
+        config["vision_config"]["image_size"] = self.image_size
+        path.write_text(json.dumps(config, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+
+    def stats(self) -> dict:
+        return {
+            "mode": self.mode,
+            "ratio": round(self.ratio, 4),
+            "kept_tokens": self.keep,
+            "tokens_seen": self.tokens,
+            "tokens_kept": self.kept,
+        }
+
+
+def install_pruner(model, ratio: float, mode: str = "drop") -> Optional[VisionTokenPruner]:
+    """Hooks a pruner into `model` when `ratio` > 0."""
+    if ratio <= 0:
+        return None
+    return VisionTokenPruner(model, ratio, mode)
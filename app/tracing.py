@@ -0,0 +1,139 @@
+"""
+Structured timing of agent workflows.
+
+A TraceRecorder collects spans (capture, encode, request, TTFT, parse, action, ...)
+for one session and writes them as Chrome trace JSON, which can be opened in
+chrome://tracing or https://ui.perfetto.dev to see a timeline of every round. When the
+server reports its phase timings (`openai_demo.py` adds them to the usage chunk), the
+client-observed TTFT is split into network, preprocessing, queueing and prefill time.
+"""
+
+import json
+import os
+import re
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+
+# Server phases and network time are drawn on their own row of the client process
+SERVER_TID = 0
+# Session ids come from clients; anything else is replaced in trace file names
+_UNSAFE_NAME = re.compile(r"[^A-Za-z0-9_-]")
+
+
+class TraceRecorder:
+    """
+    Records spans of one session.
+
+    Args:
+        session_id(str): Session the spans belong to; also the name of the trace file.
+        process_name(str): Name shown for the trace's process row.
+    """
+
+    def __init__(self, session_id: str, process_name: str = "CogAgent client"):
+        self.session_id = session_id
+        self.process_name = process_name
+        self.origin = time.perf_counter()
+        self.round = 0
+        self.events: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _now_us(self) -> float:
+        return (time.perf_counter() - self.origin) * 1e6
+
+    def add(self, name: str, start: float, end: float, cat: str = "client", tid: Optional[int] = None, **args):
+        """Adds a span measured with `time.perf_counter()` timestamps."""
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": (start - self.origin) * 1e6,
+            "dur": (end - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_ident() if tid is None else tid,
+            "args": dict(args, round=self.round),
+        }
+        with self._lock:
+            self.events.append(event)
+
+    @contextmanager
+    def span(self, name: str, cat: str = "client", **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.perf_counter(), cat, **args)
+
+    def instant(self, name: str, cat: str = "client", **args):
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "i",
+            "s": "t",
+            "ts": self._now_us(),
+            "pid": os.getpid(),
+            "tid": threading.get_ident(),
+            "args": dict(args, round=self.round),
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def add_completion(
+        self, start: float, first_token: float, end: float, chunks: int = 0, server: Optional[Dict[str, float]] = None
+    ):
+        """
+        Adds the spans of one streamed completion: TTFT and decoding as observed by the client
+        and, given the server's phase timings in milliseconds, the server phases and the rest of
+        the TTFT as network time. The clocks are not shared, so the server phases are placed
+        after half of the network time.
+        """
+        self.add("ttft", start, first_token, cat="model")
+        self.add("decode", first_token, end, cat="model", chunks=chunks)
+        if not server:
+            return
+        before_first_token = sum(ms for name, ms in server.items() if name != "decode") / 1000
+        half = max(first_token - start - before_first_token, 0) / 2
+        self.add("network", start, start + half, cat="network", tid=SERVER_TID)
+        mark = start + half
+        for name, ms in server.items():
+            if name == "decode":
+                self.add("network", mark, mark + half, cat="network", tid=SERVER_TID)
+                mark += half
+            self.add(f"server_{name}", mark, mark + ms / 1000, cat="server", tid=SERVER_TID)
+            mark += ms / 1000
+
+    def next_round(self, round_num: int):
+        self.round = round_num
+
+    def summary(self, round_num: Optional[int] = None) -> Dict[str, float]:
+        """Total milliseconds per span name, for one round or the whole session."""
+        totals = defaultdict(float)
+        with self._lock:
+            for event in self.events:
+                if event["ph"] != "X":
+                    continue
+                if round_num is not None and event["args"]["round"] != round_num:
+                    continue
+                totals[event["name"]] += event["dur"] / 1000
+        return {name: round(ms, 1) for name, ms in totals.items()}
+
+    def to_chrome(self) -> Dict[str, Any]:
+        metadata = {
+            "name": "process_name",
+            "ph": "M",
+            "pid": os.getpid(),
+            "args": {"name": f"{self.process_name} {self.session_id}"},
+        }
+        with self._lock:
+            events = [metadata] + list(self.events)
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def save(self, directory: str) -> str:
+        os.makedirs(directory, exist_ok=True)
+        name = _UNSAFE_NAME.sub("_", self.session_id)[:128] or "session"
+        path = os.path.join(directory, f"{name}.json")
+        with open(path, "w") as f:
+            json.dump(self.to_chrome(), f)
+        return path
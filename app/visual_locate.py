@@ -0,0 +1,275 @@
+"""
+Template matching on screenshots, used to find a known UI element (an icon or button image)
+on screen or to refine the box predicted by the model.
+
+Matching is normalized cross-correlation (the same score as OpenCV's TM_CCOEFF_NORMED) on
+grayscale NumPy arrays. The correlation is computed with FFTs and normalized with integral
+images, first on a downsampled pyramid level and then only in a small window around the
+candidate on each finer level, so a full-screen search costs a fraction of a pixel-by-pixel
+comparison. A region-of-interest hint (e.g. the model's box) restricts the search further.
+"""
+
+import hashlib
+import os
+import time
+from collections import OrderedDict
+from typing import Callable, List, NamedTuple, Optional, Sequence, Tuple, Union
+
+import numpy as np
+from PIL import Image
+
+ImageLike = Union[str, Image.Image, np.ndarray]
+
+# A pyramid level is only used while the template keeps at least this many pixels per side
+MIN_TEMPLATE_SIDE = 12
+
+
+class Match(NamedTuple):
+    """Location of a template in screenshot pixels."""
+
+    left: int
+    top: int
+    width: int
+    height: int
+    score: float
+
+    @property
+    def center(self) -> Tuple[float, float]:
+        return self.left + self.width / 2, self.top + self.height / 2
+
+    def to_box(self, size: Tuple[int, int]) -> List[int]:
+        """Converts the match to a box normalized to 0-1000 for a screenshot of `size`."""
+        width, height = size
+        return [
+            round(self.left / width * 1000),
+            round(self.top / height * 1000),
+            round((self.left + self.width) / width * 1000),
+            round((self.top + self.height) / height * 1000),
+        ]
+
+
+def to_gray(image: ImageLike) -> np.ndarray:
+    """Converts a path, PIL image or array to a float32 grayscale array."""
+    if isinstance(image, str):
+        image = Image.open(image)
+    if isinstance(image, Image.Image):
+        return np.asarray(image.convert("L"), dtype=np.float32)
+    array = np.asarray(image, dtype=np.float32)
+    if array.ndim == 3:
+        # ITU-R 601-2 luma, as PIL's "L" conversion
+        array = array[..., :3] @ np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    return array
+
+
+def downsample(array: np.ndarray) -> np.ndarray:
+    """Halves both sides by averaging 2x2 blocks."""
+    h, w = array.shape[0] // 2 * 2, array.shape[1] // 2 * 2
+    array = array[:h, :w]
+    return (array[0::2, 0::2] + array[1::2, 0::2] + array[0::2, 1::2] + array[1::2, 1::2]) * 0.25
+
+
+def build_pyramid(array: np.ndarray, levels: int) -> List[np.ndarray]:
+    pyramid = [array]
+    for _ in range(levels - 1):
+        pyramid.append(downsample(pyramid[-1]))
+    return pyramid
+
+
+def _window_sums(array: np.ndarray, th: int, tw: int) -> np.ndarray:
+    """Sum of every th x tw window, from an integral image."""
+    integral = np.zeros((array.shape[0] + 1, array.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(array, axis=0, dtype=np.float64), axis=1, out=integral[1:, 1:])
+    return integral[th:, tw:] - integral[:-th, tw:] - integral[th:, :-tw] + integral[:-th, :-tw]
+
+
+def match_template(image: np.ndarray, template: np.ndarray) -> np.ndarray:
+    """
+    Normalized cross-correlation of `template` at every position where it fits inside `image`.
+
+    Returns:
+        An array of shape (H - th + 1, W - tw + 1) with scores in [-1, 1]; flat windows score 0.
+    """
+    th, tw = template.shape
+    H, W = image.shape
+    if th > H or tw > W:
+        return np.zeros((0, 0), dtype=np.float32)
+
+    t = template.astype(np.float64) - template.mean()
+    t_norm = np.sqrt((t * t).sum())
+    if t_norm == 0:
+        return np.zeros((H - th + 1, W - tw + 1), dtype=np.float32)
+
+    # Correlation as a convolution with the flipped template; since t has zero mean,
+    # sum(I * t) equals sum((I - mean(I)) * t) for every window.
+    shape = (H + th - 1, W + tw - 1)
+    spectrum = np.fft.rfft2(image, shape) * np.fft.rfft2(t[::-1, ::-1], shape)
+    corr = np.fft.irfft2(spectrum, shape)[th - 1 : H, tw - 1 : W]
+
+    n = th * tw
+    sums = _window_sums(image, th, tw)
+    sq_sums = _window_sums(np.square(image, dtype=np.float64), th, tw)
+    variance = np.maximum(sq_sums - sums * sums / n, 0)
+    denominator = np.sqrt(variance) * t_norm
+    scores = np.zeros_like(corr)
+    np.divide(corr, denominator, out=scores, where=denominator > 1e-6 * t_norm)
+    return scores.astype(np.float32)
+
+
+class VisualLocator:
+    """
+    Finds templates on screenshots with a coarse-to-fine pyramid search.
+
+    Args:
+        threshold(float): Minimum score of a match.
+        levels(int): Maximum number of pyramid levels; fewer are used for small templates.
+        scales(Sequence[float]): Template scales to try, e.g. (1.0, 2.0) when templates were
+            captured on a normal display and the screenshot comes from a Retina display.
+        timeout(float): Default time `locate_on_screen` keeps polling for the template.
+        poll_interval(float): Pause between screenshots while polling.
+        cache_size(int): Number of prepared templates kept in memory.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.8,
+        levels: int = 4,
+        scales: Sequence[float] = (1.0,),
+        timeout: float = 0.0,
+        poll_interval: float = 0.2,
+        cache_size: int = 64,
+    ):
+        self.threshold = threshold
+        self.levels = levels
+        self.scales = tuple(scales)
+        self.timeout = timeout
+        self.poll_interval = poll_interval
+        self.cache_size = cache_size
+        self._templates = OrderedDict()
+
+    def _template_key(self, template: ImageLike):
+        if isinstance(template, str):
+            return template, os.path.getmtime(template)
+        array = to_gray(template)
+        return hashlib.blake2b(array.tobytes(), digest_size=16).hexdigest(), array.shape
+
+    def prepare(self, template: ImageLike) -> List[List[np.ndarray]]:
+        """Returns the template pyramids for every scale, from the cache when possible."""
+        key = self._template_key(template)
+        if key in self._templates:
+            self._templates.move_to_end(key)
+            return self._templates[key]
+
+        gray = to_gray(template)
+        pyramids = []
+        for scale in self.scales:
+            array = gray
+            if scale != 1.0:
+                size = (max(1, round(gray.shape[1] * scale)), max(1, round(gray.shape[0] * scale)))
+                array = np.asarray(
+                    Image.fromarray(gray).resize(size, Image.BILINEAR), dtype=np.float32
+                )
+            levels = 1
+            while levels < self.levels and min(array.shape) >> levels >= MIN_TEMPLATE_SIDE:
+                levels += 1
+            pyramids.append(build_pyramid(array, levels))
+
+        self._templates[key] = pyramids
+        if len(self._templates) > self.cache_size:
+            self._templates.popitem(last=False)
+        return pyramids
+
+    def _search(self, image_pyramid: List[np.ndarray], template_pyramid: List[np.ndarray]):
+        """Coarse-to-fine search; returns (x, y, score) on the full-resolution level."""
+        top = min(len(image_pyramid), len(template_pyramid)) - 1
+        scores = match_template(image_pyramid[top], template_pyramid[top])
+        if scores.size == 0:
+            return None
+        y, x = np.unravel_index(np.argmax(scores), scores.shape)
+        score = float(scores[y, x])
+
+        for level in range(top - 1, -1, -1):
+            image, template = image_pyramid[level], template_pyramid[level]
+            th, tw = template.shape
+            # The candidate moves by at most a couple of pixels per level
+            x0, y0 = max(0, 2 * x - 2), max(0, 2 * y - 2)
+            x1 = min(image.shape[1], 2 * x + 2 + tw + 1)
+            y1 = min(image.shape[0], 2 * y + 2 + th + 1)
+            scores = match_template(image[y0:y1, x0:x1], template)
+            if scores.size == 0:
+                return None
+            dy, dx = np.unravel_index(np.argmax(scores), scores.shape)
+            x, y, score = x0 + dx, y0 + dy, float(scores[dy, dx])
+        return int(x), int(y), score
+
+    def locate(
+        self,
+        template: ImageLike,
+        screenshot: ImageLike,
+        region: Optional[Sequence[int]] = None,
+        margin: float = 1.0,
+    ) -> Optional[Match]:
+        """
+        Finds the best match of `template` in `screenshot`.
+
+        Args:
+            template: Path, PIL image or array of the element to find.
+            screenshot: PIL image or array of the screen.
+            region(Sequence[int], optional): Box normalized to 0-1000 (e.g. the model's box)
+                around which to search.
+            margin(float): How far around `region` to search, in multiples of the template size.
+        Returns:
+            The match in screenshot pixels, or None when no position reaches the threshold.
+        """
+        image = to_gray(screenshot)
+        H, W = image.shape
+        x_offset = y_offset = 0
+        pyramids = self.prepare(template)
+
+        if region is not None:
+            th = max(p[0].shape[0] for p in pyramids)
+            tw = max(p[0].shape[1] for p in pyramids)
+            left = int(region[0] / 1000 * W - margin * tw)
+            top = int(region[1] / 1000 * H - margin * th)
+            right = int(region[2] / 1000 * W + margin * tw)
+            bottom = int(region[3] / 1000 * H + margin * th)
+            x_offset, y_offset = max(0, left), max(0, top)
+            image = image[y_offset : min(H, bottom), x_offset : min(W, right)]
+
+        image_pyramid = build_pyramid(image, max(len(p) for p in pyramids))
+        best = None
+        for template_pyramid in pyramids:
+            found = self._search(image_pyramid, template_pyramid)
+            if found is not None and (best is None or found[2] > best[0][2]):
+                best = found, template_pyramid[0].shape
+        if best is None or best[0][2] < self.threshold:
+            return None
+        (x, y, score), (th, tw) = best
+        return Match(x + x_offset, y + y_offset, tw, th, score)
+
+    def locate_on_screen(
+        self,
+        template: ImageLike,
+        grab: Callable[[], Image.Image],
+        region: Optional[Sequence[int]] = None,
+        timeout: Optional[float] = None,
+    ) -> Optional[Match]:
+        """
+        Takes screenshots with `grab` until the template is found or `timeout` expires;
+        a timeout of 0 tries exactly once.
+        """
+        timeout = self.timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while True:
+            match = self.locate(template, grab(), region)
+            if match is not None or time.monotonic() >= deadline:
+                return match
+            time.sleep(self.poll_interval)
+
+    def refine_box(
+        self, template: ImageLike, screenshot: Image.Image, box: Sequence[int]
+    ) -> Sequence[int]:
+        """Returns the matched box (0-1000) near the model's `box`, or `box` itself without a match."""
+        match = self.locate(template, screenshot, region=box)
+        if match is None:
+            return box
+        return match.to_box(screenshot.size)
@@ -8,15 +8,15 @@ CogAgent Client Web UI - Flask Version
 """
 
 import argparse
+import atexit
 import base64
+import httpx
 import platform
-import pyautogui
 import re
 import os
-import json
-import threading
 import time
 import uuid
+from io import BytesIO
 from PIL import Image, ImageDraw
 from typing import List, Dict, Any, Optional, Tuple
 from flask import Flask, render_template, request, jsonify, send_from_directory, Response
@@ -26,32 +26,72 @@ from werkzeug.utils import secure_filename
 # 导入操作执行模块
 import sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
-from register import agent
+from register import ActionExecutor, agent, get_executor, set_executor
+from input_backends import INPUT_BACKENDS, create_backend
+from artifact_store import ArtifactStore
+from sse import event as sse_event
+from session_stop import SessionStops
+from tracing import TraceRecorder
+from token_budget import budget_for_format
+from image_registry import IMAGE_URL_PREFIX, image_id
+from shm_transport import ShmWriter
+from history import HISTORY_STRATEGIES, format_history
+from grounding import GROUNDING_MODES, crop_region, downscale, find_box, needs_refinement, refine_step
 
 app = Flask(__name__)
 CORS(app)
 
 # 全局变量
-stop_event = threading.Event()
+# 每个会话的停止标志，/stop 只停止发起请求的会话
+session_stops = SessionStops()
 current_session = {}
 
 # 配置
 CACHE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'caches')
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+TRACE_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'traces')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
 
 app.config['CACHE_FOLDER'] = CACHE_FOLDER
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max
 
+# 截图与标注图片的存储（后台写盘 + 容量/时间清理），在 main() 中根据参数重新创建
+cache_store = None
+upload_store = None
+
 # API 配置（从命令行参数获取）
 api_config = {
     'api_key': 'EMPTY',
     'base_url': 'http://127.0.0.1:7870/v1',
     'model': 'CogAgent',
-    'platform': 'WIN'
+    'platform': 'WIN',
+    'render_boxes': False,
+    'max_actions': 1,
+    'trace_dir': None,
+    'max_tokens': None,
+    'image_transport': 'base64',
+    'history': 'full',
+    'history_window': 4,
+    'grounding': 'single',
+    'coarse_scale': 0.5,
+    'crop_scale': 0.25,
+    'refine_max_area': 0.01
 }
 
+# 上传图片使用的 HTTP 客户端（保持连接复用），首次使用时创建
+http_client = None
+# 共享内存帧环形缓冲区（--image_transport shm），在 main() 中创建
+shm_writer = None
+
+# 回答格式，同时决定每轮生成的 token 预算（见 token_budget.py）
+ANSWER_FORMAT = "(Answer in Status-Plan-Action-Operation-Sensitive format.)"
+# --max_actions > 1 时追加在回答格式之后，允许模型在一次回答中给出多个按顺序执行的操作
+MULTI_ACTION_FORMAT = (
+    "(If the following steps do not depend on the screen changing, give up to {max_actions} "
+    "Action and Grounded Operation pairs in the order they are executed.)"
+)
+
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -68,10 +108,89 @@ def identify_os() -> str:
         return "WIN"
 
 
-def encode_image(image_path: str) -> str:
+def encode_image(image_bytes: bytes) -> str:
     """将图片编码为base64"""
-    with open(image_path, "rb") as image_file:
-        return base64.b64encode(image_file.read()).decode("utf-8")
+    return base64.b64encode(image_bytes).decode("utf-8")
+
+
+def encode_png(image: Image.Image) -> bytes:
+    """将截图编码为PNG字节（请求与缓存共用同一份编码结果）"""
+    buffer = BytesIO()
+    image.save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def upload_image(image_bytes: bytes, session_id: Optional[str] = None) -> str:
+    """
+    将截图原始字节上传到服务端 /v1/images，返回消息中引用的 image://<id>。
+    id 由内容哈希得到，服务端已有同一张图片时（HEAD 返回 200）跳过上传。
+    """
+    global http_client
+    if http_client is None:
+        http_client = httpx.Client(timeout=60)
+    headers = {"Authorization": f"Bearer {api_config['api_key']}"}
+    if session_id:
+        headers["X-Session-ID"] = session_id
+    url = f"{api_config['base_url'].rstrip('/')}/images"
+    key = image_id(image_bytes)
+    if http_client.head(f"{url}/{key}", headers=headers).status_code != 200:
+        response = http_client.post(
+            url, content=image_bytes, headers={**headers, "Content-Type": "application/octet-stream"}
+        )
+        response.raise_for_status()
+    return f"{IMAGE_URL_PREFIX}{key}"
+
+
+def image_reference(
+    screenshot: Image.Image, image_bytes: Optional[bytes], session_id: Optional[str] = None
+) -> str:
+    """
+    按 --image_transport 返回消息中的图片 URL：base64 data URL（OpenAI 兼容）、上传后引用 image://<id>，
+    或写入共享内存后引用 shm://（仅客户端与服务端在同一台机器上时可用，不需要 PNG 编码）
+    """
+    if api_config['image_transport'] == 'shm':
+        return shm_writer.write(screenshot)
+    if api_config['image_transport'] == 'upload':
+        return upload_image(image_bytes, session_id)
+    return f"data:image/jpeg;base64,{encode_image(image_bytes)}"
+
+
+def completion_request(
+    model: str,
+    messages: List[Dict[str, Any]],
+    max_length: int,
+    top_p: float,
+    temperature: float,
+    presence_penalty: float,
+    session_id: Optional[str],
+) -> Dict[str, Any]:
+    """同步与异步客户端共用的流式请求参数"""
+    # 交互式客户端：服务端优先调度，批量任务在其解码期间暂停或被抢占
+    headers = {"X-Priority": "interactive"}
+    if session_id:
+        headers["X-Session-ID"] = session_id
+    return dict(
+        model=model,
+        messages=messages,
+        stream=True,
+        timeout=60,
+        max_tokens=max_length,
+        temperature=temperature,
+        presence_penalty=presence_penalty,
+        top_p=top_p,
+        stream_options={"include_usage": True},
+        extra_headers=headers,
+    )
+
+
+def parse_usage(usage) -> Tuple[Dict[str, int], Optional[Dict[str, float]]]:
+    """流末尾 usage 块 -> (token 用量, 服务端各阶段耗时)"""
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        # 模型实际预填充的图片 token 数（服务端统一缩放，与发送的像素数无关）
+        'image_tokens': getattr(usage, 'image_tokens', None) or 0,
+    }, getattr(usage, 'timings', None)  # openai_demo.py 在 usage 块中附带，用于拆分 TTFT
 
 
 def create_chat_completion(
@@ -83,58 +202,73 @@ def create_chat_completion(
     top_p: float = 1.0,
     temperature: float = 1.0,
     presence_penalty: float = 1.0,
-) -> Any:
-    """调用OpenAI兼容API - 与原client.py完全一致"""
+    session_id: Optional[str] = None,
+    trace: Optional[TraceRecorder] = None,
+) -> Tuple[Optional[str], Optional[Dict[str, int]]]:
+    """
+    调用OpenAI兼容API；session_id 通过 X-Session-ID 头传给路由器（router.py）以保持会话亲和，
+    X-Priority: interactive 使请求在服务端队列中优先于批量任务。
+    以流式方式接收响应，从而记录首 token 时间（TTFT，包含网络、排队与预填充）与解码时间。
+    服务端在 usage 块中返回各阶段耗时时，TTFT 进一步拆分为网络、预处理、排队与预填充时间。
+    返回 (响应文本, token 用量)；用量来自流末尾的 usage 块，服务端不支持时为 None。
+    """
     from openai import OpenAI
 
     client = OpenAI(api_key=api_key, base_url=base_url)
-    response = client.chat.completions.create(
-        model=model,
-        messages=messages,
-        stream=False,
-        timeout=60,
-        max_tokens=max_length,
-        temperature=temperature,
-        presence_penalty=presence_penalty,
-        top_p=top_p,
+    start = time.perf_counter()
+    stream = client.chat.completions.create(
+        **completion_request(model, messages, max_length, top_p, temperature, presence_penalty, session_id)
     )
-    if response:
-        return response.choices[0].message.content
-    return None
-
-
-def shot_current_screen(round_num: int) -> str:
-    """截取当前屏幕 - 与原client.py完全一致"""
-    img = pyautogui.screenshot()
-    filepath = os.path.join(CACHE_FOLDER, f"img_{round_num}.png")
-    img.save(filepath)
-    return filepath
+    first_token = None
+    pieces = []
+    usage = None
+    server_timings = None
+    for chunk in stream:
+        if chunk.usage:
+            usage, server_timings = parse_usage(chunk.usage)
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        if first_token is None:
+            first_token = time.perf_counter()
+        pieces.append(chunk.choices[0].delta.content)
+    end = time.perf_counter()
+
+    if trace is not None:
+        trace.add_completion(start, first_token or end, end, len(pieces), server_timings)
+    if pieces:
+        return "".join(pieces), usage
+    return None, usage
+
+
+def shot_current_screen() -> Image.Image:
+    """通过输入后端截取当前屏幕（分辨率或缩放变化时同时刷新屏幕几何信息），截图保存在内存中，由 cache_store 在后台写盘"""
+    return get_executor().screenshot()
 
 
 def formatting_input(
     task: str, 
     history_step: List[str], 
     history_action: List[str], 
-    round_num: int
+    img_url: str,
+    max_actions: int = 1
 ) -> List[Dict[str, Any]]:
-    """格式化输入消息 - 与原client.py完全一致"""
+    """格式化输入消息 - 与原client.py一致；max_actions > 1 时要求模型按顺序给出多个操作"""
     current_platform = api_config['platform']
     platform_str = f"(Platform: {current_platform})\n"
-    format_str = "(Answer in Status-Plan-Action-Operation-Sensitive format.)\n"
+    format_str = f"{ANSWER_FORMAT}\n"
+    if max_actions > 1:
+        format_str += MULTI_ACTION_FORMAT.format(max_actions=max_actions) + "\n"
 
     if len(history_step) != len(history_action):
         raise ValueError("Mismatch in lengths of history_step and history_action.")
 
-    history_str = "\nHistory steps: "
-    for index, (step, action) in enumerate(zip(history_step, history_action)):
-        history_str += f"\n{index}. {step}\t{action}"
+    # 历史步骤按 --history 策略选取（窗口、去重、压缩），限制长任务中提示词的增长
+    history_str = format_history(
+        history_step, history_action, api_config['history'], api_config['history_window']
+    )
 
     query = f"Task: {task}{history_str}\n{platform_str}{format_str}"
 
-    # Create image URL with base64 encoding
-    img_path = os.path.join(CACHE_FOLDER, f"img_{round_num}.png")
-    img_url = f"data:image/jpeg;base64,{encode_image(img_path)}"
-
     messages = [
         {
             "role": "user",
@@ -165,8 +299,117 @@ def extract_grounded_operation(response: str) -> Tuple[Optional[str], Optional[s
     return step, action
 
 
-def draw_boxes_on_image(image: Image.Image, boxes: List[List[float]], save_path: str):
-    """在图片上绘制边界框 - 与原client.py完全一致"""
+def extract_grounded_operations(response: str) -> List[Tuple[str, str]]:
+    """提取响应中的全部操作（每行一个 Grounded Operation，按顺序执行），Action 缺失时为空字符串"""
+    steps = re.findall(r"Grounded Operation:\s*(.*)", response)
+    actions = re.findall(r"Action:\s*(.*)", response)
+    actions += [""] * (len(steps) - len(actions))
+    return list(zip(steps, actions))
+
+
+# 细化请求的统计：裁剪图像素数与 token 用量
+REFINE_STATS = ('pixels', 'prompt_tokens', 'completion_tokens', 'image_tokens')
+
+
+def refine_grounding(
+    response: str,
+    screenshot: Image.Image,
+    session_id: Optional[str],
+    max_length: int,
+    top_p: float,
+    temperature: float,
+    trace: Optional[TraceRecorder] = None,
+) -> Tuple[str, Dict[str, int]]:
+    """
+    coarse_to_fine 模式的第二阶段：对缩小截图上预测的每个定位框，从原分辨率截图中裁剪框周围的方形区域，
+    以该步的 Action 作为任务让模型在裁剪图中重新定位，再将结果映射回全屏坐标并替换响应中的原定位框
+    （重新定位失败或操作不一致时保留原框）。服务端将每张图片缩放到相同尺寸，每次细化都是一次完整的视觉编码与预填充，
+    因此只细化面积小于屏幕 refine_max_area 的定位框。返回 (替换后的响应, 裁剪图像素数与 token 用量)
+    """
+    size = screenshot.size
+    stats = dict.fromkeys(REFINE_STATS, 0)
+    for step, action, region in refinement_targets(response, size):
+        crop = screenshot.crop(region)
+        stats['pixels'] += crop.width * crop.height
+        crop_bytes = None if api_config['image_transport'] == 'shm' else encode_png(crop)
+        messages = formatting_input(action or step, [], [], image_reference(crop, crop_bytes, session_id))
+        refined, usage = create_chat_completion(
+            api_key=api_config['api_key'],
+            base_url=api_config['base_url'],
+            model=api_config['model'],
+            messages=messages,
+            max_length=max_length,
+            top_p=top_p,
+            temperature=temperature,
+            session_id=session_id,
+            trace=trace,
+        )
+        for key, value in (usage or {}).items():
+            stats[key] += value
+        response = apply_refinement(response, step, refined, region, size)
+    return response, stats
+
+
+def refinement_targets(response: str, size: Tuple[int, int]) -> List[Tuple[str, str, Tuple[int, int, int, int]]]:
+    """需要细化的步骤：(步骤, Action, 原分辨率截图中的裁剪区域)，只包含面积小于 refine_max_area 的定位框"""
+    targets = []
+    for step, action in extract_grounded_operations(response)[:api_config['max_actions']]:
+        box = find_box(step)
+        if box is not None and needs_refinement(box, api_config['refine_max_area']):
+            targets.append((step, action, crop_region(box, size, api_config['crop_scale'])))
+    return targets
+
+
+def apply_refinement(response: str, step: str, refined: Optional[str], region, size: Tuple[int, int]) -> str:
+    """用裁剪图中的定位结果（映射回全屏）替换响应中该步骤的定位框"""
+    refined_steps = extract_grounded_operations(refined or "")
+    refined_step = refined_steps[0][0] if refined_steps else None
+    return response.replace(step, refine_step(step, refined_step, region, size), 1)
+
+
+def merge_refinement(
+    usage: Optional[Dict[str, int]], pixels: int, refine_stats: Dict[str, int]
+) -> Tuple[Optional[Dict[str, int]], int]:
+    """本轮用量与发送的像素数加上细化请求的部分"""
+    pixels += refine_stats['pixels']
+    if usage:
+        usage = {key: usage[key] + refine_stats[key] for key in usage}
+    return usage, pixels
+
+
+def parse_operations(response: str) -> Tuple[List[Tuple[str, str]], List[Tuple[Dict[str, Any], str, str]]]:
+    """
+    提取操作：一次响应可包含多个操作，最多执行 max_actions 个。
+    返回 (全部步骤, NO_ACTION 之前的 (操作, 步骤, Action))；没有可执行的操作时后者为空
+    """
+    steps = extract_grounded_operations(response)[:api_config['max_actions']]
+    if not steps:
+        steps = [(None, None)]
+    grounded_operations = []
+    for step, action in steps:
+        grounded_operation = extract_operation(step)
+        if grounded_operation["operation"] == "NO_ACTION":
+            break
+        grounded_operations.append((grounded_operation, step, action))
+    return steps, grounded_operations
+
+
+def record_executed(
+    grounded_operations: List[Tuple[Dict[str, Any], str, str]],
+    executed: List[str],
+    history_step: List[str],
+    history_action: List[str],
+) -> List[List[float]]:
+    """将实际执行的步骤写入历史，返回这些步骤的边界框（只绘制实际执行的步骤）"""
+    for _, step, action in grounded_operations[:len(executed)]:
+        history_step.append(step)
+        history_action.append(action or "")
+    return extract_bboxes("\n".join(step for _, step, _ in grounded_operations[:len(executed)]))
+
+
+def draw_boxes_on_image(image: Image.Image, boxes: List[List[float]]) -> Image.Image:
+    """在图片副本上绘制边界框，返回标注后的图片"""
+    image = image.copy()
     draw = ImageDraw.Draw(image)
     for box in boxes:
         x_min = int(box[0] * image.width)
@@ -174,21 +417,32 @@ def draw_boxes_on_image(image: Image.Image, boxes: List[List[float]], save_path:
         x_max = int(box[2] * image.width)
         y_max = int(box[3] * image.height)
         draw.rectangle([x_min, y_min, x_max, y_max], outline="red", width=3)
-    image.save(save_path)
+    return image
 
 
-def extract_bboxes(response: str, round_num: int) -> Optional[str]:
-    """提取边界框并绘制 - 与原client.py完全一致"""
+def extract_bboxes(response: str) -> List[List[float]]:
+    """提取边界框，返回 0-1 归一化坐标 [x_min, y_min, x_max, y_max]"""
     box_pattern = r"box=\[\[?(\d+),(\d+),(\d+),(\d+)\]?\]"
     matches = re.findall(box_pattern, response)
-    if matches:
-        boxes = [[int(x) / 1000 for x in match] for match in matches]
-        img_save_path = os.path.join(CACHE_FOLDER, f"img_{round_num}_bbox.png")
-        img_path = os.path.join(CACHE_FOLDER, f"img_{round_num}.png")
-        image = Image.open(img_path).convert("RGB")
-        draw_boxes_on_image(image, boxes, img_save_path)
-        return f"img_{round_num}_bbox.png"
-    return None
+    return [[int(x) / 1000 for x in match] for match in matches]
+
+
+def render_bboxes(screenshot: Image.Image, boxes: List[List[float]]) -> str:
+    """导出模式：在服务端绘制边界框，标注图片交给 cache_store 在后台编码写盘"""
+    image = draw_boxes_on_image(screenshot.convert("RGB"), boxes)
+    return cache_store.put_image(image)
+
+
+def image_event(screenshot: Image.Image, screenshot_name: str, boxes: List[List[float]]) -> Optional[Dict[str, Any]]:
+    """
+    生成前端展示事件。默认只发送原始截图路径和归一化坐标，由前端叠加绘制边界框；
+    开启 --render_boxes 时发送服务端绘制好的标注图片
+    """
+    if not boxes:
+        return None
+    if api_config['render_boxes']:
+        return {'type': 'image', 'path': f"/caches/{render_bboxes(screenshot, boxes)}"}
+    return {'type': 'boxes', 'path': f"/caches/{screenshot_name}", 'boxes': boxes}
 
 
 def is_balanced(s: str) -> bool:
@@ -232,16 +486,29 @@ def index():
     return render_template('index.html')
 
 
+def session_artifacts() -> List[str]:
+    """会话仍在展示的截图与标注图片，存储清理时保留（在写盘线程中调用）"""
+    return [name for session in list(current_session.values()) for name in list(session['artifacts'])]
+
+
+def send_artifact(store: ArtifactStore, filename: str) -> Response:
+    """发送存储中的文件；文件名由内容哈希生成，可以长期缓存"""
+    store.wait(filename)
+    response = send_from_directory(store.root, filename, max_age=ArtifactStore.CACHE_MAX_AGE)
+    response.headers.update(ArtifactStore.CACHE_HEADERS)
+    return response
+
+
 @app.route('/caches/<filename>')
 def cached_file(filename):
     """获取缓存文件"""
-    return send_from_directory(CACHE_FOLDER, filename)
+    return send_artifact(cache_store, filename)
 
 
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """获取上传的文件"""
-    return send_from_directory(UPLOAD_FOLDER, filename)
+    return send_artifact(upload_store, filename)
 
 
 @app.route('/upload', methods=['POST'])
@@ -256,9 +523,9 @@ def upload_file():
     
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(UPLOAD_FOLDER, unique_filename)
-        file.save(filepath)
+        ext = filename.rsplit('.', 1)[1].lower()
+        unique_filename = upload_store.put_bytes(file.read(), ext)
+        filepath = upload_store.path(unique_filename)
         return jsonify({'filename': unique_filename, 'path': filepath})
     
     return jsonify({'error': 'Invalid file type'}), 400
@@ -276,22 +543,26 @@ def workflow():
     session_id = data.get('session_id', str(uuid.uuid4()))
     task = data.get('task', '')
     
-    # 使用默认参数值（与原client.py一致）
-    max_length = 4096
+    # 生成长度按回答格式的预算（新 token 数），可用 --max_tokens 覆盖；其余参数与原client.py一致
+    max_length = api_config['max_tokens'] or budget_for_format(ANSWER_FORMAT, steps=api_config['max_actions'])
     top_p = 0.8
     temperature = 0.6
     
-    # 重置停止事件
-    stop_event.clear()
+    # 本次工作流的停止标志（只属于该会话）
+    stop_event = session_stops.start(session_id)
     
     def generate():
         history_step = []
         history_action = []
+        image_events = []
         round_num = 1
+        trace = TraceRecorder(session_id)
+        # 会话展示的截图与标注图片不会被存储清理（/clear 后释放）
+        artifacts = current_session.setdefault(session_id, {'artifacts': set()})['artifacts']
         
         try:
             # 发送开始警告
-            yield f"data: {json.dumps({'type': 'warning_start'})}\n\n"
+            yield sse_event({'type': 'warning_start'})
             
             while True:
                 print(f"\033[92m Round {round_num}: \033[0m")
@@ -300,83 +571,129 @@ def workflow():
                     break  # Exit the loop after 15 rounds
                 
                 # 发送轮次信息
-                yield f"data: {json.dumps({'type': 'round', 'round': round_num})}\n\n"
+                yield sse_event({'type': 'round', 'round': round_num})
+                trace.next_round(round_num)
                 
-                # 截取当前屏幕
-                shot_current_screen(round_num)
-                
-                # 格式化输入消息
-                messages = formatting_input(task, history_step, history_action, round_num)
+                # 截取当前屏幕，PNG编码结果同时用于请求和缓存
+                with trace.span('capture'):
+                    screenshot = shot_current_screen()
+                # coarse_to_fine 模式先发送缩小的截图，定位框随后用原分辨率的裁剪图细化；缓存始终保存原图
+                coarse_to_fine = api_config['grounding'] == 'coarse_to_fine'
+                request_image = downscale(screenshot, api_config['coarse_scale']) if coarse_to_fine else screenshot
+                if api_config['image_transport'] == 'shm':
+                    # 共享内存传输不需要 PNG：缓存图片在后台线程编码
+                    screenshot_bytes = None
+                    with trace.span('save'):
+                        screenshot_name = cache_store.put_image(screenshot)
+                else:
+                    with trace.span('encode'):
+                        screenshot_bytes = encode_png(request_image)
+                    with trace.span('save'):
+                        if request_image is screenshot:
+                            screenshot_name = cache_store.put_bytes(screenshot_bytes, 'png')
+                        else:
+                            screenshot_name = cache_store.put_image(screenshot)
+
+                # 格式化输入消息（图片按 --image_transport 内嵌、上传或写入共享内存）
+                with trace.span('format'):
+                    img_url = image_reference(request_image, screenshot_bytes, session_id)
+                    messages = formatting_input(task, history_step, history_action, img_url, api_config['max_actions'])
                 
                 # 调用API获取响应
-                response = create_chat_completion(
-                    api_key=api_config['api_key'],
-                    base_url=api_config['base_url'],
-                    model=api_config['model'],
-                    messages=messages,
-                    max_length=max_length,
-                    top_p=top_p,
-                    temperature=temperature,
-                )
+                with trace.span('request'):
+                    response, usage = create_chat_completion(
+                        api_key=api_config['api_key'],
+                        base_url=api_config['base_url'],
+                        model=api_config['model'],
+                        messages=messages,
+                        max_length=max_length,
+                        top_p=top_p,
+                        temperature=temperature,
+                        session_id=session_id,
+                        trace=trace,
+                    )
                 
                 if not response:
-                    yield f"data: {json.dumps({'type': 'error', 'message': 'Model returned empty response'})}\n\n"
+                    yield sse_event({'type': 'error', 'message': 'Model returned empty response'})
                     break
+
+                # 第二阶段：在高分辨率裁剪图中细化定位框，坐标映射回全屏后再解析与执行
+                pixels = request_image.width * request_image.height
+                if coarse_to_fine:
+                    with trace.span('refine'):
+                        response, refine_stats = refine_grounding(
+                            response, screenshot, session_id, max_length, top_p, temperature, trace
+                        )
+                    usage, pixels = merge_refinement(usage, pixels, refine_stats)
+
+                # 发送模型响应及本轮 token 用量（含模型处理的图片 token 数与客户端发送的像素数）
+                yield sse_event({'type': 'response', 'content': response})
+                if usage:
+                    yield sse_event({'type': 'usage', 'round': round_num, 'pixels': pixels, **usage})
                 
-                # 发送模型响应
-                yield f"data: {json.dumps({'type': 'response', 'content': response})}\n\n"
+                # 提取操作：一次响应可包含多个操作，最多执行 max_actions 个
+                with trace.span('parse'):
+                    steps, grounded_operations = parse_operations(response)
                 
-                # 提取操作
-                step, action = extract_grounded_operation(response)
-                history_step.append(step if step else "")
-                history_action.append(action if action else "")
+                if not grounded_operations:
+                    history_step.append(steps[0][0] or "")
+                    history_action.append(steps[0][1] or "")
+                    break
                 
-                # 处理边界框
-                bbox_filename = extract_bboxes(response, round_num)
+                # 连续执行操作，后续步骤在目标区域已明显变化时停止，并只记录实际执行的步骤
+                with trace.span('action', count=len(grounded_operations)):
+                    executed = agent([op for op, _, _ in grounded_operations], reference=screenshot, settle=False)
+                status = executed[-1]
                 
-                # 提取操作详情
-                grounded_operation = extract_operation(step)
+                # 处理边界框：只绘制实际执行的步骤
+                with trace.span('bbox'):
+                    boxes = record_executed(grounded_operations, executed, history_step, history_action)
+                    image_events.append(image_event(screenshot, screenshot_name, boxes))
+                    if image_events[-1]:
+                        artifacts.add(os.path.basename(image_events[-1]['path']))
                 
-                if grounded_operation["operation"] == "NO_ACTION":
-                    break
+                # 等待界面更新后再进入下一轮
+                with trace.span('sleep'):
+                    time.sleep(get_executor().settle)
                 
-                # 执行操作
-                status = agent(grounded_operation)
+                # 发送图片路径（及边界框）
+                if image_events[-1]:
+                    yield sse_event(image_events[-1])
                 
-                # 发送图片路径
-                if bbox_filename:
-                    output_image = f"/caches/{bbox_filename}"
-                    yield f"data: {json.dumps({'type': 'image', 'path': output_image})}\n\n"
+                # 发送本轮耗时统计（毫秒）
+                yield sse_event({'type': 'trace', 'round': round_num, 'spans': trace.summary(round_num)})
                 
                 # 检查是否结束或停止
                 if status == "END" or stop_event.is_set():
-                    if bbox_filename and round_num > 1:
-                        prev_bbox = f"/caches/img_{round_num - 1}_bbox.png"
-                        yield f"data: {json.dumps({'type': 'image', 'path': prev_bbox})}\n\n"
+                    if image_events[-1] and round_num > 1 and image_events[-2]:
+                        yield sse_event(image_events[-2])
                     
                     if stop_event.is_set():
-                        yield f"data: {json.dumps({'type': 'stopped'})}\n\n"
+                        yield sse_event({'type': 'stopped'})
                     break
                 
                 round_num += 1
             
+            # 发送整个会话的耗时统计，并按需写出 Chrome trace 文件
+            trace_path = trace.save(api_config['trace_dir']) if api_config['trace_dir'] else None
+            yield sse_event({'type': 'trace', 'spans': trace.summary(), 'path': trace_path})
+            
             # 发送结束警告
-            yield f"data: {json.dumps({'type': 'warning_end'})}\n\n"
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
+            yield sse_event({'type': 'warning_end'})
+            yield sse_event({'type': 'done'})
             
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+            yield sse_event({'type': 'error', 'message': str(e)})
         finally:
-            # 清除停止事件
-            stop_event.clear()
+            session_stops.finish(session_id, stop_event)
     
     return Response(generate(), mimetype='text/event-stream')
 
 
 @app.route('/stop', methods=['POST'])
 def stop_execution():
-    """停止执行 - 与原client.py的switch函数一致"""
-    stop_event.set()
+    """停止执行 - 与原client.py的switch函数一致，只停止请求中 session_id 的工作流"""
+    session_stops.stop((request.get_json(silent=True) or {}).get('session_id'))
     return jsonify({'status': 'stopped'})
 
 
@@ -392,7 +709,8 @@ def clear_session():
     return jsonify({'status': 'success'})
 
 
-def main():
+def build_parser() -> argparse.ArgumentParser:
+    """命令行参数（Flask 版与 asgi_app.py 共用）"""
     parser = argparse.ArgumentParser(description="CogAgent Client Web UI")
     parser.add_argument("--api_key", default="EMPTY", help="OpenAI API Key")
     parser.add_argument("--base_url", default="http://127.0.0.1:7870/v1", help="OpenAI API Base URL")
@@ -400,18 +718,70 @@ def main():
     parser.add_argument("--host", default="127.0.0.1", help="Host IP for the server")
     parser.add_argument("--port", type=int, default=7860, help="Port for the server")
     parser.add_argument("--platform", default=None, help="Platform (WIN/Mac/Mobile)")
-    
-    args = parser.parse_args()
-    
+    parser.add_argument("--render_boxes", action="store_true", help="Render annotated images on the server instead of drawing boxes in the browser")
+    parser.add_argument("--cache_max_mb", type=int, default=1024, help="Max disk usage of caches/ and uploads/ in MB (0 = unlimited)")
+    parser.add_argument("--cache_max_age", type=float, default=72, help="Delete cached files older than this many hours (0 = never)")
+    parser.add_argument("--type_mode", choices=["auto", "paste", "type"], default="auto", help="Text input: auto types ASCII directly and pastes other text")
+    parser.add_argument("--action_pause", type=float, default=0.1, help="Pause after each mouse/keyboard event in seconds")
+    parser.add_argument("--trace", action="store_true", help=f"Write a Chrome trace JSON per session to {TRACE_FOLDER}")
+    parser.add_argument("--trace_dir", default=None, help="Directory for trace files (implies --trace)")
+    parser.add_argument("--image_transport", choices=["base64", "upload", "shm"], default="base64", help="Send screenshots as base64 data URLs, upload raw bytes to /v1/images, or pass raw frames through shared memory (same host, server --allow_shm)")
+    parser.add_argument("--max_tokens", type=int, default=None, help="Max new tokens per round (default: budget of the answer format)")
+    parser.add_argument("--history", choices=HISTORY_STRATEGIES, default="full", help="History steps in the prompt: all, the last --history_window, repeats collapsed, or older steps reduced to the operation name")
+    parser.add_argument("--history_window", type=int, default=4, help="Number of recent steps kept in full by the window and compact strategies")
+    parser.add_argument("--grounding", choices=GROUNDING_MODES, default="single", help="single sends the full screenshot; coarse_to_fine sends a downscaled one and refines each box on a full resolution crop")
+    parser.add_argument("--coarse_scale", type=float, default=0.5, help="Scale of the screenshot sent in the coarse stage")
+    parser.add_argument("--crop_scale", type=float, default=0.25, help="Side of the refinement crop as a fraction of the longer screen side")
+    parser.add_argument("--refine_max_area", type=float, default=0.01, help="Only boxes covering less than this fraction of the screen are refined")
+    parser.add_argument("--max_actions", type=int, default=1, help="Max number of grounded operations executed from one response")
+    parser.add_argument("--input_backend", choices=INPUT_BACKENDS, default="pyautogui", help="Mouse/keyboard/screen backend (xdotool for Xvfb, fake records events)")
+    parser.add_argument("--display", default=None, help="X display of the xdotool backend, e.g. :99")
+    parser.add_argument("--monitor", type=int, default=None, help="Monitor number to act on (requires screeninfo)")
+    return parser
+
+
+def configure(args):
+    """根据命令行参数更新 API 配置，创建存储与操作执行器（Flask 版与 asgi_app.py 共用）"""
     # 更新API配置
     api_config['api_key'] = args.api_key
     api_config['base_url'] = args.base_url
     api_config['model'] = args.model
     api_config['platform'] = args.platform if args.platform else identify_os()
+    api_config['render_boxes'] = args.render_boxes
+    api_config['max_actions'] = args.max_actions
+    api_config['max_tokens'] = args.max_tokens
+    api_config['image_transport'] = args.image_transport
+    api_config['history'] = args.history
+    api_config['history_window'] = args.history_window
+    api_config['grounding'] = args.grounding
+    api_config['coarse_scale'] = args.coarse_scale
+    api_config['crop_scale'] = args.crop_scale
+    api_config['refine_max_area'] = args.refine_max_area
+    api_config['trace_dir'] = args.trace_dir or (TRACE_FOLDER if args.trace else None)
+    
+    # 创建存储（同时确保目录存在）
+    global cache_store, upload_store, shm_writer
+    retention = dict(
+        max_bytes=args.cache_max_mb * 1024 * 1024,
+        max_age=args.cache_max_age * 3600,
+        in_use=session_artifacts,
+    )
+    cache_store = ArtifactStore(CACHE_FOLDER, **retention)
+    upload_store = ArtifactStore(UPLOAD_FOLDER, **retention)
     
-    # 确保目录存在
-    os.makedirs(CACHE_FOLDER, exist_ok=True)
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
+    # 共享内存帧缓冲区（仅 --image_transport shm），退出时释放
+    if args.image_transport == 'shm':
+        shm_writer = ShmWriter()
+        atexit.register(shm_writer.close)
+    
+    # 操作执行器：屏幕几何信息与系统快捷键只探测一次
+    backend = create_backend(args.input_backend, display=args.display, pause=args.action_pause)
+    set_executor(ActionExecutor(backend, type_mode=args.type_mode, monitor=args.monitor))
+
+
+def main():
+    args = build_parser().parse_args()
+    configure(args)
     
     print(f"="*50)
     print(f"CogAgent Client Web UI")
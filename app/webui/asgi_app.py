@@ -0,0 +1,413 @@
+"""
+CogAgent Client Web UI - ASGI Version
+与 app.py（Flask 版）路由、参数和 SSE 事件完全一致的异步版本，适合大量浏览器会话同时观看工作流
+
+Flask 版以 threaded=True 运行，每个打开的 SSE 流占用一个线程直到 15 轮工作流结束。这里每个流是一个协程：
+模型请求（AsyncOpenAI）与截图上传（httpx.AsyncClient）直接 await；截图、PIL 编码等阻塞操作交给
+有界线程池（--blocking_workers），鼠标/键盘操作与截图共用一个单线程执行器（同一时间只有一个会话操作桌面）。
+请求参数、usage 解析、细化目标的选择、操作解析与历史记录等每轮的步骤逻辑由 app.py 提供，这里只负责异步 I/O。
+
+客户端运行：python app/webui/asgi_app.py --api_key EMPTY --base_url http://127.0.0.1:7870/v1 --host 127.0.0.1 --port 7860 --platform WIN
+"""
+
+import asyncio
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from typing import Any, Dict, List, Optional, Tuple
+
+import httpx
+import uvicorn
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from PIL import Image
+from werkzeug.utils import secure_filename
+
+# Flask 版的模块（app.py）提供配置、提示词格式化与响应解析；优先于 app/ 目录导入
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app as webui
+from register import agent, get_executor
+from artifact_store import ArtifactStore
+from sse import event as sse_event
+from tracing import TraceRecorder
+from token_budget import budget_for_format
+from image_registry import IMAGE_URL_PREFIX, image_id
+from grounding import downscale
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+INDEX_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'index.html')
+
+# 阻塞操作（PNG 编码、缓存写入、共享内存写入）的有界线程池，在 main() 中按 --blocking_workers 重新创建
+blocking_pool = ThreadPoolExecutor(max_workers=8, thread_name_prefix='blocking')
+# 截图与鼠标/键盘操作：同一块屏幕，单线程依次执行
+input_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='input')
+
+# 异步 HTTP 客户端，在 lifespan 中创建
+openai_client = None
+http_client = None
+
+
+async def run_blocking(function, *args, pool: Optional[ThreadPoolExecutor] = None, **kwargs):
+    """在线程池中执行阻塞函数，不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool or blocking_pool, partial(function, *args, **kwargs))
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """创建共享的异步 HTTP 客户端（连接复用），退出时关闭"""
+    global openai_client, http_client
+    from openai import AsyncOpenAI
+
+    openai_client = AsyncOpenAI(api_key=webui.api_config['api_key'], base_url=webui.api_config['base_url'])
+    http_client = httpx.AsyncClient(timeout=60)
+    yield
+    await openai_client.close()
+    await http_client.aclose()
+    blocking_pool.shutdown(wait=False)
+    input_pool.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.mount('/static', StaticFiles(directory=STATIC_FOLDER), name='static')
+
+
+async def upload_image(image_bytes: bytes, session_id: Optional[str] = None) -> str:
+    """异步版 webui.upload_image：上传截图原始字节，服务端已有同一张图片时跳过上传"""
+    headers = {"Authorization": f"Bearer {webui.api_config['api_key']}"}
+    if session_id:
+        headers["X-Session-ID"] = session_id
+    url = f"{webui.api_config['base_url'].rstrip('/')}/images"
+    key = image_id(image_bytes)
+    if (await http_client.head(f"{url}/{key}", headers=headers)).status_code != 200:
+        response = await http_client.post(
+            url, content=image_bytes, headers={**headers, "Content-Type": "application/octet-stream"}
+        )
+        response.raise_for_status()
+    return f"{IMAGE_URL_PREFIX}{key}"
+
+
+async def image_reference(
+    screenshot: Image.Image, image_bytes: Optional[bytes], session_id: Optional[str] = None
+) -> str:
+    """异步版 webui.image_reference"""
+    if webui.api_config['image_transport'] == 'shm':
+        return await run_blocking(webui.shm_writer.write, screenshot)
+    if webui.api_config['image_transport'] == 'upload':
+        return await upload_image(image_bytes, session_id)
+    return f"data:image/jpeg;base64,{webui.encode_image(image_bytes)}"
+
+
+async def create_chat_completion(
+    messages: List[Dict[str, Any]],
+    max_length: int = 512,
+    top_p: float = 1.0,
+    temperature: float = 1.0,
+    presence_penalty: float = 1.0,
+    session_id: Optional[str] = None,
+    trace: Optional[TraceRecorder] = None,
+) -> Tuple[Optional[str], Optional[Dict[str, int]]]:
+    """异步版 webui.create_chat_completion：流式接收响应并记录 TTFT 与解码时间，返回 (响应文本, token 用量)"""
+    start = time.perf_counter()
+    stream = await openai_client.chat.completions.create(
+        **webui.completion_request(
+            webui.api_config['model'], messages, max_length, top_p, temperature, presence_penalty, session_id
+        )
+    )
+    first_token = None
+    pieces = []
+    usage = None
+    server_timings = None
+    async for chunk in stream:
+        if chunk.usage:
+            usage, server_timings = webui.parse_usage(chunk.usage)
+        if not chunk.choices or not chunk.choices[0].delta.content:
+            continue
+        if first_token is None:
+            first_token = time.perf_counter()
+        pieces.append(chunk.choices[0].delta.content)
+    end = time.perf_counter()
+
+    if trace is not None:
+        trace.add_completion(start, first_token or end, end, len(pieces), server_timings)
+    if pieces:
+        return "".join(pieces), usage
+    return None, usage
+
+
+async def refine_grounding(
+    response: str,
+    screenshot: Image.Image,
+    session_id: Optional[str],
+    max_length: int,
+    top_p: float,
+    temperature: float,
+    trace: Optional[TraceRecorder] = None,
+) -> Tuple[str, Dict[str, int]]:
+    """异步版 webui.refine_grounding：只细化小定位框，在原分辨率裁剪图中重新定位，坐标映射回全屏"""
+    size = screenshot.size
+    stats = dict.fromkeys(webui.REFINE_STATS, 0)
+    for step, action, region in webui.refinement_targets(response, size):
+        crop = await run_blocking(screenshot.crop, region)
+        stats['pixels'] += crop.width * crop.height
+        crop_bytes = None if webui.api_config['image_transport'] == 'shm' else await run_blocking(webui.encode_png, crop)
+        img_url = await image_reference(crop, crop_bytes, session_id)
+        messages = webui.formatting_input(action or step, [], [], img_url)
+        refined, usage = await create_chat_completion(
+            messages, max_length, top_p, temperature, session_id=session_id, trace=trace
+        )
+        for key, value in (usage or {}).items():
+            stats[key] += value
+        response = webui.apply_refinement(response, step, refined, region, size)
+    return response, stats
+
+
+@app.get('/')
+async def index():
+    """主页"""
+    return FileResponse(INDEX_PAGE)
+
+
+async def send_artifact(store: ArtifactStore, filename: str):
+    """发送存储中的文件；文件可能仍在后台写盘，在线程池中等待"""
+    filename = secure_filename(filename)
+    await run_blocking(store.wait, filename)
+    path = store.path(filename)
+    if not os.path.exists(path):
+        return JSONResponse({'error': 'Not found'}, status_code=404)
+    return FileResponse(path, headers=ArtifactStore.CACHE_HEADERS)
+
+
+@app.get('/caches/{filename}')
+async def cached_file(filename: str):
+    """获取缓存文件"""
+    return await send_artifact(webui.cache_store, filename)
+
+
+@app.get('/uploads/{filename}')
+async def uploaded_file(filename: str):
+    """获取上传的文件"""
+    return await send_artifact(webui.upload_store, filename)
+
+
+@app.post('/upload')
+async def upload_file(file: Optional[UploadFile] = File(None)):
+    """上传图片 - 与 Flask 版一致"""
+    if file is None:
+        return JSONResponse({'error': 'No file part'}, status_code=400)
+    if file.filename == '':
+        return JSONResponse({'error': 'No selected file'}, status_code=400)
+    if not webui.allowed_file(file.filename):
+        return JSONResponse({'error': 'Invalid file type'}, status_code=400)
+
+    data = await file.read()
+    if len(data) > webui.app.config['MAX_CONTENT_LENGTH']:
+        return JSONResponse({'error': 'File too large'}, status_code=413)
+    ext = secure_filename(file.filename).rsplit('.', 1)[1].lower()
+    unique_filename = webui.upload_store.put_bytes(data, ext)
+    return {'filename': unique_filename, 'path': webui.upload_store.path(unique_filename)}
+
+
+@app.post('/workflow')
+async def workflow(request: Request):
+    """
+    主工作流 - 与 Flask 版一致：自动截图、调用模型、执行操作的循环，
+    以协程方式推送 SSE 事件
+    """
+    data = await request.json()
+    session_id = data.get('session_id', str(uuid.uuid4()))
+    task = data.get('task', '')
+    config = webui.api_config
+
+    max_length = config['max_tokens'] or budget_for_format(webui.ANSWER_FORMAT, steps=config['max_actions'])
+    top_p = 0.8
+    temperature = 0.6
+
+    # 本次工作流的停止标志（只属于该会话）
+    stop_event = webui.session_stops.start(session_id)
+
+    async def generate():
+        history_step = []
+        history_action = []
+        image_events = []
+        round_num = 1
+        trace = TraceRecorder(session_id)
+        # 会话展示的截图与标注图片不会被存储清理（/clear 后释放）
+        artifacts = webui.current_session.setdefault(session_id, {'artifacts': set()})['artifacts']
+
+        try:
+            # 发送开始警告
+            yield sse_event({'type': 'warning_start'})
+
+            while True:
+                print(f"\033[92m Round {round_num}: \033[0m")
+
+                if round_num > 15:
+                    break  # Exit the loop after 15 rounds
+
+                # 发送轮次信息
+                yield sse_event({'type': 'round', 'round': round_num})
+                trace.next_round(round_num)
+
+                # 截取当前屏幕（输入执行器），编码与缓存在线程池中完成
+                with trace.span('capture'):
+                    screenshot = await run_blocking(webui.shot_current_screen, pool=input_pool)
+                coarse_to_fine = config['grounding'] == 'coarse_to_fine'
+                request_image = screenshot
+                if coarse_to_fine:
+                    request_image = await run_blocking(downscale, screenshot, config['coarse_scale'])
+                if config['image_transport'] == 'shm':
+                    screenshot_bytes = None
+                    with trace.span('save'):
+                        screenshot_name = await run_blocking(webui.cache_store.put_image, screenshot)
+                else:
+                    with trace.span('encode'):
+                        screenshot_bytes = await run_blocking(webui.encode_png, request_image)
+                    with trace.span('save'):
+                        if request_image is screenshot:
+                            screenshot_name = webui.cache_store.put_bytes(screenshot_bytes, 'png')
+                        else:
+                            screenshot_name = await run_blocking(webui.cache_store.put_image, screenshot)
+
+                # 格式化输入消息（图片按 --image_transport 内嵌、上传或写入共享内存）
+                with trace.span('format'):
+                    img_url = await image_reference(request_image, screenshot_bytes, session_id)
+                    messages = webui.formatting_input(task, history_step, history_action, img_url, config['max_actions'])
+
+                # 调用API获取响应
+                with trace.span('request'):
+                    response, usage = await create_chat_completion(
+                        messages, max_length, top_p, temperature, session_id=session_id, trace=trace
+                    )
+
+                if not response:
+                    yield sse_event({'type': 'error', 'message': 'Model returned empty response'})
+                    break
+
+                # 第二阶段：在高分辨率裁剪图中细化定位框
+                pixels = request_image.width * request_image.height
+                if coarse_to_fine:
+                    with trace.span('refine'):
+                        response, refine_stats = await refine_grounding(
+                            response, screenshot, session_id, max_length, top_p, temperature, trace
+                        )
+                    usage, pixels = webui.merge_refinement(usage, pixels, refine_stats)
+
+                # 发送模型响应及本轮 token 用量（含模型处理的图片 token 数与客户端发送的像素数）
+                yield sse_event({'type': 'response', 'content': response})
+                if usage:
+                    yield sse_event({'type': 'usage', 'round': round_num, 'pixels': pixels, **usage})
+
+                # 提取操作：一次响应可包含多个操作，最多执行 max_actions 个
+                with trace.span('parse'):
+                    steps, grounded_operations = webui.parse_operations(response)
+
+                if not grounded_operations:
+                    history_step.append(steps[0][0] or "")
+                    history_action.append(steps[0][1] or "")
+                    break
+
+                # 连续执行操作（输入执行器），只记录实际执行的步骤
+                with trace.span('action', count=len(grounded_operations)):
+                    executed = await run_blocking(
+                        agent, [op for op, _, _ in grounded_operations], reference=screenshot, settle=False, pool=input_pool
+                    )
+                status = executed[-1]
+
+                # 处理边界框：只绘制实际执行的步骤（--render_boxes 时在线程池中绘制）
+                with trace.span('bbox'):
+                    boxes = webui.record_executed(grounded_operations, executed, history_step, history_action)
+                    image_events.append(await run_blocking(webui.image_event, screenshot, screenshot_name, boxes))
+                    if image_events[-1]:
+                        artifacts.add(os.path.basename(image_events[-1]['path']))
+
+                # 等待界面更新后再进入下一轮（不占用线程）
+                with trace.span('sleep'):
+                    await asyncio.sleep(get_executor().settle)
+
+                # 发送图片路径（及边界框）
+                if image_events[-1]:
+                    yield sse_event(image_events[-1])
+
+                # 发送本轮耗时统计（毫秒）
+                yield sse_event({'type': 'trace', 'round': round_num, 'spans': trace.summary(round_num)})
+
+                # 检查是否结束或停止
+                if status == "END" or stop_event.is_set():
+                    if image_events[-1] and round_num > 1 and image_events[-2]:
+                        yield sse_event(image_events[-2])
+
+                    if stop_event.is_set():
+                        yield sse_event({'type': 'stopped'})
+                    break
+
+                round_num += 1
+
+            # 发送整个会话的耗时统计，并按需写出 Chrome trace 文件
+            trace_path = await run_blocking(trace.save, config['trace_dir']) if config['trace_dir'] else None
+            yield sse_event({'type': 'trace', 'spans': trace.summary(), 'path': trace_path})
+
+            # 发送结束警告
+            yield sse_event({'type': 'warning_end'})
+            yield sse_event({'type': 'done'})
+
+        except Exception as e:
+            yield sse_event({'type': 'error', 'message': str(e)})
+        finally:
+            webui.session_stops.finish(session_id, stop_event)
+
+    return StreamingResponse(generate(), media_type='text/event-stream')
+
+
+@app.post('/stop')
+async def stop_execution(request: Request):
+    """停止执行：只停止请求中 session_id 的工作流"""
+    data = await request.json()
+    webui.session_stops.stop(data.get('session_id'))
+    return {'status': 'stopped'}
+
+
+@app.post('/clear')
+async def clear_session(request: Request):
+    """清空会话"""
+    data = await request.json()
+    webui.current_session.pop(data.get('session_id'), None)
+    return {'status': 'success'}
+
+
+def main():
+    global blocking_pool
+    parser = webui.build_parser()
+    parser.add_argument("--blocking_workers", type=int, default=8, help="Threads for blocking work (PNG encoding, caching) shared by all sessions")
+    args = parser.parse_args()
+    webui.configure(args)
+    blocking_pool = ThreadPoolExecutor(max_workers=args.blocking_workers, thread_name_prefix='blocking')
+
+    print("=" * 50)
+    print("CogAgent Client Web UI (ASGI)")
+    print("=" * 50)
+    print(f"API Base URL: {webui.api_config['base_url']}")
+    print(f"Model: {webui.api_config['model']}")
+    print(f"Platform: {webui.api_config['platform']}")
+    print("=" * 50)
+    print(f"Starting server at http://{args.host}:{args.port}")
+    print("=" * 50)
+
+    uvicorn.run(app, host=args.host, port=args.port, workers=1)
+
+
+if __name__ == "__main__":
+    main()
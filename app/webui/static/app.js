@@ -15,6 +15,10 @@ const taskInput = document.getElementById('taskInput');
 const submitBtn = document.getElementById('submitBtn');
 const clearBtn = document.getElementById('clearBtn');
 const stopBtn = document.getElementById('stopBtn');
+const boxOverlay = document.getElementById('boxOverlay');
+
+// 当前结果图片上的边界框（0-1 归一化坐标）
+let currentBoxes = [];
 
 // 生成 UUID
 function generateUUID() {
@@ -172,17 +176,13 @@ function handleStreamEvent(data) {
             break;
             
         case 'image':
-            console.log('Result image path:', data.path);
-            resultImage.onload = function() {
-                console.log('Result image loaded successfully');
-                resultImage.style.display = 'block';
-                resultArea.querySelector('.result-placeholder').style.display = 'none';
-                resultArea.classList.add('has-image');
-            };
-            resultImage.onerror = function() {
-                console.error('Failed to load result image:', data.path);
-            };
-            resultImage.src = data.path;
+            // 导出模式：服务端绘制好的标注图片
+            showResultImage(data.path, []);
+            break;
+            
+        case 'boxes':
+            // 原始截图 + 前端叠加边界框
+            showResultImage(data.path, data.boxes);
             break;
             
         case 'done':
@@ -199,6 +199,20 @@ function handleStreamEvent(data) {
             setGenerating(false);
             break;
             
+        case 'usage':
+            // 本轮 token 用量（提示词 / 生成 / 模型处理的图片 token）与客户端发送的图片像素数
+            addMessage('status', `Tokens: prompt ${data.prompt_tokens}, completion ${data.completion_tokens}, image ${data.image_tokens}, sent pixels ${data.pixels}`);
+            break;
+            
+        case 'trace':
+            // 耗时统计（毫秒）：每轮一条，会话结束时汇总一条
+            if (data.round) {
+                console.log(`Round ${data.round} timings (ms):`, data.spans);
+            } else {
+                console.log('Session timings (ms):', data.spans, data.path ? `trace: ${data.path}` : '');
+            }
+            break;
+            
         case 'warning_start':
             // 显示警告：CogAgent正在处理，请勿操作键盘鼠标
             console.log('CogAgent is processing. Please do not interact with the keyboard or mouse.');
@@ -214,7 +228,13 @@ function handleStreamEvent(data) {
 // 停止生成
 stopBtn.addEventListener('click', async () => {
     try {
-        await fetch('/stop', { method: 'POST' });
+        await fetch('/stop', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ session_id: sessionId })
+        });
         setGenerating(false);
     } catch (error) {
         console.error('Stop error:', error);
@@ -234,6 +254,8 @@ clearBtn.addEventListener('click', async () => {
         
         chatbot.innerHTML = '<div class="chat-empty">Start conversation...</div>';
         resultImage.style.display = 'none';
+        currentBoxes = [];
+        renderBoxes();
         resultArea.querySelector('.result-placeholder').style.display = 'block';
         resultArea.classList.remove('has-image');
         
@@ -244,6 +266,57 @@ clearBtn.addEventListener('click', async () => {
     }
 });
 
+// 显示结果图片，并在其上叠加边界框
+function showResultImage(path, boxes) {
+    console.log('Result image path:', path);
+    currentBoxes = boxes || [];
+    
+    resultImage.onload = function() {
+        console.log('Result image loaded successfully');
+        resultImage.style.display = 'block';
+        resultArea.querySelector('.result-placeholder').style.display = 'none';
+        resultArea.classList.add('has-image');
+        renderBoxes();
+    };
+    
+    resultImage.onerror = function() {
+        console.error('Failed to load result image:', path);
+    };
+    
+    resultImage.src = path;
+    // 同一张图片不会再次触发 onload
+    if (resultImage.complete && resultImage.naturalWidth) {
+        renderBoxes();
+    }
+}
+
+// 将叠加层对齐到图片的实际显示区域并绘制边界框
+function renderBoxes() {
+    boxOverlay.innerHTML = '';
+    
+    if (!currentBoxes.length || resultImage.style.display === 'none') {
+        boxOverlay.style.display = 'none';
+        return;
+    }
+    
+    boxOverlay.style.left = resultImage.offsetLeft + 'px';
+    boxOverlay.style.top = resultImage.offsetTop + 'px';
+    boxOverlay.style.width = resultImage.offsetWidth + 'px';
+    boxOverlay.style.height = resultImage.offsetHeight + 'px';
+    
+    for (const box of currentBoxes) {
+        const rect = document.createElementNS('http://www.w3.org/2000/svg', 'rect');
+        rect.setAttribute('x', box[0]);
+        rect.setAttribute('y', box[1]);
+        rect.setAttribute('width', Math.max(box[2] - box[0], 0));
+        rect.setAttribute('height', Math.max(box[3] - box[1], 0));
+        boxOverlay.appendChild(rect);
+    }
+    boxOverlay.style.display = 'block';
+}
+
+window.addEventListener('resize', renderBoxes);
+
 // 添加消息
 function addMessage(role, content) {
     // 移除空状态提示
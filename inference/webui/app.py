@@ -3,13 +3,11 @@ import os
 import re
 import torch
 import base64
-import json
-from threading import Thread, Event
+from threading import Thread
 from PIL import Image, ImageDraw
 from flask import Flask, render_template, request, jsonify, send_from_directory
 from flask_cors import CORS
 from transformers import (
-    AutoTokenizer,
     AutoModelForCausalLM,
     TextIteratorStreamer,
 )
@@ -18,17 +16,38 @@ from werkzeug.utils import secure_filename
 import uuid
 from io import BytesIO
 
+# 导入共享模块（位于 app/ 目录）
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))), 'app'))
+from artifact_store import ArtifactStore
+from model_backend import BACKENDS, load_model
+from sse import coalesce, event as sse_event
+from session_stop import SessionStops
+from token_budget import budget_for_format
+from prompt_cache import PromptBuilder
+from history import HISTORY_STRATEGIES, format_history
+
 app = Flask(__name__)
 CORS(app)
 
 # 全局变量
 tokenizer = None
 model = None
+prompt_builder = None
 platform_str = ""
 format_str = ""
 output_dir = ""
-stop_event = Event()
+render_boxes = False
+history_strategy = "full"
+history_window = 4
+stream_flush_tokens = 8
+stream_flush_ms = 40.0
+# 每个会话的停止标志，/stop 只停止发起请求的会话
+session_stops = SessionStops()
 current_session = {}
+# 上传图片与标注结果的存储（后台写盘 + 容量/时间清理），在 main() 中创建
+upload_store = None
+result_store = None
 
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
@@ -41,7 +60,7 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def draw_boxes_on_image(image: Image.Image, boxes: List[List[float]], save_path: str):
+def draw_boxes_on_image(image: Image.Image, boxes: List[List[float]]) -> Image.Image:
     """绘制边界框"""
     draw = ImageDraw.Draw(image)
     for box in boxes:
@@ -50,7 +69,20 @@ def draw_boxes_on_image(image: Image.Image, boxes: List[List[float]], save_path:
         x_max = int(box[2] * image.width)
         y_max = int(box[3] * image.height)
         draw.rectangle([x_min, y_min, x_max, y_max], outline="red", width=3)
-    image.save(save_path)
+    return image
+
+
+def session_artifacts():
+    """会话仍在引用的上传图片与结果图片，存储清理时保留（在写盘线程中调用）"""
+    return [name for session in list(current_session.values()) for name in list(session['artifacts'])]
+
+
+def send_artifact(store: ArtifactStore, filename: str):
+    """发送存储中的文件；文件名由内容哈希生成，可以长期缓存"""
+    store.wait(filename)
+    response = send_from_directory(store.root, filename, max_age=ArtifactStore.CACHE_MAX_AGE)
+    response.headers.update(ArtifactStore.CACHE_HEADERS)
+    return response
 
 
 def preprocess_messages(history, img_path):
@@ -63,10 +95,8 @@ def preprocess_messages(history, img_path):
             grounded_operation = matches_history.group(1)
             history_step.append(grounded_operation)
 
-    history_str = "\nHistory steps: "
-    if history_step:
-        for i, step in enumerate(history_step):
-            history_str += f"\n{i}. {step}"
+    # 历史步骤按 --history 策略选取（窗口、去重、压缩），限制多轮对话中提示词的增长
+    history_str = format_history(history_step, None, history_strategy, history_window)
 
     if history:
         task = history[-1][0]
@@ -96,11 +126,10 @@ def upload_file():
     
     if file and allowed_file(file.filename):
         filename = secure_filename(file.filename)
-        unique_filename = f"{uuid.uuid4()}_{filename}"
-        filepath = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
-        file.save(filepath)
-        print(f"File saved to: {filepath}")
-        print(f"File exists: {os.path.exists(filepath)}")
+        ext = filename.rsplit('.', 1)[1].lower()
+        unique_filename = upload_store.put_bytes(file.read(), ext)
+        filepath = upload_store.path(unique_filename)
+        print(f"File queued to: {filepath}")
         return jsonify({'filename': unique_filename, 'path': filepath})
     
     return jsonify({'error': 'Invalid file type'}), 400
@@ -109,27 +138,13 @@ def upload_file():
 @app.route('/uploads/<filename>')
 def uploaded_file(filename):
     """获取上传的文件"""
-    filepath = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-    print(f"Requesting file: {filepath}")
-    print(f"File exists: {os.path.exists(filepath)}")
-    print(f"Upload folder: {app.config['UPLOAD_FOLDER']}")
-    return send_from_directory(app.config['UPLOAD_FOLDER'], filename)
+    return send_artifact(upload_store, filename)
 
 
 @app.route('/results/<filename>')
 def result_file(filename):
     """获取结果文件"""
-    result_dir = output_dir if output_dir else 'results'
-    # 转换为绝对路径
-    if not os.path.isabs(result_dir):
-        result_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), result_dir)
-    
-    filepath = os.path.join(result_dir, filename)
-    print(f"Requesting result file: {filepath}")
-    print(f"Result file exists: {os.path.exists(filepath)}")
-    print(f"Result directory: {result_dir}")
-    
-    return send_from_directory(result_dir, filename)
+    return send_artifact(result_store, filename)
 
 
 @app.route('/predict', methods=['POST'])
@@ -141,31 +156,33 @@ def predict():
     session_id = data.get('session_id', str(uuid.uuid4()))
     task = data.get('task', '')
     img_path = data.get('img_path', '')
-    max_length = data.get('max_length', 1024)
+    # 新生成 token 数；未指定时按回答格式的预算（见 app/token_budget.py）
+    max_new_tokens = data.get('max_new_tokens') or budget_for_format(format_str)
     
+    # 上传的图片可能仍在后台写盘
+    if img_path:
+        upload_store.wait(img_path)
     if not img_path or not os.path.exists(img_path):
         return jsonify({'error': 'Image not found'}), 400
     
     # 初始化或获取会话
     if session_id not in current_session:
-        current_session[session_id] = {'history': []}
+        current_session[session_id] = {'history': [], 'artifacts': set()}
     
     history = current_session[session_id]['history']
     history.append([task, ""])
+    # 会话引用的图片不会被存储清理
+    artifacts = current_session[session_id]['artifacts']
+    artifacts.add(os.path.basename(img_path))
     
-    # 重置停止事件
-    stop_event.clear()
+    # 本次生成的停止标志（只属于该会话）
+    stop_event = session_stops.start(session_id)
     
     def generate():
         try:
             query, image = preprocess_messages(history, img_path)
-            inputs = tokenizer.apply_chat_template(
-                [{"role": "user", "image": image, "content": query}],
-                add_generation_prompt=True,
-                tokenize=True,
-                return_tensors="pt",
-                return_dict=True,
-            ).to(model.device)
+            # 模板框架与重复出现的行（任务、历史、平台、格式）的 token 已缓存，只对新增内容分词
+            inputs = prompt_builder.build(query, image).to(model.device)
             
             streamer = TextIteratorStreamer(
                 tokenizer, timeout=60, skip_prompt=True, skip_special_tokens=True
@@ -177,7 +194,7 @@ def predict():
                 "position_ids": inputs["position_ids"],
                 "images": inputs["images"],
                 "streamer": streamer,
-                "max_length": max_length,
+                "max_new_tokens": max_new_tokens,
                 "do_sample": True,
                 "top_k": 1,
             }
@@ -186,43 +203,54 @@ def predict():
             t.start()
             
             with torch.no_grad():
-                for new_token in streamer:
+                # 合并连续的 token，减少 SSE 帧数与序列化开销
+                for new_text in coalesce(streamer, stream_flush_tokens, stream_flush_ms):
                     if stop_event.is_set():
-                        yield f"data: {json.dumps({'type': 'stopped'})}\n\n"
+                        yield sse_event({'type': 'stopped'})
                         return
                     
-                    if new_token:
-                        history[-1][1] += new_token
-                        yield f"data: {json.dumps({'type': 'token', 'content': new_token})}\n\n"
+                    history[-1][1] += new_text
+                    yield sse_event({'type': 'token', 'content': new_text})
             
-            # 检查是否有边界框
+            # 发送本轮 token 用量（提示词 / 生成）
             response = history[-1][1]
+            yield sse_event({
+                'type': 'usage',
+                'prompt_tokens': inputs["input_ids"].shape[1],
+                'completion_tokens': len(tokenizer.encode(response, add_special_tokens=False)),
+            })
+            
+            # 检查是否有边界框
             box_pattern = r"box=\[\[?(\d+),(\d+),(\d+),(\d+)\]?\]"
             matches = re.findall(box_pattern, response)
             
             if matches:
                 boxes = [[int(x) / 1000 for x in match] for match in matches]
-                os.makedirs(output_dir, exist_ok=True)
-                base_name = os.path.splitext(os.path.basename(img_path))[0]
-                round_num = len([h for h in history if h[0] and h[1]])
-                output_filename = f"{base_name}_{round_num}.png"
-                output_path = os.path.join(output_dir, output_filename)
-                image = Image.open(img_path).convert("RGB")
-                draw_boxes_on_image(image, boxes, output_path)
-                yield f"data: {json.dumps({'type': 'image', 'path': f'/results/{output_filename}'})}\n\n"
+                if render_boxes:
+                    # 导出模式：服务端绘制标注图片
+                    image = draw_boxes_on_image(image.copy(), boxes)
+                    output_filename = result_store.put_image(image)
+                    artifacts.add(output_filename)
+                    yield sse_event({'type': 'image', 'path': f'/results/{output_filename}'})
+                else:
+                    # 默认：只发送归一化坐标，由前端在原图上叠加绘制
+                    upload_path = f'/uploads/{os.path.basename(img_path)}'
+                    yield sse_event({'type': 'boxes', 'path': upload_path, 'boxes': boxes})
             
-            yield f"data: {json.dumps({'type': 'done'})}\n\n"
+            yield sse_event({'type': 'done'})
             
         except Exception as e:
-            yield f"data: {json.dumps({'type': 'error', 'message': str(e)})}\n\n"
+            yield sse_event({'type': 'error', 'message': str(e)})
+        finally:
+            session_stops.finish(session_id, stop_event)
     
     return app.response_class(generate(), mimetype='text/event-stream')
 
 
 @app.route('/stop', methods=['POST'])
 def stop_generation():
-    """停止生成"""
-    stop_event.set()
+    """停止生成：只停止请求中 session_id 的生成"""
+    session_stops.stop((request.get_json(silent=True) or {}).get('session_id'))
     return jsonify({'status': 'stopped'})
 
 
@@ -247,6 +275,7 @@ def clear_history():
     
     if session_id in current_session:
         current_session[session_id]['history'] = []
+        current_session[session_id]['artifacts'] = set()
     
     return jsonify({'status': 'success'})
 
@@ -262,16 +291,29 @@ def get_history():
     return jsonify({'history': []})
 
 
-def main():
+def build_parser() -> argparse.ArgumentParser:
+    """命令行参数（Flask 版与 asgi_app.py 共用）"""
     parser = argparse.ArgumentParser(description="CogAgent Flask Demo")
     parser.add_argument("--host", default="127.0.0.1", help="Host IP for the server.")
     parser.add_argument("--port", type=int, default=7860, help="Port for the server.")
     parser.add_argument("--model_dir", required=True, help="Path or identifier of the model.")
     parser.add_argument("--format_key", default="action_op_sensitive", help="Key to select the prompt format.")
     parser.add_argument("--platform", default="Mac", help="Platform information string.")
+    parser.add_argument("--backend", choices=BACKENDS, default="default", help="Inference backend: full precision, int8/int4 quantization, or CPU.")
+    parser.add_argument("--cpu_threads", type=int, default=None, help="Number of threads of the CPU backends.")
     parser.add_argument("--output_dir", default="results", help="Directory to save annotated images.")
-    args = parser.parse_args()
-
+    parser.add_argument("--stream_flush_tokens", type=int, default=8, help="Max number of tokens merged into one SSE frame (1 disables merging).")
+    parser.add_argument("--stream_flush_ms", type=float, default=40.0, help="Max time in milliseconds a token is buffered before it is sent.")
+    parser.add_argument("--render_boxes", action="store_true", help="Render annotated images on the server (export mode) instead of in the browser.")
+    parser.add_argument("--cache_max_mb", type=int, default=1024, help="Max disk usage of uploads and output_dir in MB (0 = unlimited).")
+    parser.add_argument("--cache_max_age", type=float, default=72, help="Delete stored images older than this many hours (0 = never).")
+    parser.add_argument("--history", choices=HISTORY_STRATEGIES, default="full", help="History steps in the prompt: all, the last --history_window, repeats collapsed, or older steps reduced to the operation name.")
+    parser.add_argument("--history_window", type=int, default=4, help="Number of recent steps kept in full by the window and compact strategies.")
+    return parser
+
+
+def configure(args):
+    """加载模型并根据命令行参数设置全局配置与存储（Flask 版与 asgi_app.py 共用）"""
     format_dict = {
         "action_op_sensitive": "(Answer in Action-Operation-Sensitive format.)",
         "status_plan_action_op": "(Answer in Status-Plan-Action-Operation format.)",
@@ -283,17 +325,27 @@ def main():
     if args.format_key not in format_dict:
         raise ValueError(f"Invalid format_key. Available keys: {list(format_dict.keys())}")
 
-    global tokenizer, model, platform_str, format_str, output_dir
+    global tokenizer, model, platform_str, format_str, output_dir, upload_store, result_store, render_boxes
+    global stream_flush_tokens, stream_flush_ms, prompt_builder, history_strategy, history_window
     
     print("Loading model...")
-    tokenizer = AutoTokenizer.from_pretrained(args.model_dir, trust_remote_code=True)
-    model = AutoModelForCausalLM.from_pretrained(
-        args.model_dir, torch_dtype=torch.bfloat16, trust_remote_code=True, device_map="auto"
-    ).eval()
+    tokenizer, model = load_model(
+        args.model_dir,
+        backend=args.backend,
+        model_class=AutoModelForCausalLM,
+        torch_dtype=torch.bfloat16,
+        cpu_threads=args.cpu_threads,
+    )
     print("Model loaded successfully!")
+    prompt_builder = PromptBuilder(tokenizer)
 
     platform_str = f"(Platform: {args.platform})\n"
     format_str = format_dict[args.format_key]
+    render_boxes = args.render_boxes
+    stream_flush_tokens = args.stream_flush_tokens
+    stream_flush_ms = args.stream_flush_ms
+    history_strategy = args.history
+    history_window = args.history_window
     
     # 转换 output_dir 为绝对路径
     if not os.path.isabs(args.output_dir):
@@ -301,12 +353,23 @@ def main():
     else:
         output_dir = args.output_dir
     
-    # 确保目录存在
-    os.makedirs(UPLOAD_FOLDER, exist_ok=True)
-    os.makedirs(output_dir, exist_ok=True)
+    # 创建存储（同时确保目录存在）
+    # 只清理存储自己写入的文件（output_dir 中的其他文件不受影响），跳过会话仍在引用的图片
+    retention = dict(
+        max_bytes=args.cache_max_mb * 1024 * 1024,
+        max_age=args.cache_max_age * 3600,
+        in_use=session_artifacts,
+    )
+    upload_store = ArtifactStore(UPLOAD_FOLDER, **retention)
+    result_store = ArtifactStore(output_dir, **retention)
     
     print(f"Upload folder: {UPLOAD_FOLDER}")
     print(f"Output folder: {output_dir}")
+
+
+def main():
+    args = build_parser().parse_args()
+    configure(args)
     print(f"Starting server at http://{args.host}:{args.port}")
     app.run(host=args.host, port=args.port, debug=False, threaded=True)
 
@@ -0,0 +1,326 @@
+"""
+CogAgent Web Demo - ASGI Version
+与 app.py（Flask 版）路由、参数和 SSE 事件一致的异步版本，适合大量浏览器会话同时连接
+
+每个 SSE 流是一个协程：生成在有界的生成线程池中运行（--generation_workers，超出的请求排队），
+token 经异步 streamer 送回事件循环；图片解码、分词与标注绘制交给有界线程池（--blocking_workers）。
+该会话的 /stop 或客户端断开时，生成在下一个解码步停止（CancelCriteria），不再占用生成线程直到 max_new_tokens。
+
+运行：python inference/webui/asgi_app.py --model_dir THUDM/cogagent-9b-20241220 --host 127.0.0.1 --port 7860
+"""
+
+import asyncio
+import os
+import re
+import sys
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from contextlib import asynccontextmanager
+from typing import Optional
+
+import torch
+import uvicorn
+from fastapi import FastAPI, File, Request, UploadFile
+from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import FileResponse, JSONResponse, StreamingResponse
+from fastapi.staticfiles import StaticFiles
+from transformers import StoppingCriteria, StoppingCriteriaList, TextStreamer
+from werkzeug.utils import secure_filename
+
+# Flask 版的模块（app.py）提供模型加载、配置与提示词构造；优先于 app/ 目录导入
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import app as webui
+from artifact_store import ArtifactStore
+from sse import acoalesce, event as sse_event
+from token_budget import budget_for_format
+
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+INDEX_PAGE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'templates', 'index.html')
+
+# 生成线程池（同时生成的请求数），与阻塞操作（图片解码、分词、绘制）的线程池，在 main() 中按参数重新创建
+generation_pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix='generate')
+blocking_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='blocking')
+
+
+async def run_blocking(function, *args, pool: Optional[ThreadPoolExecutor] = None, **kwargs):
+    """在线程池中执行阻塞函数，不阻塞事件循环"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool or blocking_pool, partial(function, *args, **kwargs))
+
+
+class AsyncTextStreamer(TextStreamer):
+    """在生成线程中解码 token，通过 asyncio.Queue 交给事件循环中的协程"""
+
+    def __init__(self, tokenizer, loop: asyncio.AbstractEventLoop, timeout: Optional[float] = None, **kwargs):
+        super().__init__(tokenizer, **kwargs)
+        self.loop = loop
+        self.timeout = timeout
+        self.queue = asyncio.Queue()
+
+    def on_finalized_text(self, text: str, stream_end: bool = False):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, text)
+        if stream_end:
+            self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    def end_with_error(self):
+        self.loop.call_soon_threadsafe(self.queue.put_nowait, None)
+
+    async def texts(self):
+        while True:
+            text = await asyncio.wait_for(self.queue.get(), self.timeout)
+            if text is None:
+                return
+            yield text
+
+
+class CancelCriteria(StoppingCriteria):
+    """每个解码步后由 generate 检查：请求的取消标志置位后停止生成"""
+
+    def __init__(self, cancelled: threading.Event):
+        self.cancelled = cancelled
+
+    def __call__(self, input_ids: torch.LongTensor, scores: torch.FloatTensor, **kwargs) -> torch.BoolTensor:
+        return torch.full((input_ids.shape[0],), self.cancelled.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    generation_pool.shutdown(wait=False)
+    blocking_pool.shutdown(wait=False)
+
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=["*"],
+    allow_credentials=True,
+    allow_methods=["*"],
+    allow_headers=["*"],
+)
+app.mount('/static', StaticFiles(directory=STATIC_FOLDER), name='static')
+
+
+async def send_artifact(store: ArtifactStore, filename: str):
+    """发送存储中的文件；文件可能仍在后台写盘，在线程池中等待"""
+    filename = secure_filename(filename)
+    await run_blocking(store.wait, filename)
+    path = store.path(filename)
+    if not os.path.exists(path):
+        return JSONResponse({'error': 'Not found'}, status_code=404)
+    return FileResponse(path, headers=ArtifactStore.CACHE_HEADERS)
+
+
+@app.get('/')
+async def index():
+    """主页"""
+    return FileResponse(INDEX_PAGE)
+
+
+@app.post('/upload')
+async def upload_file(file: Optional[UploadFile] = File(None)):
+    """上传图片"""
+    if file is None:
+        return JSONResponse({'error': 'No file part'}, status_code=400)
+    if file.filename == '':
+        return JSONResponse({'error': 'No selected file'}, status_code=400)
+    if not webui.allowed_file(file.filename):
+        return JSONResponse({'error': 'Invalid file type'}, status_code=400)
+
+    data = await file.read()
+    if len(data) > webui.app.config['MAX_CONTENT_LENGTH']:
+        return JSONResponse({'error': 'File too large'}, status_code=413)
+    ext = secure_filename(file.filename).rsplit('.', 1)[1].lower()
+    unique_filename = webui.upload_store.put_bytes(data, ext)
+    return {'filename': unique_filename, 'path': webui.upload_store.path(unique_filename)}
+
+
+@app.get('/uploads/{filename}')
+async def uploaded_file(filename: str):
+    """获取上传的文件"""
+    return await send_artifact(webui.upload_store, filename)
+
+
+@app.get('/results/{filename}')
+async def result_file(filename: str):
+    """获取结果文件"""
+    return await send_artifact(webui.result_store, filename)
+
+
+def generate_blocking(streamer: AsyncTextStreamer, generate_kwargs: dict, cancelled: threading.Event):
+    """在生成线程池中运行 model.generate；出错时结束 streamer，避免协程一直等待；排队期间已取消的请求不再生成"""
+    if cancelled.is_set():
+        streamer.end_with_error()
+        return
+    try:
+        with torch.no_grad():
+            webui.model.generate(
+                **generate_kwargs,
+                streamer=streamer,
+                stopping_criteria=StoppingCriteriaList([CancelCriteria(cancelled)]),
+            )
+    except Exception:
+        streamer.end_with_error()
+        raise
+
+
+@app.post('/predict')
+async def predict(request: Request):
+    """预测接口 - 流式返回"""
+    data = await request.json()
+    session_id = data.get('session_id', str(uuid.uuid4()))
+    task = data.get('task', '')
+    img_path = data.get('img_path', '')
+    # 新生成 token 数；未指定时按回答格式的预算（见 app/token_budget.py）
+    max_new_tokens = data.get('max_new_tokens') or budget_for_format(webui.format_str)
+
+    # 上传的图片可能仍在后台写盘
+    if img_path:
+        await run_blocking(webui.upload_store.wait, img_path)
+    if not img_path or not os.path.exists(img_path):
+        return JSONResponse({'error': 'Image not found'}, status_code=400)
+
+    # 初始化或获取会话
+    if session_id not in webui.current_session:
+        webui.current_session[session_id] = {'history': [], 'artifacts': set()}
+
+    history = webui.current_session[session_id]['history']
+    history.append([task, ""])
+    # 会话引用的图片不会被存储清理
+    artifacts = webui.current_session[session_id]['artifacts']
+    artifacts.add(os.path.basename(img_path))
+
+    # 本次生成的停止标志（只属于该会话）：该会话的 /stop、断开（生成器被关闭）或出错时置位，生成线程在下一个解码步结束
+    cancelled = webui.session_stops.start(session_id)
+
+    async def generate():
+        try:
+            query, image = await run_blocking(webui.preprocess_messages, history, img_path)
+            inputs = await run_blocking(webui.prompt_builder.build, query, image)
+            inputs = inputs.to(webui.model.device)
+
+            # 请求可能在生成线程池中排队，因此不设置等待 token 的超时
+            streamer = AsyncTextStreamer(
+                webui.tokenizer, asyncio.get_running_loop(), skip_prompt=True, skip_special_tokens=True
+            )
+            generate_kwargs = {
+                "input_ids": inputs["input_ids"],
+                "attention_mask": inputs["attention_mask"],
+                "position_ids": inputs["position_ids"],
+                "images": inputs["images"],
+                "max_new_tokens": max_new_tokens,
+                "do_sample": True,
+                "top_k": 1,
+            }
+            generation = asyncio.ensure_future(
+                run_blocking(generate_blocking, streamer, generate_kwargs, cancelled, pool=generation_pool)
+            )
+
+            # 合并连续的 token，减少 SSE 帧数与序列化开销
+            async for new_text in acoalesce(streamer.texts(), webui.stream_flush_tokens, webui.stream_flush_ms):
+                if cancelled.is_set():
+                    yield sse_event({'type': 'stopped'})
+                    return
+
+                history[-1][1] += new_text
+                yield sse_event({'type': 'token', 'content': new_text})
+            # 生成中的异常在这里抛出
+            await generation
+
+            # 发送本轮 token 用量（提示词 / 生成）
+            response = history[-1][1]
+            yield sse_event({
+                'type': 'usage',
+                'prompt_tokens': inputs["input_ids"].shape[1],
+                'completion_tokens': len(webui.tokenizer.encode(response, add_special_tokens=False)),
+            })
+
+            # 检查是否有边界框
+            box_pattern = r"box=\[\[?(\d+),(\d+),(\d+),(\d+)\]?\]"
+            matches = re.findall(box_pattern, response)
+
+            if matches:
+                boxes = [[int(x) / 1000 for x in match] for match in matches]
+                if webui.render_boxes:
+                    # 导出模式：服务端绘制标注图片
+                    annotated = await run_blocking(webui.draw_boxes_on_image, image.copy(), boxes)
+                    output_filename = webui.result_store.put_image(annotated)
+                    artifacts.add(output_filename)
+                    yield sse_event({'type': 'image', 'path': f'/results/{output_filename}'})
+                else:
+                    # 默认：只发送归一化坐标，由前端在原图上叠加绘制
+                    upload_path = f'/uploads/{os.path.basename(img_path)}'
+                    yield sse_event({'type': 'boxes', 'path': upload_path, 'boxes': boxes})
+
+            yield sse_event({'type': 'done'})
+
+        except Exception as e:
+            yield sse_event({'type': 'error', 'message': str(e)})
+        finally:
+            cancelled.set()
+            webui.session_stops.finish(session_id, cancelled)
+
+    return StreamingResponse(generate(), media_type='text/event-stream')
+
+
+@app.post('/stop')
+async def stop_generation(request: Request):
+    """停止生成：只停止请求中 session_id 的生成"""
+    data = await request.json()
+    webui.session_stops.stop(data.get('session_id'))
+    return {'status': 'stopped'}
+
+
+@app.post('/undo')
+async def undo_last(request: Request):
+    """撤销最后一轮"""
+    data = await request.json()
+    session_id = data.get('session_id')
+
+    if session_id in webui.current_session and webui.current_session[session_id]['history']:
+        webui.current_session[session_id]['history'].pop()
+        return {'status': 'success', 'history': webui.current_session[session_id]['history']}
+
+    return {'status': 'success', 'history': []}
+
+
+@app.post('/clear')
+async def clear_history(request: Request):
+    """清空历史"""
+    data = await request.json()
+    session_id = data.get('session_id')
+
+    if session_id in webui.current_session:
+        webui.current_session[session_id]['history'] = []
+        webui.current_session[session_id]['artifacts'] = set()
+
+    return {'status': 'success'}
+
+
+@app.get('/history')
+async def get_history(session_id: Optional[str] = None):
+    """获取历史记录"""
+    if session_id in webui.current_session:
+        return {'history': webui.current_session[session_id]['history']}
+
+    return {'history': []}
+
+
+def main():
+    global generation_pool, blocking_pool
+    parser = webui.build_parser()
+    parser.add_argument("--generation_workers", type=int, default=1, help="Number of generations running at the same time; further requests wait.")
+    parser.add_argument("--blocking_workers", type=int, default=4, help="Threads for image decoding, tokenization and rendering shared by all sessions.")
+    args = parser.parse_args()
+    webui.configure(args)
+    generation_pool = ThreadPoolExecutor(max_workers=args.generation_workers, thread_name_prefix='generate')
+    blocking_pool = ThreadPoolExecutor(max_workers=args.blocking_workers, thread_name_prefix='blocking')
+
+    print(f"Starting server at http://{args.host}:{args.port}")
+    uvicorn.run(app, host=args.host, port=args.port, workers=1)
+
+
+if __name__ == "__main__":
+    main()
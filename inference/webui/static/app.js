@@ -15,6 +15,10 @@ const taskInput = document.getElementById('taskInput');
 const submitBtn = document.getElementById('submitBtn');
 const clearBtn = document.getElementById('clearBtn');
 const stopBtn = document.getElementById('stopBtn');
+const boxOverlay = document.getElementById('boxOverlay');
+
+// 当前结果图片上的边界框（0-1 归一化坐标）
+let currentBoxes = [];
 
 // 生成 UUID
 function generateUUID() {
@@ -127,8 +131,7 @@ submitBtn.addEventListener('click', async () => {
             body: JSON.stringify({
                 session_id: sessionId,
                 task: task,
-                img_path: currentImagePath,
-                max_length: 1024
+                img_path: currentImagePath
             })
         });
         
@@ -151,22 +154,15 @@ submitBtn.addEventListener('click', async () => {
                     
                     if (data.type === 'token') {
                         appendToMessage(botMessageId, data.content);
+                    } else if (data.type === 'usage') {
+                        // 本轮 token 用量（提示词 / 生成）
+                        console.log(`Tokens: prompt ${data.prompt_tokens}, completion ${data.completion_tokens}`);
                     } else if (data.type === 'image') {
-                        console.log('Result image path:', data.path);
-                        
-                        resultImage.onload = function() {
-                            console.log('Result image loaded successfully');
-                            resultImage.style.display = 'block';
-                            resultArea.querySelector('.result-placeholder').style.display = 'none';
-                            resultArea.classList.add('has-image');
-                        };
-                        
-                        resultImage.onerror = function() {
-                            console.error('Failed to load result image:', data.path);
-                            alert('结果图片加载失败');
-                        };
-                        
-                        resultImage.src = data.path;
+                        // 导出模式：服务端绘制好的标注图片
+                        showResultImage(data.path, []);
+                    } else if (data.type === 'boxes') {
+                        // 原图 + 前端叠加边界框
+                        showResultImage(data.path, data.boxes);
                     } else if (data.type === 'done') {
                         setGenerating(false);
                     } else if (data.type === 'stopped') {
@@ -188,7 +184,13 @@ submitBtn.addEventListener('click', async () => {
 // 停止生成
 stopBtn.addEventListener('click', async () => {
     try {
-        await fetch('/stop', { method: 'POST' });
+        await fetch('/stop', {
+            method: 'POST',
+            headers: {
+                'Content-Type': 'application/json'
+            },
+            body: JSON.stringify({ session_id: sessionId })
+        });
         setGenerating(false);
     } catch (error) {
         console.error('Stop error:', error);
@@ -212,6 +214,8 @@ clearBtn.addEventListener('click', async () => {
         
         chatbot.innerHTML = '<div class="chat-empty">开始对话...</div>';
         resultImage.style.display = 'none';
+        currentBoxes = [];
+        renderBoxes();
         resultArea.querySelector('.result-placeholder').style.display = 'block';
         resultArea.classList.remove('has-image');
     } catch (error) {
@@ -219,6 +223,57 @@ clearBtn.addEventListener('click', async () => {
     }
 });
 
+// 显示结果图片，并在其上叠加边界框
+function showResultImage(path, boxes) {
+    console.log('Result image path:', path);
+    currentBoxes = boxes || [];
+    
+    resultImage.onload = function() {
+        console.log('Result image loaded successfully');
+        resultImage.style.display = 'block';
+        resultArea.querySelector('.result-placeholder').style.display = 'none';
+        resultArea.classList.add('has-image');
+        renderBoxes();
+    };
+    
+    resultImage.onerror = function() {
+        console.error('Failed to load result image:', path);
+    };
+    
+    resultImage.src = path;
+    // 同一张图片不会再次触发 onload
+    if (resultImage.complete && resultImage.naturalWidth) {
+        renderBoxes();
+    }
+}
+
+// 将叠加层对齐到图片的实际显示区域并绘制边界框
+function renderBoxes() {
+    boxOverlay.innerHTML = '';
+    
+    if (!currentBoxes.length || resultImage.style.display === 'none') {
+        boxOverlay.style.display = 'none';
+        return;
+    }
+    
+    boxOverlay.style.left = resultImage.offsetLeft + 'px';
+    boxOverlay.style.top = resultImage.offsetTop + 'px';
+    boxOverlay.style.width = resultImage.offsetWidth + 'px';
+    boxOverlay.style.height = resultImage.offsetHeight + 'px';
+    
+    for (const box of currentBoxes) {
+        const rect = document.createElementNS('http://www.w3.org/2000/svg', 'rect');
+        rect.setAttribute('x', box[0]);
+        rect.setAttribute('y', box[1]);
+        rect.setAttribute('width', Math.max(box[2] - box[0], 0));
+        rect.setAttribute('height', Math.max(box[3] - box[1], 0));
+        boxOverlay.appendChild(rect);
+    }
+    boxOverlay.style.display = 'block';
+}
+
+window.addEventListener('resize', renderBoxes);
+
 // 添加消息
 function addMessage(role, content) {
     // 移除空状态提示